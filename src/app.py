@@ -1,23 +1,45 @@
 import json
 import logging
 import os
+import threading
 from functools import lru_cache
+from typing import Iterator, Tuple, Optional, Union
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 
-from question_to_sql import get_prompt
-
-from sql_fixer import fix_sql
-from utils import init_logging, invoke_llm, init_env_from_file
+from dataset_context import DatasetContextStore
+from hedging import hedging_stats
+from llm_cache import LLMResponseCache
+from llm_router import router
+from server_datasets import QueryError, QueryResult, CachedQueryResult, create_dataset_server, has_arrow
+from metrics import stage, track_request, render_metrics, RATE_LIMITED, CACHE
+from sql_batch import generate_sql_batch, parse_questions
+from sql_generator import SqlResult, generate_sql, generate_sql_stream, log_result, warm_up_sql_fixer
+from sql_request import SqlRequest, parse_sql_request, parse_dataset_context, read_json_body
+from utils import init_logging, init_env_from_file, warm_up_llm_clients
 from visitors_limit import VisitorsLimit
 from flask_compress import Compress
 
 
 app = Flask(__name__, static_url_path="", static_folder="static")
 Compress(app)
-visitors_limit = VisitorsLimit(200, 20, 3600)
+visitors_limit = VisitorsLimit(int(os.environ.get("VISITORS_LIMIT_TOTAL", 200)),
+                               int(os.environ.get("VISITORS_LIMIT_PER_VISITOR", 20)), 3600,
+                               db_file=os.environ.get("VISITORS_LIMIT_DB"))
+llm_cache = LLMResponseCache(max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 1000)),
+                             ttl_seconds=float(os.environ.get("LLM_CACHE_TTL", 3600)),
+                             max_bytes=int(os.environ.get("LLM_CACHE_MAX_BYTES", 50 * 1024 * 1024)),
+                             db_file=os.environ.get("LLM_CACHE_DB"),
+                             max_disk_entries=int(os.environ.get("LLM_CACHE_DB_MAX_ENTRIES", 100000)))
+dataset_contexts = DatasetContextStore(max_entries=int(os.environ.get("CONTEXT_MAX_ENTRIES", 1000)),
+                                      ttl_seconds=float(os.environ.get("CONTEXT_TTL", 3600)),
+                                      max_bytes=int(os.environ.get("CONTEXT_MAX_BYTES", 100 * 1024 * 1024)),
+                                      max_turns=int(os.environ.get("CONTEXT_MAX_TURNS", 5)))
+dataset_server = create_dataset_server()
 
 _VERSION = os.environ.get("APP_VERSION", "0.0.0")
+_LIMIT_REACHED = "Requests limit has been reached. Please try again later."
+_DATASETS_DISABLED = "Server datasets are not enabled. Set SERVER_DATASETS_DIR to enable them"
 
 
 @app.route('/ping')
@@ -25,6 +47,20 @@ def _ping():
     return jsonify({"status": "ok", "version": _VERSION})
 
 
+@app.route('/stats')
+def _stats():
+    return jsonify({"llm_cache": llm_cache.stats(), "dataset_contexts": dataset_contexts.stats(),
+                    "hedging": hedging_stats(), "llm_router": router.stats(),
+                    "server_datasets": dataset_server.stats() if dataset_server is not None else None})
+
+
+@app.route('/metrics')
+def _metrics():
+    for name, value in llm_cache.stats().items():
+        CACHE.set(value, (name,))
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
 @app.route('/')
 def _app_main():
     return render_template("index.html",
@@ -36,43 +72,219 @@ def _app_main():
                            url=os.environ.get("URL", request.host_url))
 
 
-@app.route('/sql')
+@app.route('/sql', methods=["GET", "POST"])
 def _question_to_sql():
-    visitor_id = request.args.get("visitor_id")
-    if "RECAPTCHA_KEY" in os.environ:
-        token = request.args["token"]
-        if not _verify_recaptcha(token):
-            return jsonify({"error": "Recaptcha verification failed"})
-
-    if not visitors_limit.visit(visitor_id):
-        return jsonify({"error": "Requests limit has been reached. Please try again later."})
-    if "hint" in request.args and len(request.args["hint"]) > 0:
-        hint = request.args["hint"]
-    else:
-        hint = None
-
-    table_name = request.args.get("table_name")
-    question = request.args.get("question")
-    metadata = request.args.get("metadata")
-    distinct_values = request.args.get("distinct_values", None)
-    sample_data = request.args["sample_data"]
-    previous_sql = request.args.get("previous_sql", None)
-    previous_error = request.args.get("previous_error", None)
-    prompt = get_prompt(table_name, question, metadata, sample_data, distinct_values, hint, previous_sql, previous_error)
-    model_id = request.args.get("model_id")
+    with track_request("sql") as outcome:
+        sql_request, error = _read_sql_request()
+        if error is not None:
+            outcome[0] = "rejected"
+            return jsonify({"error": error})
+
+        try:
+            result = generate_sql(sql_request, llm_cache)
+        except Exception as e:
+            logging.exception("Error invoking LLM")
+            outcome[0] = "error"
+            return jsonify({"error": str(e)})
+        return jsonify(_format_result(sql_request, result))
+
+
+@app.route('/sql/context', methods=["POST"])
+def _register_dataset_context():
+    try:
+        context = parse_dataset_context(read_json_body(request.get_data(), request.headers.get("Content-Encoding")))
+    except ValueError as e:
+        return jsonify({"error": f"Invalid request: {e}"})
+    return jsonify({"context_id": dataset_contexts.register(context)})
+
+
+@app.route('/sql/stream', methods=["GET", "POST"])
+def _question_to_sql_stream():
+    sql_request, error = _read_sql_request()
+    if error is not None:
+        return Response(_sse_event("error", {"error": error}), mimetype="text/event-stream")
+
+    def _events() -> Iterator[str]:
+        with track_request("sql_stream") as outcome:
+            try:
+                for event, value in generate_sql_stream(sql_request, llm_cache):
+                    if event == "token":
+                        yield _sse_event("token", {"text": value})
+                    elif event == "retry":
+                        yield _sse_event("retry", {"error": value})
+                    else:
+                        yield _sse_event("result", _format_result(sql_request, value))
+            except Exception as e:
+                logging.exception("Error invoking LLM")
+                outcome[0] = "error"
+                yield _sse_event("error", {"error": str(e)})
+
+    return Response(_events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/sql/batch', methods=["POST"])
+def _question_to_sql_batch():
+    try:
+        params = read_json_body(request.get_data(), request.headers.get("Content-Encoding"))
+        questions = parse_questions(params)
+        sql_request = parse_sql_request(params, dataset_contexts)
+    except ValueError as e:
+        return Response(_sse_event("error", {"error": f"Invalid request: {e}"}), mimetype="text/event-stream")
+    if not _is_human(sql_request):
+        return Response(_sse_event("error", {"error": "Recaptcha verification failed"}), mimetype="text/event-stream")
+
+    def _events() -> Iterator[str]:
+        # Every question counts as a request for the requests limit
+        allowed = []
+        for index in range(len(questions)):
+            if visitors_limit.visit(sql_request.visitor_id):
+                allowed.append(index)
+            else:
+                RATE_LIMITED.inc()
+                yield _sse_event("error", {"index": index, "error": _LIMIT_REACHED})
+        errors = len(questions) - len(allowed)
+        sql_requests = [sql_request._replace(question=questions[index]) for index in allowed]
+        for position, value in generate_sql_batch(sql_requests, llm_cache):
+            index = allowed[position]
+            if isinstance(value, Exception):
+                logging.error(f"Error invoking LLM for batch question {index}", exc_info=value)
+                errors += 1
+                yield _sse_event("error", {"index": index, "error": str(value)})
+            else:
+                log_result(sql_requests[position], value)
+                yield _sse_event("result", {"index": index, **value.to_response()})
+        yield _sse_event("done", {"questions": len(questions), "errors": errors})
+
+    return Response(_events(), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/datasets')
+def _list_datasets():
+    if dataset_server is None:
+        return jsonify({"error": _DATASETS_DISABLED}), 404
+    dataset_server.refresh()
+    return jsonify({"datasets": [{"name": d.name, "format": d.file_format} for d in dataset_server.datasets()]})
+
+
+@app.route('/datasets/query', methods=["POST"])
+def _query_dataset():
+    # Runs the given sql, or the sql generated for the question, on a server dataset. The rows come back as json
+    # lines: the columns, then a line per page of rows and a last line with the row count
+    if dataset_server is None:
+        return jsonify({"error": _DATASETS_DISABLED}), 404
     try:
-        sql = invoke_llm(prompt, model_id)
-    except Exception as e:
-        logging.exception("Error invoking LLM")
+        params = read_json_body(request.get_data(), request.headers.get("Content-Encoding"))
+        arrow = params.get("format") == "arrow"
+        page_size = max(1, int(params.get("page_size", 1000)))
+        if arrow and not has_arrow():
+            raise QueryError("Arrow results need pyarrow, it isn't installed on the server")
+        sql = params.get("sql")
+        if sql:
+            # Nothing to profile, the request only needs the visitor fields
+            sql_request = parse_sql_request({**params, "metadata": "[]"})
+        else:
+            sql_request = parse_sql_request({**params, **dataset_server.get_context(params.get("dataset"))._asdict()})
+    except QueryError as e:
         return jsonify({"error": str(e)})
-    sql = fix_sql(sql, {m["column_name"] for m in json.loads(metadata)})
-    logging.info("Invoke details: %s", {
-        "question": question,
-        "metadata-columns": [row["column_name"] for row in json.loads(metadata)],
-        "previous-error": previous_error,
-        "sql": sql,
-    })
-    return jsonify({"sql": sql})
+    except ValueError as e:
+        return jsonify({"error": f"Invalid request: {e}"})
+    error = _check_visitor(sql_request)
+    if error is not None:
+        return jsonify({"error": error})
+
+    header = {}
+    with track_request("dataset_query") as outcome:
+        try:
+            if not sql:
+                result = generate_sql(sql_request, llm_cache)
+                header = _format_result(sql_request, result)
+                sql = result.sql
+            with stage("query", sql_request.model_id):
+                query = dataset_server.query(sql, arrow=arrow)
+        except QueryError as e:
+            outcome[0] = "error"
+            return jsonify({**header, "sql": sql, "error": str(e)})
+        except Exception as e:
+            logging.exception("Error invoking LLM")
+            outcome[0] = "error"
+            return jsonify({"error": str(e)})
+
+    if arrow:
+        response = Response(query.arrow_stream(), mimetype="application/vnd.apache.arrow.stream",
+                            headers={"X-Query-Sql": json.dumps(sql), "X-Query-Cached": str(query.cached).lower()})
+    else:
+        response = Response(_query_lines(query, {**header, "sql": sql}, page_size),
+                            mimetype="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+    # Also when the client goes away before the rows are read
+    response.call_on_close(query.close)
+    return response
+
+
+def _query_lines(query: Union[QueryResult, CachedQueryResult], header: dict, page_size: int) -> Iterator[str]:
+    yield _json_line({**header, "columns": query.columns, "types": query.types, "cached": query.cached})
+    try:
+        for page in query.pages(page_size):
+            yield _json_line({"rows": page})
+    except QueryError as e:
+        yield _json_line({"error": str(e)})
+        return
+    yield _json_line({"done": True, "rows": query.rows, "truncated": query.truncated})
+
+
+def _json_line(data: dict) -> str:
+    # Dates, times and decimals as text
+    return json.dumps(data, default=str) + "\n"
+
+
+def _read_sql_request() -> Tuple[Optional[SqlRequest], Optional[str]]:
+    try:
+        if request.method == "POST":
+            params = read_json_body(request.get_data(), request.headers.get("Content-Encoding"))
+        else:
+            params = request.args
+        sql_request = parse_sql_request(params, dataset_contexts)
+    except ValueError as e:
+        return None, f"Invalid request: {e}"
+    error = _check_visitor(sql_request)
+    return (sql_request, None) if error is None else (None, error)
+
+
+def _check_visitor(sql_request: SqlRequest) -> Optional[str]:
+    with stage("recaptcha", sql_request.model_id):
+        human = _is_human(sql_request)
+    if not human:
+        return "Recaptcha verification failed"
+
+    with stage("rate_limit", sql_request.model_id):
+        allowed = visitors_limit.visit(sql_request.visitor_id)
+    if not allowed:
+        RATE_LIMITED.inc()
+        return _LIMIT_REACHED
+    return None
+
+
+def _is_human(sql_request: SqlRequest) -> bool:
+    if "RECAPTCHA_KEY" not in os.environ:
+        return True
+    return sql_request.token is not None and bool(_verify_recaptcha(sql_request.token))
+
+
+def _format_result(sql_request: SqlRequest, result: SqlResult) -> dict:
+    log_result(sql_request, result)
+    record_turn(sql_request, result)
+    return result.to_response()
+
+
+def record_turn(sql_request: SqlRequest, result: SqlResult):
+    if sql_request.context_id is not None and sql_request.session_id is not None and result.error is None:
+        dataset_contexts.add_turn(sql_request.context_id, sql_request.session_id, sql_request.question, result.sql,
+                                  replaces=sql_request.previous_sql)
+
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
 
 @lru_cache(maxsize=100)
@@ -92,11 +304,23 @@ def _verify_recaptcha(token: str) -> bool:
     return success
 
 
-if __name__ == '__main__':
+def init_app():
     init_logging()
     logging.getLogger("werkzeug").setLevel('WARNING')
-    port = os.environ.get("APP_PORT", 5000)
-    logging.info(f"Going to start the app. Version: {_VERSION}. Port: {port}")
+    logging.info(f"Going to start the app. Version: {_VERSION}")
     init_env_from_file(os.environ.get("ENV", "aws.env.list"))
-    app.run(host="0.0.0.0", port=port)
+    if os.environ.get("STARTUP_WARM_UP", "true").lower() == "true":
+        # The app serves requests while the backends and sqlglot load, the first /sql waits only for what it needs
+        threading.Thread(target=_warm_up, name="warm-up", daemon=True).start()
 
+
+def _warm_up():
+    warm_up_llm_clients()
+    warm_up_sql_fixer()
+
+
+if __name__ == '__main__':
+    init_app()
+    port = os.environ.get("APP_PORT", 5000)
+    logging.info(f"Starting the development server. Port: {port}")
+    app.run(host="0.0.0.0", port=port)
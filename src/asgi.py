@@ -0,0 +1,158 @@
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from typing import Optional, Tuple, List
+from urllib.parse import parse_qsl
+
+from asgiref.sync import ThreadSensitiveContext
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app as flask_app, init_app, llm_cache, visitors_limit, dataset_contexts, record_turn
+from async_llm import aclose_clients, get_async_client
+from metrics import stage, track_request, RATE_LIMITED
+from sql_generator import agenerate_sql, log_result
+from sql_request import SqlRequest, parse_sql_request, read_json_body
+
+_MAX_BODY_SIZE = 20 * 1024 * 1024
+_MAX_IN_FLIGHT = int(os.environ.get("ASGI_MAX_IN_FLIGHT", 500))
+
+_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", 40))
+
+_in_flight = 0
+_recaptcha_results: OrderedDict[str, bool] = OrderedDict()
+# Flask requests running at once, each in its own thread
+_wsgi_slots = asyncio.Semaphore(_WSGI_THREADS)
+
+
+class _WsgiToAsgi(WsgiToAsgi):
+    # asgiref runs every WSGI request in the one thread sensitive thread, so a stream or a batch would hold up the
+    # others. The Flask routes are thread safe: each request gets its own thread, like in the threaded Flask server
+    async def __call__(self, scope, receive, send):
+        async with _wsgi_slots:
+            async with ThreadSensitiveContext():
+                await super().__call__(scope, receive, send)
+
+
+_flask = _WsgiToAsgi(flask_app)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/sql":
+        await _question_to_sql(scope, receive, send)
+    else:
+        # Everything but the LLM path is cheap, the Flask app serves it from the thread pool
+        await _flask(scope, receive, send)
+
+
+async def _question_to_sql(scope, receive, send):
+    with track_request("sql") as outcome:
+        await _answer_sql_request(scope, receive, send, outcome)
+
+
+async def _answer_sql_request(scope, receive, send, outcome: List[str]):
+    global _in_flight
+    sql_request, error = await _read_sql_request(scope, receive)
+    if error is not None:
+        outcome[0] = "rejected"
+        await _send_json(send, {"error": error})
+        return
+    if _in_flight >= _MAX_IN_FLIGHT:
+        outcome[0] = "rejected"
+        await _send_json(send, {"error": "The server is busy. Please try again later."}, status=503)
+        return
+    _in_flight += 1
+    try:
+        result = await agenerate_sql(sql_request, llm_cache)
+    except Exception as e:
+        logging.exception("Error invoking LLM")
+        outcome[0] = "error"
+        await _send_json(send, {"error": str(e)})
+        return
+    finally:
+        _in_flight -= 1
+    log_result(sql_request, result)
+    record_turn(sql_request, result)
+    await _send_json(send, result.to_response())
+
+
+async def _read_sql_request(scope, receive) -> Tuple[Optional[SqlRequest], Optional[str]]:
+    try:
+        if scope["method"] == "POST":
+            headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+            # Decompressing and parsing a large body would hold up the event loop
+            params = await asyncio.to_thread(read_json_body, await _read_body(receive),
+                                             headers.get("content-encoding"))
+        else:
+            params = dict(parse_qsl(scope["query_string"].decode("utf-8")))
+        sql_request = await asyncio.to_thread(parse_sql_request, params, dataset_contexts)
+    except ValueError as e:
+        return None, f"Invalid request: {e}"
+
+    if "RECAPTCHA_KEY" in os.environ:
+        remote_ip = scope["client"][0] if scope.get("client") else None
+        with stage("recaptcha", sql_request.model_id):
+            human = sql_request.token is not None and await _verify_recaptcha(sql_request.token, remote_ip)
+        if not human:
+            return None, "Recaptcha verification failed"
+
+    with stage("rate_limit", sql_request.model_id):
+        # The limits may be kept in SQLite, which waits for the other workers' writes
+        allowed = await asyncio.to_thread(visitors_limit.visit, sql_request.visitor_id)
+    if not allowed:
+        RATE_LIMITED.inc()
+        return None, "Requests limit has been reached. Please try again later."
+    return sql_request, None
+
+
+async def _read_body(receive) -> bytes:
+    chunks: List[bytes] = []
+    size = 0
+    while True:
+        message = await receive()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > _MAX_BODY_SIZE:
+            raise ValueError(f"Request body is larger than {_MAX_BODY_SIZE} bytes")
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def _verify_recaptcha(token: str, remote_ip: Optional[str]) -> bool:
+    if token in _recaptcha_results:
+        return _recaptcha_results[token]
+    client = get_async_client("https://www.google.com", 10)
+    response = await client.post("/recaptcha/api/siteverify", data={
+        'secret': os.environ["RECAPTCHA_SECRET_KEY"],
+        'response': token,
+        'remote_ip': remote_ip or "",
+    })
+    success = response.json().get('success', None)
+    _recaptcha_results[token] = success
+    if len(_recaptcha_results) > 100:
+        _recaptcha_results.popitem(last=False)
+    return success
+
+
+async def _send_json(send, data: dict, status: int = 200):
+    body = json.dumps(data).encode("utf-8")
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"),
+                            (b"content-length", str(len(body)).encode("ascii"))]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            init_app()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await aclose_clients()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+import os
+from typing import Dict, Tuple, TYPE_CHECKING
+
+from utils import _get_default_model_id, get_provider
+
+if TYPE_CHECKING:
+    import httpx
+
+_clients: Dict[Tuple, "httpx.AsyncClient"] = {}
+
+
+async def ainvoke_llm(prompt: str, model_id: str = None) -> str:
+    if model_id is None or model_id == "":
+        model_id = _get_default_model_id()
+    provider = get_provider(model_id)
+    if provider.ainvoke is None:
+        return await asyncio.to_thread(provider.invoke, prompt, model_id)
+    return await provider.ainvoke(prompt, model_id)
+
+
+def get_async_client(base_url: str, timeout: float) -> "httpx.AsyncClient":
+    import httpx
+    # httpx clients are bound to the event loop they were first used on
+    key = (asyncio.get_running_loop(), base_url, timeout)
+    client = _clients.get(key)
+    if client is None:
+        max_connections = int(os.getenv("LLM_ASYNC_MAX_CONNECTIONS", "100"))
+        logging.info(f"Creating async HTTP client. URL: {base_url}, timeout: {timeout}, "
+                     f"max connections: {max_connections}")
+        client = httpx.AsyncClient(base_url=base_url, timeout=timeout,
+                                   limits=httpx.Limits(max_connections=max_connections,
+                                                       max_keepalive_connections=max_connections))
+        _clients[key] = client
+    return client
+
+
+async def aclose_clients():
+    loop = asyncio.get_running_loop()
+    for key in [k for k in _clients if k[0] is loop]:
+        await _clients.pop(key).aclose()
@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, Tuple, Iterator, Optional
+from urllib.parse import quote
+
+from boto3.session import Session
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from async_llm import get_async_client
+from question_to_sql import Prompt
+from utils import ProviderError
+
+_bedrock_clients: Dict[Tuple, object] = {}
+_bedrock_clients_lock = threading.Lock()
+_aws_credentials = None
+_aws_credentials_lock = threading.Lock()
+
+
+def invoke(prompt: str, model_id: str) -> str:
+    logging.info(f"Going to invoke Bedrock LLM model. Model id: {model_id}")
+
+    bedrock_client = get_bedrock_client()
+    body_dict = _format_model_body(prompt, None, model_id)
+    body_bytes = json.dumps(body_dict).encode("utf-8")
+    try:
+        response = bedrock_client.invoke_model(
+            body=body_bytes,
+            modelId=model_id,
+        )
+    except ClientError as e:
+        raise _provider_error(e) from e
+    return _get_response_content(json.loads(response.get("body").read()), model_id)
+
+
+def invoke_stream(prompt: str, model_id: str) -> Iterator[str]:
+    logging.info(f"Going to invoke Bedrock LLM model with response stream. Model id: {model_id}")
+
+    body_dict = _format_model_body(prompt, None, model_id)
+    try:
+        response = get_bedrock_client().invoke_model_with_response_stream(
+            body=json.dumps(body_dict).encode("utf-8"),
+            modelId=model_id,
+        )
+    except ClientError as e:
+        raise _provider_error(e) from e
+    for event in response["body"]:
+        if "chunk" in event:
+            text = _get_response_chunk_content(json.loads(event["chunk"]["bytes"]), model_id)
+            if text:
+                yield text
+
+
+async def ainvoke(prompt: str, model_id: str) -> str:
+    logging.info(f"Going to invoke Bedrock LLM model (async). Model id: {model_id}")
+    region = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
+    endpoint_url = os.getenv("BEDROCK_ENDPOINT_URL", f"https://bedrock-runtime.{region}.amazonaws.com")
+    client = get_async_client(endpoint_url, float(os.getenv("BEDROCK_READ_TIMEOUT", "60")))
+    body = json.dumps(_format_model_body(prompt, None, model_id)).encode("utf-8")
+    # Bedrock has no async SDK, so the request is signed with botocore and sent with httpx
+    url = f"{endpoint_url}/model/{quote(model_id, safe='')}/invoke"
+    aws_request = AWSRequest(method="POST", url=url, data=body,
+                             headers={"Content-Type": "application/json", "Accept": "application/json"})
+    SigV4Auth(_get_aws_credentials().get_frozen_credentials(), "bedrock", region).add_auth(aws_request)
+    response = await client.post(url, content=body, headers=dict(aws_request.headers.items()))
+    if response.status_code != 200:
+        raise ProviderError(f"Bedrock request failed for model '{model_id}'. "
+                            f"Status: {response.status_code}. Response: {response.text}", response.status_code)
+    return _get_response_content(response.json(), model_id)
+
+
+def warm_up():
+    get_bedrock_client()
+
+
+def get_bedrock_client(region: str = None):
+    if region is None:
+        region = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
+    connect_timeout = float(os.getenv("BEDROCK_CONNECT_TIMEOUT", "5"))
+    read_timeout = float(os.getenv("BEDROCK_READ_TIMEOUT", "60"))
+    max_pool_connections = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+    endpoint_url = os.getenv("BEDROCK_ENDPOINT_URL")
+    key = (region, connect_timeout, read_timeout, max_pool_connections, endpoint_url)
+    client = _bedrock_clients.get(key)
+    if client is None:
+        # boto3 clients are thread safe, but sessions are not - create them under the lock
+        with _bedrock_clients_lock:
+            client = _bedrock_clients.get(key)
+            if client is None:
+                logging.info(f"Creating Bedrock client. Region: {region}, connect timeout: {connect_timeout}, "
+                             f"read timeout: {read_timeout}, max pool connections: {max_pool_connections}")
+                client = Session().client(
+                    service_name="bedrock-runtime",
+                    region_name=region,
+                    endpoint_url=endpoint_url,
+                    config=Config(connect_timeout=connect_timeout,
+                                  read_timeout=read_timeout,
+                                  max_pool_connections=max_pool_connections,
+                                  tcp_keepalive=True),
+                )
+                _bedrock_clients[key] = client
+    return client
+
+
+def _provider_error(e: ClientError) -> ProviderError:
+    status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    if e.response.get("Error", {}).get("Code") == "ThrottlingException":
+        status = 429
+    return ProviderError(f"Bedrock request failed: {e}", status)
+
+
+def _get_aws_credentials():
+    global _aws_credentials
+    if _aws_credentials is None:
+        with _aws_credentials_lock:
+            if _aws_credentials is None:
+                credentials = Session().get_credentials()
+                if credentials is None:
+                    raise ValueError("No AWS credentials found")
+                _aws_credentials = credentials
+    return _aws_credentials
+
+
+def _format_model_body(
+    prompt: str, system_prompt: Optional[str], model_id: str
+) -> dict:
+    if system_prompt is None:
+        system_prompt = "You are a SQL generator helper"
+    if "claude" in model_id:
+        body = {
+            "anthropic_version": "bedrock-2023-05-31",
+            "system": system_prompt,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": _get_claude_content(prompt),
+                }
+            ],
+            "max_tokens": 2000,
+            "temperature": 0.0,
+        }
+    elif "jamba" in model_id:
+        body = {
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": prompt},
+            ],
+            "n": 1,
+        }
+    else:
+        raise ValueError(f"Unknown model_id: {model_id}")
+    return body
+
+
+def _get_claude_content(prompt: str):
+    if not isinstance(prompt, Prompt) or os.getenv("PROMPT_CACHING", "true").lower() != "true":
+        return prompt
+    # Everything up to the question is the same for the next questions on the dataset, so it is marked cacheable
+    *cached, question = prompt.parts
+    content = [{"type": "text", "text": part, "cache_control": {"type": "ephemeral"}} for part in cached if part]
+    content.append({"type": "text", "text": question})
+    return content
+
+
+def _get_response_content(response_json: dict, model_id: str) -> str:
+    if "claude" in model_id:
+        return response_json["content"][0]["text"]
+    elif "jamba" in model_id:
+        return response_json["choices"][0]["message"]["content"]
+    else:
+        raise ValueError(f"Unknown model_id: {model_id}")
+
+
+def _get_response_chunk_content(chunk_json: dict, model_id: str) -> Optional[str]:
+    if "claude" in model_id:
+        if chunk_json.get("type") == "content_block_delta":
+            return chunk_json["delta"].get("text")
+        return None
+    elif "jamba" in model_id:
+        choices = chunk_json.get("choices", [])
+        return choices[0].get("delta", {}).get("content") if choices else None
+    else:
+        raise ValueError(f"Unknown model_id: {model_id}")
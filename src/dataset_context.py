@@ -0,0 +1,135 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import NamedTuple, Optional, List, Tuple, Deque
+
+from llm_cache import fingerprint
+
+
+class DatasetContext(NamedTuple):
+    table_name: str
+    metadata: str
+    columns: List[dict]
+    sample_data: Optional[str] = None
+    distinct_values: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.metadata) + len(self.sample_data or "") + len(self.distinct_values or "")
+
+
+class Turn(NamedTuple):
+    question: str
+    sql: str
+
+
+def get_context_id(context: DatasetContext) -> str:
+    # Content based, so every client that registers the same dataset shares the entry
+    key = hashlib.sha256()
+    for part in [context.table_name or "", fingerprint(context.metadata), fingerprint(context.sample_data),
+                 fingerprint(context.distinct_values)]:
+        key.update(part.encode("utf-8"))
+        key.update(b"\0")
+    return key.hexdigest()
+
+
+class _Entry:
+    def __init__(self, context: DatasetContext):
+        self.context = context
+        self.size = context.size
+        self.used = time.time()
+        self.sessions: OrderedDict[str, Deque[Turn]] = OrderedDict()
+
+
+class DatasetContextStore:
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 3600, max_bytes: int = 100 * 1024 * 1024,
+                 max_turns: int = 5, max_sessions: int = 100):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._max_bytes = max_bytes
+        self._max_turns = max_turns
+        self._max_sessions = max_sessions
+        self._entries: OrderedDict[str, _Entry] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"registered": 0, "hits": 0, "misses": 0, "evictions": 0}
+
+    def register(self, context: DatasetContext) -> str:
+        context_id = get_context_id(context)
+        with self._lock:
+            self._stats["registered"] += 1
+            entry = self._get_entry(context_id)
+            if entry is None:
+                entry = self._entries[context_id] = _Entry(context)
+                self._size += entry.size
+                self._evict()
+        return context_id
+
+    def get(self, context_id: str) -> Optional[DatasetContext]:
+        with self._lock:
+            entry = self._get_entry(context_id)
+            self._stats["hits" if entry is not None else "misses"] += 1
+            return entry.context if entry is not None else None
+
+    def get_turns(self, context_id: str, session_id: Optional[str]) -> Tuple[Turn, ...]:
+        with self._lock:
+            entry = self._entries.get(context_id)
+            if entry is None or session_id is None or session_id not in entry.sessions:
+                return ()
+            return tuple(entry.sessions[session_id])
+
+    def add_turn(self, context_id: str, session_id: str, question: str, sql: str, replaces: Optional[str] = None):
+        with self._lock:
+            entry = self._get_entry(context_id)
+            if entry is None or self._max_turns <= 0:
+                return
+            turns = entry.sessions.pop(session_id, None)
+            if turns is None:
+                turns = deque(maxlen=self._max_turns)
+            if replaces is not None and turns and turns[-1].sql == replaces:
+                # A retry of an answer that failed on the client: the failed answer isn't part of the conversation
+                self._resize(entry, -_turn_size(turns.pop()))
+            if len(turns) == self._max_turns:
+                self._resize(entry, -_turn_size(turns[0]))
+            turns.append(Turn(question, sql))
+            entry.sessions[session_id] = turns
+            self._resize(entry, _turn_size(turns[-1]))
+            while len(entry.sessions) > self._max_sessions:
+                _, dropped = entry.sessions.popitem(last=False)
+                self._resize(entry, -sum(_turn_size(t) for t in dropped))
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "bytes": self._size}
+
+    def _get_entry(self, context_id: str) -> Optional[_Entry]:
+        entry = self._entries.get(context_id)
+        if entry is None:
+            return None
+        now = time.time()
+        # The TTL counts from the last use, a dataset stays while the conversation on it goes on
+        if now - entry.used > self._ttl_seconds:
+            self._remove(context_id)
+            return None
+        entry.used = now
+        self._entries.move_to_end(context_id)
+        return entry
+
+    def _resize(self, entry: _Entry, delta: int):
+        entry.size += delta
+        self._size += delta
+
+    def _evict(self):
+        # The newest entry stays even when it is larger than the limit on its own, it was just handed out
+        while len(self._entries) > 1 and (len(self._entries) > self._max_entries or self._size > self._max_bytes):
+            self._remove(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def _remove(self, context_id: str):
+        self._size -= self._entries.pop(context_id).size
+
+
+def _turn_size(turn: Turn) -> int:
+    return len(turn.question) + len(turn.sql)
@@ -0,0 +1,491 @@
+import csv
+import json
+import math
+import operator
+import os
+import random
+from collections import Counter
+from datetime import date, datetime
+from itertools import islice
+from typing import NamedTuple, List, Dict, Optional, Iterator, Tuple, Any, Sequence
+
+# Registers of the HyperLogLog sketches: 2^12 of them give about 1.6% standard error
+_HLL_BITS = 12
+_MASK_64 = (1 << 64) - 1
+_NUMERIC = ("BIGINT", "DOUBLE")
+# Types Parquet files declare, on top of the ones inferred for CSV and JSON lines
+_DECLARED_NUMERIC = ("TINYINT", "SMALLINT", "INTEGER", "HUGEINT", "UTINYINT", "USMALLINT", "UINTEGER", "UBIGINT",
+                     "FLOAT", "REAL", "DECIMAL")
+_BLOCK_SIZE = 1024 * 1024
+# The delimiters DuckDB's read_csv_auto detects, so the profile has the columns of the server dataset's view
+_CSV_DELIMITERS = ",;\t|"
+_SNIFF_SIZE = 64 * 1024
+_BOOLEANS = {"true": True, "false": False, "yes": True, "no": False}
+# Once a text column has a type, its next batches are first converted in one go with the type's function
+_CONVERTERS = {"BIGINT": int, "DOUBLE": float, "DATE": date.fromisoformat, "TIMESTAMP": datetime.fromisoformat}
+
+
+class DatasetProfile(NamedTuple):
+    # The same structures SUMMARIZE, ARRAY_AGG(DISTINCT ...) and LIMIT 5 give
+    metadata: List[dict]
+    sample_data: List[dict]
+    distinct_values: Dict[str, list]
+    rows: int
+    # With a sample_rate the rows and counts are estimates, and rare values may be missing
+    sampled: bool = False
+
+    def prompt_data(self) -> Tuple[str, str, Optional[str]]:
+        # metadata, sample_data and distinct_values in the format the UI and the validation tests send them
+        distinct_values = _rows_to_str([self.distinct_values]) if self.distinct_values else None
+        return _rows_to_str(self.metadata), _rows_to_str(self.sample_data), distinct_values
+
+
+def profile_dataset(path: str, file_format: Optional[str] = None, sample_rate: float = 1.0, sample_rows: int = 5,
+                    distinct_threshold: int = 20, batch_size: int = 10000, seed: Optional[int] = None
+                    ) -> DatasetProfile:
+    file_format = file_format or _get_format(path)
+    rng = random.Random(seed)
+    sampled = 0 < sample_rate < 1
+    if file_format == "parquet":
+        names, types, batches = _read_parquet(path, batch_size, sample_rate if sampled else 1.0)
+        sampled_fraction = sample_rate if sampled else 1.0
+    else:
+        lines, sampled_fraction = _read_lines(path, sample_rate if sampled else 1.0, rng, file_format == "csv")
+        if file_format == "csv":
+            names, batches = _parse_csv(lines, batch_size, _sniff_delimiter(path))
+        elif file_format == "jsonl":
+            names, batches = _parse_jsonl(lines, batch_size)
+        else:
+            raise ValueError(f"Unsupported file format: {file_format}")
+        types = [None] * len(names)
+    columns = [_ColumnProfile(i, name, column_type, distinct_threshold, file_format == "csv")
+               for i, (name, column_type) in enumerate(zip(names, types))]
+    reservoir = _Reservoir(max(sample_rows, 1024), rng)
+    rows = 0
+    for batch in batches:
+        rows += len(batch)
+        reservoir.add(batch)
+        for column, values in zip(columns, zip(*batch)):
+            column.add(values)
+    for column in columns:
+        column.add_quantile_sample(row[column.index] for row in reservoir.items)
+    scale = 1 / sampled_fraction if sampled_fraction < 1 else 1
+    sample = reservoir.items[:sample_rows] if len(reservoir.items) <= sample_rows else \
+        rng.sample(reservoir.items, sample_rows)
+    return DatasetProfile(
+        metadata=[column.summary(rows, scale) for column in columns],
+        sample_data=[{column.name: column.convert(value) for column, value in zip(columns, row)} for row in sample],
+        distinct_values={column.name: values for column in columns
+                         if (values := column.distinct_values()) is not None},
+        rows=round(rows * scale),
+        sampled=sampled_fraction < 1)
+
+
+class HyperLogLog:
+    def __init__(self, bits: int = _HLL_BITS):
+        self._bits = bits
+        self._registers = bytearray(1 << bits)
+
+    def add(self, values):
+        registers = self._registers
+        shift = 64 - self._bits
+        rest_mask = (1 << shift) - 1
+        for value in values:
+            # splitmix64 finalizer, inlined: hash() of small ints is the int itself, the sketch needs all the bits mixed
+            h = hash(value) & _MASK_64
+            h = (h ^ (h >> 30)) * 0xBF58476D1CE4E5B9 & _MASK_64
+            h = (h ^ (h >> 27)) * 0x94D049BB133111EB & _MASK_64
+            h ^= h >> 31
+            index = h >> shift
+            # The rank is the position of the first 1 bit in the rest of the hash
+            rank = shift - (h & rest_mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self) -> int:
+        m = len(self._registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self._registers)
+        zeros = self._registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            # Small cardinalities: linear counting is more accurate
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class _Reservoir:
+    # Algorithm L: a uniform sample of the rows that only draws random numbers for the rows it takes
+    def __init__(self, size: int, rng: random.Random):
+        self.items: List[Sequence] = []
+        self._size = size
+        self._rng = rng
+        self._seen = 0
+        self._w = 1.0
+        self._next: Optional[int] = None
+
+    def add(self, rows: List[Sequence]):
+        start = self._seen
+        self._seen += len(rows)
+        i = 0
+        while len(self.items) < self._size and i < len(rows):
+            self.items.append(rows[i])
+            i += 1
+        if len(self.items) < self._size:
+            return
+        if self._next is None:
+            self._w = math.exp(math.log(self._random()) / self._size)
+            self._next = start + i - 1 + self._skip()
+        while self._next < self._seen:
+            self.items[self._rng.randrange(self._size)] = rows[self._next - start]
+            self._w *= math.exp(math.log(self._random()) / self._size)
+            self._next += self._skip()
+
+    def _skip(self) -> int:
+        return math.floor(math.log(self._random()) / math.log(1 - self._w)) + 1 if self._w < 1 else 1
+
+    def _random(self) -> float:
+        # log(0) is undefined
+        return self._rng.random() or 1e-300
+
+
+class _ColumnProfile:
+    def __init__(self, index: int, name: str, column_type: Optional[str], distinct_threshold: int,
+                 text: bool = False):
+        self.index = index
+        self.name = name
+        # Declared by the file (Parquet), or inferred from the values (CSV and JSON lines)
+        self.declared = column_type is not None
+        self.type = column_type
+        # All the values are strings (CSV)
+        self._text = text
+        self._distinct_threshold = distinct_threshold
+        self._exact: Optional[set] = set()
+        self._exact_limit = max(distinct_threshold, 1000)
+        self._hll: Optional[HyperLogLog] = None
+        self.count = 0
+        self.nulls = 0
+        self._min = self._max = None
+        self._text_min = self._text_max = None
+        self._n = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._quantiles: Dict[str, Any] = {}
+
+    def add(self, values: Sequence):
+        counts = Counter(values)
+        # An empty CSV field is NULL, like in read_csv_auto
+        self.nulls += counts.pop(None, 0) + (counts.pop("", 0) if not self.declared else 0)
+        self.count += len(values)
+        if not counts:
+            return
+        if self._exact is not None:
+            self._exact.update(counts)
+            if len(self._exact) > self._exact_limit:
+                # Too many values to keep them all, from now on they are only counted
+                self._hll = HyperLogLog()
+                self._hll.add(self._exact)
+                self._exact = None
+        else:
+            self._hll.add(counts)
+        keys = list(counts)
+        text_values = keys if self._text else [v if isinstance(v, str) else str(v) for v in keys]
+        batch_min, batch_max = min(text_values), max(text_values)
+        self._text_min = batch_min if self._text_min is None else min(self._text_min, batch_min)
+        self._text_max = batch_max if self._text_max is None else max(self._text_max, batch_max)
+        if self.type == "VARCHAR":
+            return
+        typed = self._convert_batch(keys)
+        if typed is None:
+            return
+        batch_min, batch_max = min(typed), max(typed)
+        self._min = batch_min if self._min is None else min(self._min, batch_min)
+        self._max = batch_max if self._max is None else max(self._max, batch_max)
+        if self.numeric:
+            self._add_moments(typed, [counts[k] for k in keys])
+
+    def _convert_batch(self, keys: List[Any]) -> Optional[List[Any]]:
+        # The typed values in the order of the keys, None once the column is VARCHAR
+        if self.declared:
+            return keys
+        if self._text and self.type in _CONVERTERS:
+            try:
+                return list(map(_CONVERTERS[self.type], keys))
+            except ValueError:
+                # Some value has another type, the column may have to be widened
+                pass
+        typed = []
+        for value in keys:
+            converted, value_type = self._parse(value)
+            self._widen(value_type)
+            if self.type == "VARCHAR":
+                return None
+            typed.append(converted)
+        if self.type == "DOUBLE":
+            typed = list(map(float, typed))
+        elif self.type == "TIMESTAMP":
+            typed = list(map(_to_datetime, typed))
+        return typed
+
+    def _parse(self, value: Any) -> Tuple[Any, str]:
+        if self.declared:
+            return value, self.type
+        if isinstance(value, bool):
+            return value, "BOOLEAN"
+        if isinstance(value, int):
+            return value, "BIGINT"
+        if isinstance(value, float):
+            return value, "DOUBLE"
+        if not isinstance(value, str):
+            return value, "VARCHAR"
+        return _parse_text(value)
+
+    def _widen(self, value_type: str):
+        if self.type is None or self.type == value_type:
+            self.type = value_type
+        elif {self.type, value_type} == set(_NUMERIC):
+            self.type = "DOUBLE"
+        elif {self.type, value_type} == {"DATE", "TIMESTAMP"}:
+            self.type = "TIMESTAMP"
+            self._min, self._max = _to_datetime(self._min), _to_datetime(self._max)
+        else:
+            self.type = "VARCHAR"
+
+    def _add_moments(self, typed: List[Any], counts: List[int]):
+        # Chan's parallel update: the batch mean and squared deviations are merged into the running ones
+        n = sum(counts)
+        mean = math.fsum(map(operator.mul, typed, counts)) / n
+        m2 = sum((float(v) - mean) ** 2 * c for v, c in zip(typed, counts))
+        total = self._n + n
+        delta = mean - self._mean
+        self._m2 += m2 + delta * delta * self._n * n / total
+        self._mean += delta * n / total
+        self._n = total
+
+    @property
+    def numeric(self) -> bool:
+        return self.type in _NUMERIC or self.declared and self.type.startswith(_DECLARED_NUMERIC)
+
+    def add_quantile_sample(self, values: Iterator[Any]):
+        if not self.numeric:
+            return
+        converted = sorted(v for v in map(self.convert, values) if v is not None and not isinstance(v, str))
+        if converted:
+            for name, q in (("q25", 0.25), ("q50", 0.5), ("q75", 0.75)):
+                self._quantiles[name] = converted[min(len(converted) - 1, int(len(converted) * q))]
+
+    def convert(self, value: Any) -> Any:
+        if value is None or value == "" and not self.declared:
+            return None
+        if self.declared or not isinstance(value, str) or self.type == "VARCHAR":
+            return value
+        converted, value_type = _parse_text(value)
+        if self.type == "DOUBLE" and value_type == "BIGINT":
+            return float(converted)
+        if self.type == "TIMESTAMP" and value_type == "DATE":
+            return _to_datetime(converted)
+        return converted if value_type == self.type else value
+
+    def approx_unique(self, scale: float = 1) -> int:
+        unique = len(self._exact) if self._exact is not None else self._hll.count()
+        values = self.count - self.nulls
+        if scale > 1 and unique >= 0.95 * values:
+            # Sampled: the values of an id column keep growing with the rows, for the other columns the sample
+            # count is kept, the values missing from it are too rare to guess
+            unique = round(unique * scale)
+        return unique
+
+    def distinct_values(self) -> Optional[list]:
+        if self._exact is None or len(self._exact) > self._distinct_threshold or not self._exact:
+            return None
+        values = {self.convert(v) for v in self._exact}
+        values.discard(None)
+        try:
+            return sorted(values)
+        except TypeError:
+            return sorted(values, key=str)
+
+    def summary(self, rows: int, scale: float = 1) -> dict:
+        varchar = self.type == "VARCHAR" or self.type is None
+        numeric = self.numeric and self._n > 0
+        total = max(self.count, 1)
+        return {
+            "column_name": self.name,
+            "column_type": self.type or "VARCHAR",
+            "min": _to_text(self._text_min if varchar else self._min),
+            "max": _to_text(self._text_max if varchar else self._max),
+            "approx_unique": self.approx_unique(scale),
+            "avg": str(self._mean) if numeric else None,
+            "std": str(math.sqrt(self._m2 / (self._n - 1))) if numeric and self._n > 1 else None,
+            "q25": _to_text(self._quantiles.get("q25")),
+            "q50": _to_text(self._quantiles.get("q50")),
+            "q75": _to_text(self._quantiles.get("q75")),
+            "count": round(rows * scale),
+            "null_percentage": round(self.nulls * 100 / total, 2),
+        }
+
+
+def _parse_text(value: str) -> Tuple[Any, str]:
+    try:
+        return int(value), "BIGINT"
+    except ValueError:
+        pass
+    try:
+        return float(value), "DOUBLE"
+    except ValueError:
+        pass
+    lower = value.lower()
+    # The same words read_csv_auto takes for booleans
+    if lower in _BOOLEANS:
+        return _BOOLEANS[lower], "BOOLEAN"
+    if len(value) == 10:
+        try:
+            return date.fromisoformat(value), "DATE"
+        except ValueError:
+            pass
+    elif 10 < len(value) <= 32 and value[4] == "-":
+        try:
+            return datetime.fromisoformat(value), "TIMESTAMP"
+        except ValueError:
+            pass
+    return value, "VARCHAR"
+
+
+def _to_datetime(value: Any) -> Any:
+    return datetime(value.year, value.month, value.day) if type(value) is date else value
+
+
+def _to_text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    # SUMMARIZE writes booleans in lower case
+    return str(value).lower() if isinstance(value, bool) else str(value)
+
+
+def _get_format(path: str) -> str:
+    extension = os.path.splitext(path)[1].lower()
+    if extension in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if extension == ".parquet":
+        return "parquet"
+    return "csv"
+
+
+def _read_lines(path: str, sample_rate: float, rng: random.Random, header: bool) -> Tuple[Iterator[str], float]:
+    # Sampling reads random blocks of the file, so a large file costs sample_rate of a full read
+    size = os.path.getsize(path)
+    blocks = size // _BLOCK_SIZE
+    count = math.ceil(blocks * sample_rate)
+    if sample_rate >= 1 or count >= blocks:
+        return _read_all_lines(path), 1.0
+    offsets = sorted(rng.sample(range(blocks), count))
+    return _read_blocks(path, [o * _BLOCK_SIZE for o in offsets], header), count * _BLOCK_SIZE / size
+
+
+def _read_all_lines(path: str) -> Iterator[str]:
+    with open(path, encoding="utf-8", newline="") as f:
+        yield from f
+
+
+def _read_blocks(path: str, offsets: List[int], header: bool) -> Iterator[str]:
+    with open(path, "rb") as f:
+        if header:
+            yield f.readline().decode("utf-8")
+        for offset in offsets:
+            f.seek(offset)
+            if offset > 0:
+                # The first line of a block is usually cut, it belongs to the block before
+                f.readline()
+            while f.tell() < offset + _BLOCK_SIZE:
+                line = f.readline()
+                if not line:
+                    break
+                yield line.decode("utf-8", errors="replace")
+
+
+def _sniff_delimiter(path: str) -> str:
+    with open(path, encoding="utf-8", errors="replace", newline="") as f:
+        sample = f.read(_SNIFF_SIZE)
+    if len(sample) == _SNIFF_SIZE and "\n" in sample:
+        # The last line is cut, it would look like it has fewer columns
+        sample = sample[:sample.rindex("\n")]
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=_CSV_DELIMITERS).delimiter
+    except csv.Error:
+        return ","
+
+
+def _parse_csv(lines: Iterator[str], batch_size: int, delimiter: str = ","
+               ) -> Tuple[List[str], Iterator[List[list]]]:
+    reader = csv.reader(lines, delimiter=delimiter)
+    names = next(reader, [])
+
+    def _batches() -> Iterator[List[list]]:
+        width = len(names)
+        while batch := list(islice(reader, batch_size)):
+            # Rows cut by the sampling, or broken in the file, don't have all the columns
+            yield [row for row in batch if len(row) == width]
+
+    return names, _batches()
+
+
+def _parse_jsonl(lines: Iterator[str], batch_size: int) -> Tuple[List[str], Iterator[List[list]]]:
+    records = (record for record in (_parse_json_line(line) for line in lines) if record is not None)
+    first = next(records, None)
+    names = list(first) if first is not None else []
+
+    def _batches() -> Iterator[List[list]]:
+        pending = [first] if first is not None else []
+        while True:
+            pending += list(islice(records, batch_size - len(pending)))
+            if not pending:
+                return
+            yield [[_hashable(record.get(name)) for name in names] for record in pending]
+            pending = []
+
+    return names, _batches()
+
+
+def _parse_json_line(line: str) -> Optional[dict]:
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return None
+    return record if isinstance(record, dict) else None
+
+
+def _hashable(value: Any) -> Any:
+    return json.dumps(value, sort_keys=True) if isinstance(value, (dict, list)) else value
+
+
+def _read_parquet(path: str, batch_size: int, sample_rate: float
+                  ) -> Tuple[List[str], List[str], Iterator[List[tuple]]]:
+    import duckdb
+    con = duckdb.connect()
+    # System sampling picks whole row groups, so the rest of the file isn't read
+    sample = f" USING SAMPLE {sample_rate * 100}% (system)" if sample_rate < 1 else ""
+    described = con.execute("DESCRIBE SELECT * FROM read_parquet(?)", [path]).fetchall()
+    names = [row[0] for row in described]
+    types = [row[1] for row in described]
+    # Lists, structs and maps are profiled by their text
+    nested = [i for i, t in enumerate(types) if t.endswith("]") or t.startswith(("STRUCT", "MAP"))]
+    for i in nested:
+        types[i] = "VARCHAR"
+
+    def _batches() -> Iterator[List[tuple]]:
+        try:
+            result = con.execute(f"SELECT * FROM read_parquet(?){sample}", [path])
+            while batch := result.fetchmany(batch_size):
+                if nested:
+                    batch = [tuple(str(v) if i in nested and v is not None else v for i, v in enumerate(row))
+                             for row in batch]
+                yield batch
+        finally:
+            con.close()
+
+    return names, types, _batches()
+
+
+def _rows_to_str(rows: List[dict]) -> str:
+    return "".join(str(row) + "\n" for row in rows)
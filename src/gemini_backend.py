@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import threading
+from typing import Dict, Tuple, Iterator
+
+from async_llm import get_async_client
+from http_pool import HTTPConnectionPool
+from utils import ProviderError
+
+_gemini_pools: Dict[Tuple, HTTPConnectionPool] = {}
+_gemini_pools_lock = threading.Lock()
+
+
+def invoke(prompt: str, model_id: str) -> str:
+    api_key = os.environ["GEMINI_API_KEY"]
+    headers = {"Content-Type": "application/json"}
+    data = {
+        "contents": [{"parts": [{"text": prompt}]}]
+    }
+    endpoint = f"/v1beta/models/{model_id}:generateContent?key=" + api_key
+    status, body = get_gemini_pool().request("POST", endpoint, body=json.dumps(data).encode("utf-8"),
+                                             headers=headers)
+    return _get_gemini_response_content(status, body.decode(), model_id)
+
+
+def invoke_stream(prompt: str, model_id: str) -> Iterator[str]:
+    api_key = os.environ["GEMINI_API_KEY"]
+    headers = {"Content-Type": "application/json"}
+    data = {
+        "contents": [{"parts": [{"text": prompt}]}]
+    }
+    endpoint = f"/v1beta/models/{model_id}:streamGenerateContent?alt=sse&key=" + api_key
+    with get_gemini_pool().stream("POST", endpoint, body=json.dumps(data).encode("utf-8"),
+                                  headers=headers) as response:
+        if response.status != 200:
+            raise ProviderError(f"Gemini streaming request failed for model '{model_id}'. "
+                                f"Status: {response.status}. Response: {response.read().decode()}", response.status)
+        for line in response:
+            if not line.startswith(b"data:"):
+                continue
+            json_data = json.loads(line[5:])
+            for part in json_data["candidates"][0].get("content", {}).get("parts", []):
+                if part.get("text"):
+                    yield part["text"]
+
+
+async def ainvoke(prompt: str, model_id: str) -> str:
+    api_key = os.environ["GEMINI_API_KEY"]
+    data = {
+        "contents": [{"parts": [{"text": prompt}]}]
+    }
+    client = get_async_client(os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com"),
+                              float(os.getenv("GEMINI_TIMEOUT", "60")))
+    response = await client.post(f"/v1beta/models/{model_id}:generateContent", params={"key": api_key}, json=data)
+    return _get_gemini_response_content(response.status_code, response.text, model_id)
+
+
+def warm_up():
+    get_gemini_pool()
+
+
+def _get_gemini_response_content(status: int, result: str, model_id: str) -> str:
+    if status == 404:
+        raise ProviderError(
+            f"Model '{model_id}' not found or not supported for generateContent. "
+            "Check your model_id or use a supported Gemini model (e.g., 'gemini-2.0-pro', 'gemini-2.0-flash'). "
+            f"Response: {result}", status
+        )
+    if status != 200:
+        raise ProviderError(f"Gemini request failed for model '{model_id}'. Status: {status}. Response: {result}",
+                            status)
+    json_data = json.loads(result)
+    return json_data["candidates"][0]["content"]["parts"][0]["text"]
+
+
+def get_gemini_pool() -> HTTPConnectionPool:
+    url = os.getenv("GEMINI_API_URL", "https://generativelanguage.googleapis.com")
+    max_connections = int(os.getenv("GEMINI_MAX_CONNECTIONS", "10"))
+    timeout = float(os.getenv("GEMINI_TIMEOUT", "60"))
+    key = (url, max_connections, timeout)
+    pool = _gemini_pools.get(key)
+    if pool is None:
+        with _gemini_pools_lock:
+            pool = _gemini_pools.get(key)
+            if pool is None:
+                logging.info(f"Creating Gemini connection pool. URL: {url}, max connections: {max_connections}, "
+                             f"timeout: {timeout}")
+                pool = HTTPConnectionPool(url, max_connections=max_connections, timeout=timeout)
+                _gemini_pools[key] = pool
+    return pool
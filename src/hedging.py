@@ -0,0 +1,211 @@
+import asyncio
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Awaitable, Dict, List, Tuple, Optional, Deque
+
+_MIN_SAMPLES = 20
+# The model ids come from the clients, only so many are tracked
+_MAX_MODELS = 100
+
+_latencies: Dict[str, Deque[float]] = {}
+_stats = {"requests": 0, "hedged": 0, "wins": {}, "failed": 0}
+_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def is_hedging_enabled() -> bool:
+    return get_hedge_mode() != "off"
+
+
+def get_hedge_mode() -> str:
+    return os.environ.get("LLM_HEDGE_MODE", "off").lower()
+
+
+def hedging_stats() -> dict:
+    with _lock:
+        stats = {**_stats, "wins": dict(_stats["wins"])}
+        model_ids = list(_latencies)
+    return {**stats, "hedge_delays": {model_id or "default": get_hedge_delay(model_id) for model_id in model_ids}}
+
+
+def get_hedge_delay(model_id: Optional[str]) -> float:
+    # The primary gets until the configured percentile of its recent latencies, a fixed delay until there are enough
+    with _lock:
+        samples = sorted(_latencies.get(model_id or "", ()))
+    if len(samples) < _MIN_SAMPLES:
+        return float(os.environ.get("LLM_HEDGE_DELAY", 5))
+    percentile = float(os.environ.get("LLM_HEDGE_PERCENTILE", 95))
+    return samples[min(len(samples) - 1, math.ceil(len(samples) * percentile / 100) - 1)]
+
+
+def invoke_hedged(invoke: Callable[[str, Optional[str]], str], prompt: str, model_id: Optional[str],
+                  accept: Callable[[str], bool]) -> str:
+    candidates = _get_candidates(model_id)
+    executor = _get_executor()
+    pending: Dict[Future, Tuple[str, Optional[str]]] = {}
+
+    def _start(path: str, candidate: Optional[str]):
+        # The candidates run in the request's context, so their spans land in its trace
+        context = contextvars.copy_context()
+        pending[executor.submit(context.run, _timed, invoke, prompt, candidate)] = (path, candidate)
+
+    hedge_at = _start_candidates(candidates, _start)
+    answers: List[str] = []
+    errors: List[Exception] = []
+    try:
+        while pending:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                path, candidate = pending.pop(future)
+                try:
+                    answer = future.result()
+                except Exception as e:
+                    logging.info(f"Hedged candidate failed. Path: {path}, model id: {candidate}, error: {e}")
+                    errors.append(e)
+                    continue
+                if _accepts(accept, answer):
+                    _record_win(path, candidate)
+                    return answer
+                answers.append(answer)
+            if hedge_at is not None and (not done or not pending):
+                # Either the primary is too slow or its answer was no good - the hedge goes now
+                hedge_at = None
+                _start_hedge(candidates, _start)
+    finally:
+        # Calls already sent can't be stopped, their answers are dropped
+        for future in pending:
+            future.cancel()
+    return _no_winner(answers, errors)
+
+
+async def ainvoke_hedged(ainvoke: Callable[[str, Optional[str]], Awaitable[str]], prompt: str,
+                         model_id: Optional[str], accept: Callable[[str], bool]) -> str:
+    candidates = _get_candidates(model_id)
+    pending: Dict[asyncio.Task, Tuple[str, Optional[str]]] = {}
+
+    def _start(path: str, candidate: Optional[str]):
+        pending[asyncio.ensure_future(_atimed(ainvoke, prompt, candidate))] = (path, candidate)
+
+    hedge_at = _start_candidates(candidates, _start)
+    answers: List[str] = []
+    errors: List[Exception] = []
+    try:
+        while pending:
+            timeout = None if hedge_at is None else max(0.0, hedge_at - time.monotonic())
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                path, candidate = pending.pop(task)
+                try:
+                    answer = task.result()
+                except Exception as e:
+                    logging.info(f"Hedged candidate failed. Path: {path}, model id: {candidate}, error: {e}")
+                    errors.append(e)
+                    continue
+                # The check runs fix_sql and the validation, which would hold up the event loop
+                if await asyncio.to_thread(_accepts, accept, answer):
+                    _record_win(path, candidate)
+                    return answer
+                answers.append(answer)
+            if hedge_at is not None and (not done or not pending):
+                hedge_at = None
+                _start_hedge(candidates, _start)
+    finally:
+        for task in pending:
+            task.cancel()
+    return _no_winner(answers, errors)
+
+
+def _get_candidates(model_id: Optional[str]) -> List[Optional[str]]:
+    # The primary first, then the models to hedge with. Without any, the hedge goes to the primary model again
+    hedge_model_ids = [m.strip() for m in os.environ.get("LLM_HEDGE_MODEL_IDS", "").split(",") if m.strip()]
+    return [model_id] + (hedge_model_ids or [model_id])
+
+
+def _start_candidates(candidates: List[Optional[str]], start: Callable[[str, Optional[str]], None]
+                      ) -> Optional[float]:
+    with _lock:
+        _stats["requests"] += 1
+    if get_hedge_mode() == "race":
+        count = max(1, int(os.environ.get("LLM_HEDGE_CANDIDATES", 2)))
+        start("primary", candidates[0])
+        for i in range(1, count):
+            start(f"candidate-{i}", candidates[1 + (i - 1) % (len(candidates) - 1)])
+        if count > 1:
+            with _lock:
+                _stats["hedged"] += 1
+        return None
+    start("primary", candidates[0])
+    return time.monotonic() + get_hedge_delay(candidates[0])
+
+
+def _start_hedge(candidates: List[Optional[str]], start: Callable[[str, Optional[str]], None]):
+    logging.info(f"Hedging the LLM request. Model id: {candidates[1]}")
+    with _lock:
+        _stats["hedged"] += 1
+    start("hedge", candidates[1])
+
+
+def _accepts(accept: Callable[[str], bool], answer: str) -> bool:
+    try:
+        return accept(answer)
+    except Exception as e:
+        logging.info(f"Hedged candidate check failed: {e}")
+        return False
+
+
+def _record_win(path: str, model_id: Optional[str]):
+    key = f"{path}:{model_id or 'default'}"
+    with _lock:
+        _stats["wins"][key] = _stats["wins"].get(key, 0) + 1
+
+
+def _no_winner(answers: List[str], errors: List[Exception]) -> str:
+    with _lock:
+        _stats["failed"] += 1
+    # No candidate passed the check - the first answer goes through the usual repair attempts
+    if answers:
+        return answers[0]
+    raise errors[0]
+
+
+def _timed(invoke: Callable[[str, Optional[str]], str], prompt: str, model_id: Optional[str]) -> str:
+    start = time.monotonic()
+    answer = invoke(prompt, model_id)
+    _record_latency(model_id, time.monotonic() - start)
+    return answer
+
+
+async def _atimed(ainvoke: Callable[[str, Optional[str]], Awaitable[str]], prompt: str,
+                  model_id: Optional[str]) -> str:
+    start = time.monotonic()
+    answer = await ainvoke(prompt, model_id)
+    _record_latency(model_id, time.monotonic() - start)
+    return answer
+
+
+def _record_latency(model_id: Optional[str], latency: float):
+    with _lock:
+        latencies = _latencies.get(model_id or "")
+        if latencies is None:
+            if len(_latencies) >= _MAX_MODELS:
+                return
+            latencies = _latencies[model_id or ""] = deque(maxlen=100)
+        latencies.append(latency)
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                max_workers = int(os.environ.get("LLM_HEDGE_MAX_WORKERS", 32))
+                logging.info(f"Creating hedging executor. Max workers: {max_workers}")
+                _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-hedge")
+    return _executor
@@ -0,0 +1,123 @@
+import http.client
+import logging
+import select
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, Tuple, List, Iterator
+from urllib.parse import urlsplit
+
+from tracing import span
+
+_RETRYABLE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                     ConnectionResetError, ConnectionAbortedError, BrokenPipeError)
+
+
+class HTTPConnectionPool:
+    def __init__(self, url: str, max_connections: int = 10, timeout: float = 60,
+                 max_idle_seconds: float = 60):
+        parts = urlsplit(url)
+        self._connection_class = http.client.HTTPSConnection if parts.scheme == "https" \
+            else http.client.HTTPConnection
+        self._host = parts.hostname
+        self._port = parts.port
+        self._timeout = timeout
+        self._max_idle_seconds = max_idle_seconds
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[http.client.HTTPConnection, float]] = []
+        self.connections_created = 0
+
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None, timeout: Optional[float] = None) -> Tuple[int, bytes]:
+        with self.stream(method, path, body, headers, timeout) as response:
+            return response.status, response.read()
+
+    @contextmanager
+    def stream(self, method: str, path: str, body: Optional[bytes] = None,
+               headers: Optional[Dict[str, str]] = None,
+               timeout: Optional[float] = None) -> Iterator[http.client.HTTPResponse]:
+        timeout = self._timeout if timeout is None else timeout
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError(f"Timed out waiting for a free connection to {self._host}")
+        try:
+            conn, reused = self._get_connection(timeout)
+            try:
+                try:
+                    response = self._send(conn, method, path, body, headers)
+                except _RETRYABLE_ERRORS as e:
+                    conn.close()
+                    if not reused:
+                        raise
+                    # The server closed a keep-alive connection we had in the pool - retry once on a fresh one
+                    logging.info(f"Pooled connection to {self._host} was reset ({e!r}). Retrying on a new connection")
+                    conn = self._new_connection(timeout)
+                    response = self._send(conn, method, path, body, headers)
+            except BaseException:
+                # The connection is in an unknown state, it doesn't go back to the pool or stay open
+                conn.close()
+                raise
+            try:
+                yield response
+            except BaseException:
+                conn.close()
+                raise
+            # A connection can only go back to the pool once its response was read to the end
+            self._release(conn, reusable=response.isclosed() and not response.will_close)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+    @staticmethod
+    def _send(conn: http.client.HTTPConnection, method: str, path: str, body: Optional[bytes],
+              headers: Optional[Dict[str, str]]) -> http.client.HTTPResponse:
+        if conn.sock is None:
+            # Connected here rather than in request() so a trace shows the connect time on its own
+            with span("connect", host=conn.host):
+                conn.connect()
+        with span("ttfb"):
+            conn.request(method, path, body=body, headers=headers or {})
+            return conn.getresponse()
+
+    def _get_connection(self, timeout: float) -> Tuple[http.client.HTTPConnection, bool]:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, last_used = self._idle.pop()
+            if time.monotonic() - last_used > self._max_idle_seconds or _is_stale(conn):
+                conn.close()
+                continue
+            conn.timeout = timeout
+            conn.sock.settimeout(timeout)
+            return conn, True
+        return self._new_connection(timeout), False
+
+    def _new_connection(self, timeout: float) -> http.client.HTTPConnection:
+        with self._lock:
+            self.connections_created += 1
+        return self._connection_class(self._host, self._port, timeout=timeout)
+
+    def _release(self, conn: http.client.HTTPConnection, reusable: bool):
+        if not reusable or conn.sock is None:
+            conn.close()
+            return
+        with self._lock:
+            self._idle.append((conn, time.monotonic()))
+
+
+def _is_stale(conn: http.client.HTTPConnection) -> bool:
+    if conn.sock is None:
+        return True
+    try:
+        # An idle keep-alive socket must not be readable. If it is, the server either closed it (EOF)
+        # or sent unexpected data - either way it can't be reused
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+        return len(readable) > 0
+    except (OSError, ValueError):
+        return True
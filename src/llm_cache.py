@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Dict, Callable, Tuple, Awaitable
+
+_PRUNE_EVERY = 100
+
+
+def get_cache_key(table_name: str, question: str, metadata: str, sample_data: Optional[str],
+                  distinct_values: Optional[str], hint: Optional[str], model_id: Optional[str]) -> str:
+    key = hashlib.sha256()
+    for part in [table_name or "", _normalize_question(question), fingerprint(metadata),
+                 fingerprint(sample_data), fingerprint(distinct_values), hint or "", model_id or ""]:
+        key.update(part.encode("utf-8"))
+        key.update(b"\0")
+    return key.hexdigest()
+
+
+def fingerprint(data: Optional[str]) -> str:
+    if data is None or data == "":
+        return ""
+    try:
+        # Same content sent with different key order or whitespace should get the same fingerprint
+        data = json.dumps(json.loads(data), sort_keys=True, separators=(",", ":"))
+    except ValueError:
+        data = data.strip()
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def _normalize_question(question: Optional[str]) -> str:
+    return re.sub(r"\s+", " ", question or "").strip().lower()
+
+
+class _LeaderCancelled(Exception):
+    pass
+
+
+class _InFlight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Optional[str] = None
+        self.error: Optional[BaseException] = None
+
+
+class LLMResponseCache:
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 3600, max_bytes: int = 50 * 1024 * 1024,
+                 db_file: Optional[str] = None, max_disk_entries: int = 100000):
+        self._max_entries = max_entries
+        self._ttl_seconds = ttl_seconds
+        self._max_bytes = max_bytes
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._in_flight: Dict[str, _InFlight] = {}
+        self._async_in_flight: Dict[str, asyncio.Future] = {}
+        self._stats = {"hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0, "evictions": 0}
+        self._db_file = db_file
+        self._max_disk_entries = max_disk_entries
+        self._puts = 0
+        # A connection by thread: the disk tier is read and written outside the lock of the memory tier
+        self._local = threading.local()
+        if db_file:
+            db = self._get_db()
+            db.execute("CREATE TABLE IF NOT EXISTS llm_cache "
+                       "(key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache (created)")
+            self._prune_disk(db)
+            logging.info(f"LLM cache persisted to: {db_file}")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            value = self._get_from_memory(key)
+            if value is not None:
+                self._stats["hits"] += 1
+                return value
+        value = self._get_from_disk(key)
+        with self._lock:
+            if value is not None:
+                self._stats["disk_hits"] += 1
+                self._put_in_memory(key, value[0], value[1])
+                return value[0]
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, value: str):
+        created = time.time()
+        with self._lock:
+            self._put_in_memory(key, value, created)
+            self._puts += 1
+            prune = self._puts % _PRUNE_EVERY == 0
+        if self._db_file:
+            # The answer is in memory already, a failed disk write only loses the copy that survives restarts
+            try:
+                db = self._get_db()
+                db.execute("INSERT OR REPLACE INTO llm_cache (key, value, created) VALUES (?, ?, ?)",
+                           (key, value, created))
+                db.commit()
+                if prune:
+                    self._prune_disk(db)
+            except sqlite3.Error as e:
+                logging.warning(f"Could not write the LLM cache to disk: {e}")
+
+    def get_or_invoke(self, key: str, invoke: Callable[[], str]) -> str:
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            in_flight = self._in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = self._in_flight[key] = _InFlight()
+            else:
+                self._stats["coalesced"] += 1
+        if not leader:
+            in_flight.done.wait()
+            if in_flight.error is not None:
+                raise in_flight.error
+            return in_flight.result
+        try:
+            in_flight.result = invoke()
+            self.put(key, in_flight.result)
+            return in_flight.result
+        except BaseException as e:
+            in_flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            in_flight.done.set()
+
+    async def aget_or_invoke(self, key: str, invoke: Callable[[], Awaitable[str]]) -> str:
+        value = await self._run_blocking(self.get, key)
+        if value is not None:
+            return value
+        # Only touched from the event loop thread, so no lock is needed around the in-flight futures
+        future = self._async_in_flight.get(key)
+        if future is not None:
+            with self._lock:
+                self._stats["coalesced"] += 1
+        while future is not None:
+            try:
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                # The request invoking the LLM was cancelled, not this one: the first waiter invokes it again
+                future = self._async_in_flight.get(key)
+        future = self._async_in_flight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await invoke()
+            future.set_result(value)
+        except asyncio.CancelledError:
+            _set_exception(future, _LeaderCancelled())
+            raise
+        except Exception as e:
+            _set_exception(future, e)
+            raise
+        finally:
+            del self._async_in_flight[key]
+        await self._run_blocking(self.put, key, value)
+        return value
+
+    async def _run_blocking(self, func: Callable, *args):
+        # The disk tier waits for SQLite locks held by other workers, off the event loop. The memory tier doesn't
+        if not self._db_file:
+            return func(*args)
+        return await asyncio.to_thread(func, *args)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["disk_hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_rate": (self._stats["hits"] + self._stats["disk_hits"]) / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._size,
+                "in_flight": len(self._in_flight) + len(self._async_in_flight),
+            }
+
+    def _get_from_memory(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[1] > self._ttl_seconds:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _get_from_disk(self, key: str) -> Optional[Tuple[str, float]]:
+        if not self._db_file:
+            return None
+        try:
+            row = self._get_db().execute("SELECT value, created FROM llm_cache WHERE key = ? AND created >= ?",
+                                         (key, time.time() - self._ttl_seconds)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not read the LLM cache from disk: {e}")
+            return None
+        return (row[0], row[1]) if row else None
+
+    def _get_db(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self._db_file)
+        return db
+
+    def _prune_disk(self, db: sqlite3.Connection):
+        db.execute("DELETE FROM llm_cache WHERE created < ?", (time.time() - self._ttl_seconds,))
+        db.execute("DELETE FROM llm_cache WHERE key NOT IN "
+                   "(SELECT key FROM llm_cache ORDER BY created DESC LIMIT ?)", (self._max_disk_entries,))
+        db.commit()
+
+    def _put_in_memory(self, key: str, value: str, created: float):
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (value, created)
+        self._size += len(key) + len(value)
+        while self._entries and (len(self._entries) > self._max_entries or self._size > self._max_bytes):
+            self._remove(next(iter(self._entries)))
+            self._stats["evictions"] += 1
+
+    def _remove(self, key: str):
+        value, _ = self._entries.pop(key)
+        self._size -= len(key) + len(value)
+
+
+def _set_exception(future: asyncio.Future, e: BaseException):
+    future.set_exception(e)
+    # Mark the exception as retrieved, there may be no one else waiting for it
+    future.exception()
@@ -0,0 +1,229 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional, Dict, List, Iterator, Deque, Tuple
+
+from async_llm import ainvoke_llm as _ainvoke_provider
+from tracing import span
+from utils import _get_default_model_id, get_provider, invoke_llm as _invoke_provider, \
+    invoke_llm_stream as _invoke_provider_stream, ProviderError
+
+_CLOSED = "closed"
+_OPEN = "open"
+_HALF_OPEN = "half-open"
+# The model ids come from the clients, only so many are tracked
+_MAX_MODELS = 100
+
+
+class _ModelHealth:
+    def __init__(self, window: int):
+        # (latency, ok) of the recent calls
+        self.calls: Deque[Tuple[float, bool]] = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.state = _CLOSED
+        self.open_until = 0.0
+
+    def latency(self, percentile: float) -> Optional[float]:
+        latencies = sorted(latency for latency, ok in self.calls if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+    @property
+    def error_rate(self) -> float:
+        return sum(1 for _, ok in self.calls if not ok) / len(self.calls) if self.calls else 0.0
+
+
+class LLMRouter:
+    def __init__(self):
+        self._health: Dict[str, _ModelHealth] = {}
+        self._lock = threading.Lock()
+
+    def route(self, model_id: Optional[str]) -> List[str]:
+        fallbacks = [m.strip() for m in os.environ.get("LLM_FALLBACK_MODEL_IDS", "").split(",") if m.strip()]
+        if model_id is None or model_id == "":
+            # The default model goes to the fastest healthy one of the default and its fallbacks
+            candidates = _unique([_get_default_model_id()] + fallbacks)
+            candidates.sort(key=self._p95_or_unknown)
+        else:
+            # A model no provider knows is the client's mistake, not a reason to fall back
+            get_provider(model_id)
+            candidates = _unique([model_id] + fallbacks)
+        now = time.monotonic()
+        with self._lock:
+            available = [m for m in candidates if self._is_available(m, now)]
+        if not available:
+            # The circuits let a probe through when they half open, until then the request fails fast
+            raise ProviderError(f"All the circuits are open. Model ids: {candidates}", 503)
+        return available
+
+    def invoke(self, prompt: str, model_id: Optional[str] = None) -> str:
+        error = None
+        for candidate in self.route(model_id):
+            start = time.monotonic()
+            try:
+                with span("provider", model_id=candidate):
+                    answer = _invoke_provider(prompt, candidate)
+            except Exception as e:
+                if not self._record_error(candidate, time.monotonic() - start, e):
+                    raise
+                logging.warning(f"LLM call failed, trying the next model. Model id: {candidate}, error: {e}")
+                error = e
+                continue
+            self._record(candidate, time.monotonic() - start, True)
+            return answer
+        raise error
+
+    def invoke_stream(self, prompt: str, model_id: Optional[str] = None) -> Iterator[str]:
+        error = None
+        for candidate in self.route(model_id):
+            start = time.monotonic()
+            started = False
+            try:
+                with span("provider", model_id=candidate) as provider_span:
+                    for chunk in _invoke_provider_stream(prompt, candidate):
+                        if not started and provider_span is not None:
+                            provider_span.attrs["first_chunk_ms"] = round((time.monotonic() - start) * 1000, 3)
+                        started = True
+                        yield chunk
+            except Exception as e:
+                if not self._record_error(candidate, time.monotonic() - start, e) or started:
+                    # A bad request fails on every model, and another model can't continue a started answer
+                    raise
+                logging.warning(f"LLM stream failed, trying the next model. Model id: {candidate}, error: {e}")
+                error = e
+                continue
+            self._record(candidate, time.monotonic() - start, True)
+            return
+        raise error
+
+    async def ainvoke(self, prompt: str, model_id: Optional[str] = None) -> str:
+        error = None
+        timeout = float(os.environ.get("LLM_ROUTER_TIMEOUT", 0)) or None
+        for candidate in self.route(model_id):
+            start = time.monotonic()
+            try:
+                with span("provider", model_id=candidate):
+                    answer = await asyncio.wait_for(_ainvoke_provider(prompt, candidate), timeout)
+            except asyncio.TimeoutError as e:
+                self._record(candidate, time.monotonic() - start, False)
+                logging.warning(f"LLM call timed out, trying the next model. Model id: {candidate}")
+                error = e
+                continue
+            except Exception as e:
+                if not self._record_error(candidate, time.monotonic() - start, e):
+                    raise
+                logging.warning(f"LLM call failed, trying the next model. Model id: {candidate}, error: {e}")
+                error = e
+                continue
+            self._record(candidate, time.monotonic() - start, True)
+            return answer
+        raise error
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {model_id: {
+                "provider": _provider_name(model_id),
+                "calls": len(health.calls),
+                "error_rate": health.error_rate,
+                "p50": health.latency(50),
+                "p95": health.latency(95),
+                "circuit": health.state,
+            } for model_id, health in self._health.items()}
+
+    def reset(self):
+        with self._lock:
+            self._health.clear()
+
+    def _p95_or_unknown(self, model_id: str) -> float:
+        with self._lock:
+            health = self._health.get(model_id)
+            latency = health.latency(95) if health is not None else None
+        # Models without measurements keep their configured order, after the measured ones
+        return latency if latency is not None else float("inf")
+
+    def _is_available(self, model_id: str, now: float) -> bool:
+        health = self._health.get(model_id)
+        if health is None or health.state == _CLOSED:
+            return True
+        if now < health.open_until:
+            return False
+        # Half open: one request at a time probes the model, the others keep away until it is back
+        health.state = _HALF_OPEN
+        health.open_until = now + float(os.environ.get("LLM_CIRCUIT_OPEN_SECONDS", 30))
+        return True
+
+    def _record_error(self, model_id: str, latency: float, error: Exception) -> bool:
+        # A bad request would fail on the fallbacks too, only provider failures are worth another model
+        if not _is_provider_failure(error):
+            return False
+        self._record(model_id, latency, False)
+        return True
+
+    def _record(self, model_id: str, latency: float, ok: bool):
+        # An answer that took too long is a failure too, it held a request for all that time
+        if ok and latency > float(os.environ.get("LLM_ROUTER_SLOW_SECONDS", 60)):
+            ok = False
+        with self._lock:
+            health = self._health.get(model_id)
+            if health is None:
+                if len(self._health) >= _MAX_MODELS:
+                    return
+                health = self._health[model_id] = _ModelHealth(int(os.environ.get("LLM_ROUTER_WINDOW", 50)))
+            health.calls.append((latency, ok))
+            if ok:
+                health.consecutive_failures = 0
+                if health.state != _CLOSED:
+                    logging.info(f"Closing the circuit. Model id: {model_id}")
+                    health.state = _CLOSED
+                return
+            health.consecutive_failures += 1
+            if health.state == _HALF_OPEN or self._should_open(health):
+                logging.warning(f"Opening the circuit. Model id: {model_id}, "
+                                f"consecutive failures: {health.consecutive_failures}")
+                health.state = _OPEN
+                health.open_until = time.monotonic() + float(os.environ.get("LLM_CIRCUIT_OPEN_SECONDS", 30))
+
+    @staticmethod
+    def _should_open(health: _ModelHealth) -> bool:
+        if health.consecutive_failures >= int(os.environ.get("LLM_CIRCUIT_FAILURES", 5)):
+            return True
+        return len(health.calls) >= 10 and health.error_rate >= float(os.environ.get("LLM_CIRCUIT_ERROR_RATE", 0.5))
+
+
+def _is_provider_failure(error: Exception) -> bool:
+    # Transport errors, timeouts, 5xx and throttling count against the provider. A bad request or prompt would fail
+    # on any provider, it doesn't open the circuit
+    status = getattr(error, "status", None)
+    if status is not None:
+        return status >= 500 or status == 429
+    return not isinstance(error, ValueError)
+
+
+def _unique(model_ids: List[str]) -> List[str]:
+    return list(dict.fromkeys(model_ids))
+
+
+def _provider_name(model_id: str) -> Optional[str]:
+    try:
+        return get_provider(model_id).name
+    except ValueError:
+        return None
+
+
+router = LLMRouter()
+
+
+def invoke_llm(prompt: str, model_id: str = None) -> str:
+    return router.invoke(prompt, model_id)
+
+
+def invoke_llm_stream(prompt: str, model_id: str = None) -> Iterator[str]:
+    return router.invoke_stream(prompt, model_id)
+
+
+async def ainvoke_llm(prompt: str, model_id: str = None) -> str:
+    return await router.ainvoke(prompt, model_id)
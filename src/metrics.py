@@ -0,0 +1,188 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Tuple, Dict, List, Optional, Iterator
+
+from tracing import enter_span, exit_span, start_trace
+
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_SIZE_BUCKETS = (100, 300, 1000, 3000, 10000, 30000, 100000, 300000)
+# Model ids come from the clients, the ones after these many are counted as "other"
+_MAX_MODEL_LABELS = 20
+
+_metrics: List["_Metric"] = []
+_model_labels: Dict[str, str] = {}
+_model_labels_lock = threading.Lock()
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type}"]
+
+    def _format_labels(self, values: Tuple[str, ...], extra: str = "") -> str:
+        labels = [f'{k}="{_escape(v)}"' for k, v in zip(self.labels, values)]
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, labels: Tuple[str, ...] = (), value: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def get(self, labels: Tuple[str, ...] = ()) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return super().render() + [f"{self.name}{self._format_labels(k)} {_number(v)}" for k, v in values]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, labels: Tuple[str, ...] = ()):
+        with self._lock:
+            self._values[labels] = value
+
+    def dec(self, labels: Tuple[str, ...] = (), value: float = 1):
+        self.inc(labels, -value)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = _LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = buckets
+        # Per labels: the count in each bucket (not cumulative), then the sum and the total count
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 3)
+            counts[index] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def count(self, labels: Tuple[str, ...] = ()) -> int:
+        counts = self._values.get(labels)
+        return int(counts[-1]) if counts else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        lines = super().render()
+        for labels, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{self._format_labels(labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(labels)} {_number(counts[-2])}")
+            lines.append(f"{self.name}_count{self._format_labels(labels)} {int(counts[-1])}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("llm_analytics_stage_seconds", "Time spent in each stage of a SQL request",
+                          ("stage", "model_id"))
+REQUEST_SECONDS = Histogram("llm_analytics_request_seconds", "Time to answer a SQL request", ("endpoint", "outcome"))
+PROMPT_CHARS = Histogram("llm_analytics_prompt_chars", "Size of the prompts in characters", ("model_id",),
+                         _SIZE_BUCKETS)
+PROMPT_TOKENS = Histogram("llm_analytics_prompt_tokens", "Estimated size of the prompts in tokens", ("model_id",),
+                          _SIZE_BUCKETS)
+RESPONSE_CHARS = Histogram("llm_analytics_response_chars", "Size of the LLM answers in characters", ("model_id",),
+                           _SIZE_BUCKETS)
+RESPONSE_TOKENS = Histogram("llm_analytics_response_tokens", "Estimated size of the LLM answers in tokens",
+                            ("model_id",), _SIZE_BUCKETS)
+RETRY_REQUESTS = Counter("llm_analytics_retry_requests_total", "SQL requests retrying a failed SQL (previous_error)")
+RATE_LIMITED = Counter("llm_analytics_rate_limited_total", "SQL requests rejected by the requests limit")
+IN_FLIGHT = Gauge("llm_analytics_requests_in_flight", "SQL requests being answered", ("endpoint",))
+CACHE = Gauge("llm_analytics_llm_cache", "LLM response cache counters", ("stat",))
+
+
+def model_label(model_id: Optional[str]) -> str:
+    if not model_id:
+        return "default"
+    label = _model_labels.get(model_id)
+    if label is None:
+        with _model_labels_lock:
+            label = _model_labels.setdefault(model_id, model_id if len(_model_labels) < _MAX_MODEL_LABELS else "other")
+    return label
+
+
+class _Stage:
+    # A plain class rather than @contextmanager, it is on the hot path of every request
+    __slots__ = ("name", "model_id", "start", "span")
+
+    def __init__(self, name: str, model_id: Optional[str]):
+        self.name = name
+        self.model_id = model_id
+
+    def __enter__(self):
+        self.span = enter_span(self.name, {"model_id": self.model_id} if self.model_id else None)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *args):
+        exit_span(self.span)
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, (self.name, model_label(self.model_id)))
+
+
+def stage(name: str, model_id: Optional[str] = None) -> _Stage:
+    return _Stage(name, model_id)
+
+
+@contextmanager
+def track_request(endpoint: str) -> Iterator[List[str]]:
+    # The caller sets the outcome in the yielded list when the request didn't succeed
+    outcome = ["ok"]
+    IN_FLIGHT.inc((endpoint,))
+    start = time.perf_counter()
+    trace = start_trace(endpoint)
+    try:
+        yield outcome
+    except BaseException:
+        outcome[0] = "error"
+        raise
+    finally:
+        IN_FLIGHT.dec((endpoint,))
+        REQUEST_SECONDS.observe(time.perf_counter() - start, (endpoint, outcome[0]))
+        if trace is not None:
+            trace.finish(outcome[0])
+
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for metric in _metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
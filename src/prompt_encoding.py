@@ -0,0 +1,138 @@
+import ast
+import csv
+import datetime
+import io
+import json
+from typing import NamedTuple, Optional, List, Dict, Any
+
+_MAX_VALUE_LENGTH = 40
+_METADATA_FIELDS = ["column_name", "column_type", "approx_unique", "min", "max", "null_percentage"]
+
+
+class EncodedData(NamedTuple):
+    metadata: str
+    sample_data: Optional[str]
+    distinct_values: Optional[str]
+    tokens_before: int
+    tokens_after: int
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    # Roughly 4 characters per token for the models we use - good enough to compare encodings
+    return (len(text) + 3) // 4 if text else 0
+
+
+def encode_prompt_data(metadata: str, sample_data: Optional[str], distinct_values: Optional[str],
+                       token_budget: int = 0) -> EncodedData:
+    tokens_before = estimate_tokens(metadata) + estimate_tokens(sample_data) + estimate_tokens(distinct_values)
+
+    columns = _parse_rows(metadata)
+    if columns:
+        metadata = _encode_table(columns, [f for f in _METADATA_FIELDS if any(f in c for c in columns)])
+    samples = _parse_rows(sample_data)
+    sample_fields = list(samples[0].keys()) if samples else []
+    distinct = _parse_distinct_values(distinct_values)
+
+    def _encode():
+        encoded_samples = _encode_table(samples, sample_fields) if samples else \
+            (sample_data if samples is None else None)
+        encoded_distinct = _encode_distinct_values(distinct) if distinct else \
+            (distinct_values if distinct is None else None)
+        return encoded_samples, encoded_distinct, \
+            estimate_tokens(metadata) + estimate_tokens(encoded_samples) + estimate_tokens(encoded_distinct)
+
+    encoded_samples, encoded_distinct, tokens = _encode()
+    # Over the budget, sample rows go first and then the columns with the most distinct values
+    while token_budget > 0 and tokens > token_budget:
+        if samples:
+            samples.pop()
+        elif samples is None:
+            # Data in an unknown format can only be dropped as a whole
+            samples = []
+        elif distinct:
+            del distinct[max(distinct, key=lambda c: len(distinct[c]))]
+        elif distinct is None:
+            distinct = {}
+        else:
+            break
+        encoded_samples, encoded_distinct, tokens = _encode()
+    return EncodedData(metadata, encoded_samples, encoded_distinct, tokens_before, tokens)
+
+
+def _encode_table(rows: List[dict], fields: List[str]) -> str:
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(fields)
+    for row in rows:
+        writer.writerow([_format_value(row.get(f)) for f in fields])
+    return output.getvalue()
+
+
+def _encode_distinct_values(distinct: Dict[str, list]) -> str:
+    return "".join(f"{col}: {', '.join(_format_value(v) for v in values)}\n" for col, values in distinct.items())
+
+
+def _format_value(value: Any) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        # The shortest repr that reads back the same number, the model should see the values of the data
+        text = repr(value)
+        return text[:-2] if text.endswith(".0") else text
+    value = " ".join(str(value).split())
+    if len(value) > _MAX_VALUE_LENGTH:
+        value = value[:_MAX_VALUE_LENGTH - 3] + "..."
+    return value
+
+
+def _parse_distinct_values(data: Optional[str]) -> Optional[Dict[str, list]]:
+    rows = _parse_rows(data)
+    if rows is None:
+        return None
+    distinct: Dict[str, list] = {}
+    for row in rows:
+        for col, values in row.items():
+            distinct[col] = values if isinstance(values, list) else [values]
+    return distinct
+
+
+def _parse_rows(data: Optional[str]) -> Optional[List[dict]]:
+    # The browser sends json, the validation harness sends one python dict repr per line.
+    # None means the data is in an unknown format and should be used as is
+    if data is None or data.strip() == "":
+        return []
+    try:
+        rows = json.loads(data)
+    except (ValueError, RecursionError):
+        try:
+            rows = [_literal(ast.parse(line.strip(), mode="eval").body) for line in data.splitlines() if line.strip()]
+        except (SyntaxError, ValueError, TypeError, MemoryError, RecursionError):
+            return None
+    if isinstance(rows, dict):
+        rows = [rows]
+    if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+        return None
+    return rows
+
+
+def _literal(node: ast.AST) -> Any:
+    if isinstance(node, ast.Constant):
+        return node.value
+    if isinstance(node, ast.Dict):
+        return {_literal(k): _literal(v) for k, v in zip(node.keys, node.values)}
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return [_literal(e) for e in node.elts]
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        return -_literal(node.operand)
+    if isinstance(node, ast.Call):
+        # Reprs of values DuckDB returns, e.g. Decimal('1.50') or datetime.date(2024, 1, 31)
+        args = [_literal(a) for a in node.args]
+        name = ast.unparse(node.func)
+        if name.endswith("date") and len(args) == 3:
+            return datetime.date(*args).isoformat()
+        if name.endswith("datetime") and 3 <= len(args) <= 7:
+            return datetime.datetime(*args).isoformat(sep=" ")
+        if len(args) == 1:
+            return args[0]
+        return ast.unparse(node)
+    raise ValueError(f"Unsupported value: {ast.unparse(node)}")
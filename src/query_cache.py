@@ -0,0 +1,122 @@
+import hashlib
+import pickle
+import threading
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import NamedTuple, Optional, List, Dict, Tuple, FrozenSet
+
+_VOLATILE_FUNCTIONS = {"Rand", "Uuid", "CurrentDate", "CurrentTime", "CurrentTimestamp"}
+_VOLATILE_NAMES = {"random", "uuid", "gen_random_uuid", "now", "today", "get_current_time", "get_current_timestamp",
+                   "nextval", "currval", "setseed"}
+
+
+@lru_cache(maxsize=1024)
+def canonicalize_sql(sql: str) -> Optional[Tuple[str, FrozenSet[str]]]:
+    # The sql without comments, with normalized whitespace, keywords and quoting, and the tables it reads.
+    # None when its result can't be cached: it doesn't parse, reads files directly or isn't deterministic
+    import sqlglot
+    from sqlglot import expressions as expr
+    try:
+        parse_tree = sqlglot.parse_one(sql, read="duckdb")
+    except sqlglot.errors.ParseError:
+        return None
+    if parse_tree is None:
+        return None
+    ctes = {cte.alias for cte in parse_tree.find_all(expr.CTE)}
+    tables = set()
+    for table in parse_tree.find_all(expr.Table):
+        if not isinstance(table.this, expr.Identifier):
+            return None
+        if table.name not in ctes:
+            tables.add(table.name)
+    for func in parse_tree.find_all(expr.Func):
+        name = func.name.lower() if isinstance(func, expr.Anonymous) else ""
+        if type(func).__name__ in _VOLATILE_FUNCTIONS or name in _VOLATILE_NAMES:
+            return None
+    return parse_tree.sql(dialect="duckdb", comments=False, identify=True), frozenset(tables)
+
+
+def get_result_key(canonical_sql: str, versions: Dict[str, str], result_format: str) -> str:
+    key = hashlib.sha256()
+    for part in [canonical_sql, result_format] + [f"{name}={version}" for name, version in sorted(versions.items())]:
+        key.update(part.encode("utf-8"))
+        key.update(b"\0")
+    return key.hexdigest()
+
+
+class CachedResult(NamedTuple):
+    columns: List[str]
+    types: List[str]
+    # The rows, pickled and compressed, or the Arrow IPC stream
+    data: bytes
+    rows: int
+    truncated: bool
+    # The versions of the datasets the query read
+    versions: Dict[str, str]
+
+    def decode_rows(self) -> List[tuple]:
+        return pickle.loads(zlib.decompress(self.data))
+
+
+def encode_rows(rows: List[tuple]) -> bytes:
+    return zlib.compress(pickle.dumps(rows, protocol=pickle.HIGHEST_PROTOCOL), 1)
+
+
+class QueryResultCache:
+    # Results of server dataset queries by canonical sql and dataset versions, in a size bounded LRU
+    def __init__(self, max_entries: int = 1000, max_bytes: int = 256 * 1024 * 1024,
+                 max_entry_bytes: int = 16 * 1024 * 1024):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: OrderedDict[str, CachedResult] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "uncacheable": 0, "too_large": 0, "evictions": 0,
+                       "invalidations": 0}
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry
+
+    def put(self, key: str, entry: CachedResult):
+        with self._lock:
+            if len(entry.data) > self.max_entry_bytes:
+                self._stats["too_large"] += 1
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = entry
+            self._size += len(key) + len(entry.data)
+            while self._entries and (len(self._entries) > self._max_entries or self._size > self._max_bytes):
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def invalidate(self, dataset: str, version: Optional[str] = None):
+        # Drops the results read from other versions of the dataset, or from any version without one
+        with self._lock:
+            stale = [key for key, entry in self._entries.items()
+                     if dataset in entry.versions and entry.versions[dataset] != version]
+            for key in stale:
+                self._remove(key)
+            self._stats["invalidations"] += len(stale)
+
+    def count_uncacheable(self):
+        with self._lock:
+            self._stats["uncacheable"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {**self._stats, "hit_rate": self._stats["hits"] / lookups if lookups else 0.0,
+                    "entries": len(self._entries), "bytes": self._size}
+
+    def _remove(self, key: str):
+        self._size -= len(key) + len(self._entries.pop(key).data)
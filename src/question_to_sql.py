@@ -1,4 +1,9 @@
-from typing import Optional
+import logging
+import os
+from functools import lru_cache
+from typing import Optional, Tuple, Sequence
+
+from prompt_encoding import encode_prompt_data, estimate_tokens
 
 _HINTS = [
     """Do NOT use sub-queries or any form of SELECT statement in the HAVING clause, as it is not supported by the DB. 
@@ -36,25 +41,51 @@ _HINTS = [
 
 def get_prompt(table_name: str, question: str, metadata: str, sample_data: str,
                distinct_values: str = None, hint: str = None, previous_sql: str = None,
-               previous_error: str = None) -> str:
-    prompt = f"""<instructions>
-I have a table with the columns matching the json data below. The table name is {table_name}.
-you MUST query from this table only. No other tables are available.
-Please create a sql statement I can run on my db to get the answer to the question:
-{question}
-SUPER IMPORTANT: You MUST follow the ALL OF the following rules when constructing the SQL. 
-Each one of them is important for the correct execution of the SQL - do not skip any of them:
-{_format_hints(hint)}
+               previous_error: str = None, compact: Optional[bool] = None,
+               turns: Sequence[Tuple[str, str]] = ()) -> "Prompt":
+    if compact is None:
+        compact = os.environ.get("PROMPT_ENCODING", "raw") == "compact"
+    if not compact:
+        return _build_prompt(table_name, question, metadata, sample_data, distinct_values, hint, previous_sql,
+                             previous_error, turns)
 
-{_get_retry_prompt(previous_sql, previous_error) if previous_sql else ""}
-</instructions>
-<formatting>
-Please include a single sentence SQL comment before the statement, explaining the output of the statement. 
-Start the comment with the prefix: /* Results for
-Do not include any other comments in the SQL.
-Return SQL only, without any other information. Use the duckdb SQL dialect.
-</formatting>
-        
+    token_budget = int(os.environ.get("PROMPT_TOKEN_BUDGET", 0))
+    if token_budget > 0:
+        # The budget covers the whole prompt, the data gets what the instructions leave
+        instructions = _build_prompt(table_name, question, "", None, None, hint, previous_sql, previous_error, turns)
+        token_budget = max(1, token_budget - estimate_tokens(instructions))
+    encoded = _encode_prompt_data(metadata, sample_data, distinct_values, token_budget)
+    logging.info(f"Prompt data encoded. Tokens before: {encoded.tokens_before}, after: {encoded.tokens_after}")
+    return _build_prompt(table_name, question, encoded.metadata, encoded.sample_data or "", encoded.distinct_values,
+                         hint, previous_sql, previous_error, turns)
+
+
+# Follow-up questions on a registered dataset pass the same strings again, so their encoding is reused
+_encode_prompt_data = lru_cache(maxsize=64)(encode_prompt_data)
+
+
+class Prompt(str):
+    # The prompt text, remembering the parts it was built from, so providers can cache the parts that repeat
+    parts: Tuple[str, ...]
+
+    def __new__(cls, *parts: str) -> "Prompt":
+        prompt = super().__new__(cls, "".join(parts))
+        prompt.parts = parts
+        return prompt
+
+
+def _build_prompt(table_name: str, question: str, metadata: str, sample_data: Optional[str],
+                  distinct_values: Optional[str], hint: Optional[str], previous_sql: Optional[str],
+                  previous_error: Optional[str], turns: Sequence[Tuple[str, str]] = ()) -> Prompt:
+    # From the most to the least shared part: the instructions, the dataset, the conversation and then the question
+    return Prompt(_STATIC_PREFIX, _get_dataset_prompt(table_name, metadata, sample_data, distinct_values),
+                  _get_conversation_prompt(turns), _get_question_prompt(question, hint, previous_sql, previous_error))
+
+
+@lru_cache(maxsize=64)
+def _get_dataset_prompt(table_name: str, metadata: str, sample_data: Optional[str],
+                        distinct_values: Optional[str]) -> str:
+    return f"""The table name is {table_name}.
 Here is the table metadata:
 <metadata>
 {metadata}
@@ -67,7 +98,25 @@ this is the sample data:
 {sample_data}
 </data>
 """
-    return prompt
+
+
+def _get_conversation_prompt(turns: Sequence[Tuple[str, str]]) -> str:
+    if not turns:
+        return ""
+    result = "\nThese are the previous questions on this table and the SQL you created for them:\n<conversation>\n"
+    for question, sql in turns:
+        result += f"Question: {question}\nSQL: {sql}\n"
+    return result + "</conversation>\n"
+
+
+def _get_question_prompt(question: str, hint: Optional[str], previous_sql: Optional[str],
+                         previous_error: Optional[str]) -> str:
+    return f"""
+{_get_hint_prompt(hint) if hint else ""}
+{_get_retry_prompt(previous_sql, previous_error) if previous_sql else ""}
+Please create a sql statement I can run on my db to get the answer to the question:
+{question}
+"""
 
 
 def _get_distinct_values_prompt(distinct_values: Optional[str]) -> str:
@@ -80,6 +129,12 @@ def _get_distinct_values_prompt(distinct_values: Optional[str]) -> str:
 </distinct_values>"""
 
 
+def _get_hint_prompt(hint: str) -> str:
+    return f"""You MUST also follow this rule:
+{len(_HINTS) + 1}. {hint}
+"""
+
+
 def _get_retry_prompt(previous_sql: str, previous_error: str) -> str:
     return f"""In previous attempt, the you created the the following sql:
 {previous_sql}
@@ -87,14 +142,30 @@ def _get_retry_prompt(previous_sql: str, previous_error: str) -> str:
 The result was this error from the database:
 {previous_error}        
 
-Please use this information to correct the SQL and try again."""
+Please use this information to correct the SQL and try again.
+"""
 
 
-def _format_hints(hint: str):
+def _format_hints() -> str:
     result = ""
     for idx, h in enumerate(_HINTS):
         result += f"{idx + 1}. {h}\n"
-    if hint:
-        result += f"{len(_HINTS) + 1}. {hint}"
     return result
 
+
+_STATIC_PREFIX = f"""<instructions>
+I have a table with the columns matching the json data below. The table name is given after the instructions.
+you MUST query from this table only. No other tables are available.
+I will ask you to create a sql statement I can run on my db to get the answer to a question.
+SUPER IMPORTANT: You MUST follow the ALL OF the following rules when constructing the SQL. 
+Each one of them is important for the correct execution of the SQL - do not skip any of them:
+{_format_hints()}
+</instructions>
+<formatting>
+Please include a single sentence SQL comment before the statement, explaining the output of the statement. 
+Start the comment with the prefix: /* Results for
+Do not include any other comments in the SQL.
+Return SQL only, without any other information. Use the duckdb SQL dialect.
+</formatting>
+
+"""
@@ -0,0 +1,374 @@
+import hashlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import queue
+import threading
+from functools import lru_cache
+from typing import NamedTuple, Optional, List, Dict, Iterator, Tuple, Union, TYPE_CHECKING
+
+
+from dataset_context import DatasetContext
+from dataset_profiler import profile_dataset, DatasetProfile
+from query_cache import QueryResultCache, CachedResult, canonicalize_sql, get_result_key, encode_rows
+
+if TYPE_CHECKING:
+    import duckdb
+
+_FORMATS = {".csv": "csv", ".parquet": "parquet", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+_READERS = {"csv": "read_csv_auto", "parquet": "read_parquet", "jsonl": "read_json_auto"}
+_HASH_BLOCK = 1024 * 1024
+
+
+class QueryError(ValueError):
+    pass
+
+
+class ServerDataset(NamedTuple):
+    name: str
+    path: str
+    file_format: str
+
+    @property
+    def version(self) -> str:
+        # Changes when the file is replaced or rewritten, the views read the file on every query
+        stat = os.stat(self.path)
+        return _fingerprint(self.path, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=1024)
+def _fingerprint(path: str, mtime_ns: int, size: int) -> str:
+    # The time and size with a hash of the first and last blocks, hashing a whole large file would cost more than
+    # most queries on it
+    key = hashlib.sha256(f"{mtime_ns}:{size}".encode("utf-8"))
+    with open(path, "rb") as f:
+        key.update(f.read(_HASH_BLOCK))
+        if size > _HASH_BLOCK:
+            f.seek(max(_HASH_BLOCK, size - _HASH_BLOCK))
+            key.update(f.read())
+    return key.hexdigest()[:32]
+
+
+class QueryResult:
+    # A running query: its columns, and its rows by pages or as an Arrow IPC stream. The connection goes back to
+    # the pool when the rows are read or the result is closed
+    cached = False
+
+    def __init__(self, server: "DatasetServer", cursor: "duckdb.DuckDBPyConnection", timer: threading.Timer,
+                 cache_key: Optional[str] = None, versions: Optional[Dict[str, str]] = None):
+        self._server = server
+        self._cursor = cursor
+        self._timer = timer
+        self._cache_key = cache_key
+        self._versions = versions
+        self._closed = False
+        self.rows = 0
+        self.columns = [d[0] for d in cursor.description]
+        self.types = [str(d[1]) for d in cursor.description]
+
+    def pages(self, page_size: int = 1000) -> Iterator[List[tuple]]:
+        import duckdb
+        max_rows = self._server.max_rows
+        # Kept for the cache, a result read only in part isn't cached
+        rows = [] if self._cache_key is not None else None
+        try:
+            while self.rows < max_rows:
+                page = self._cursor.fetchmany(min(page_size, max_rows - self.rows))
+                if not page:
+                    break
+                self.rows += len(page)
+                if rows is not None:
+                    rows.extend(page)
+                yield page
+            if rows is not None:
+                self._store(encode_rows(rows))
+        except duckdb.Error as e:
+            raise self._server.query_error(e)
+        finally:
+            self.close()
+
+    def arrow_stream(self, batch_size: int = 10000) -> Iterator[bytes]:
+        import duckdb
+        import pyarrow
+        max_rows = self._server.max_rows
+        sink = io.BytesIO()
+        chunks = [] if self._cache_key is not None else None
+        try:
+            reader = self._cursor.fetch_record_batch(batch_size)
+            with pyarrow.ipc.new_stream(sink, reader.schema) as writer:
+                for batch in reader:
+                    batch = batch.slice(0, max_rows - self.rows)
+                    writer.write_batch(batch)
+                    self.rows += batch.num_rows
+                    chunk = _drain(sink)
+                    if chunks is not None:
+                        chunks.append(chunk)
+                    yield chunk
+                    if self.rows >= max_rows:
+                        break
+            chunk = _drain(sink)
+            if chunks is not None:
+                self._store(b"".join(chunks) + chunk)
+            yield chunk
+        except duckdb.Error as e:
+            raise self._server.query_error(e)
+        finally:
+            self.close()
+
+    @property
+    def truncated(self) -> bool:
+        return self.rows >= self._server.max_rows
+
+    def _store(self, data: bytes):
+        self._server.cache.put(self._cache_key, CachedResult(self.columns, self.types, data, self.rows,
+                                                             self.truncated, self._versions))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._timer.cancel()
+        self._server.release(self._cursor, self.rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CachedQueryResult:
+    # A result from the cache, the same interface as QueryResult without a connection
+    cached = True
+
+    def __init__(self, entry: CachedResult):
+        self._entry = entry
+        self.columns = entry.columns
+        self.types = entry.types
+        self.rows = entry.rows
+        self.truncated = entry.truncated
+
+    def pages(self, page_size: int = 1000) -> Iterator[List[tuple]]:
+        rows = self._entry.decode_rows()
+        for start in range(0, len(rows), page_size):
+            yield rows[start:start + page_size]
+
+    def arrow_stream(self, batch_size: int = 10000) -> Iterator[bytes]:
+        yield self._entry.data
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DatasetServer:
+    # Datasets are the files of a server folder, every file a read-only view named by the file. Queries run on a
+    # pool of cursors of one DuckDB database, they share its cache and run in parallel outside of the GIL
+    def __init__(self, directory: str, pool_size: int = 4, memory_limit: Optional[str] = None,
+                 timeout_seconds: float = 30, max_rows: int = 100000, profile_max_bytes: int = 64 * 1024 * 1024,
+                 wait_seconds: float = 10, cache: Optional[QueryResultCache] = None):
+        self.cache = cache
+        self._versions: Dict[str, str] = {}
+        self._directory = os.path.abspath(directory)
+        self._timeout_seconds = timeout_seconds
+        self._wait_seconds = wait_seconds
+        self.max_rows = max_rows
+        self._profile_max_bytes = profile_max_bytes
+        self._datasets: Dict[str, ServerDataset] = {}
+        self._profiles: Dict[str, Tuple[str, DatasetProfile]] = {}
+        self._profile_locks: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+        import duckdb
+        self._con = duckdb.connect()
+        if memory_limit:
+            self._con.execute(f"SET memory_limit = '{memory_limit}'")
+        self.refresh()
+        # Queries can only read the datasets folder, and can't change the settings back
+        self._con.execute(f"SET allowed_directories = ['{self._directory}{os.sep}']")
+        self._con.execute("SET enable_external_access = false")
+        self._con.execute("SET lock_configuration = true")
+        self._pool: queue.Queue = queue.Queue()
+        for _ in range(pool_size):
+            self._pool.put(self._con.cursor())
+        self._stats = {"queries": 0, "errors": 0, "timeouts": 0, "rows": 0}
+
+    def refresh(self):
+        with self._lock:
+            datasets = {}
+            for file in sorted(os.listdir(self._directory)):
+                name, extension = os.path.splitext(file)
+                if extension.lower() in _FORMATS:
+                    datasets[name] = ServerDataset(name, os.path.join(self._directory, file),
+                                                   _FORMATS[extension.lower()])
+            for name in self._datasets.keys() - datasets.keys():
+                self._con.execute(f"DROP VIEW IF EXISTS {_quote(name)}")
+                self._profiles.pop(name, None)
+                if self.cache is not None:
+                    self.cache.invalidate(name)
+            for name, dataset in datasets.items():
+                if self._datasets.get(name) != dataset:
+                    self._con.execute(f"CREATE OR REPLACE VIEW {_quote(name)} AS "
+                                      f"SELECT * FROM {_READERS[dataset.file_format]}('{_escape(dataset.path)}')")
+            self._datasets = datasets
+        logging.info(f"Server datasets: {list(datasets)}")
+
+    def datasets(self) -> List[ServerDataset]:
+        with self._lock:
+            return list(self._datasets.values())
+
+    def get(self, name: Optional[str]) -> ServerDataset:
+        with self._lock:
+            dataset = self._datasets.get(name)
+        if dataset is None:
+            raise QueryError(f"Dataset not found: {name}")
+        return dataset
+
+    def get_context(self, name: str) -> DatasetContext:
+        # The prompt data of a dataset in the form the browser sends it, profiled once per version of the file
+        dataset = self.get(name)
+        profile = self._get_profile(dataset)
+        distinct_values = json.dumps([profile.distinct_values], default=str) if profile.distinct_values else None
+        return DatasetContext(table_name=name, metadata=json.dumps(profile.metadata),
+                              columns=profile.metadata, sample_data=json.dumps(profile.sample_data, default=str),
+                              distinct_values=distinct_values)
+
+    def _get_profile(self, dataset: ServerDataset) -> DatasetProfile:
+        version = dataset.version
+        with self._lock:
+            lock = self._profile_locks.setdefault(dataset.name, threading.Lock())
+        # Concurrent questions on a new dataset wait for one profile rather than all reading the file
+        with lock:
+            cached = self._profiles.get(dataset.name)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            size = os.path.getsize(dataset.path)
+            sample_rate = min(1.0, self._profile_max_bytes / size) if size > 0 else 1.0
+            logging.info(f"Profiling server dataset: {dataset.name}, sample rate: {sample_rate:.3f}")
+            profile = profile_dataset(dataset.path, dataset.file_format, sample_rate=sample_rate, seed=0)
+            self._profiles[dataset.name] = (version, profile)
+            return profile
+
+    def query(self, sql: str, arrow: bool = False) -> Union[QueryResult, CachedQueryResult]:
+        import duckdb
+        statement = _parse_statement(sql)
+        cache_key, versions = self._get_cache_key(sql, arrow)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return CachedQueryResult(cached)
+        try:
+            cursor = self._pool.get(timeout=self._wait_seconds)
+        except queue.Empty:
+            raise QueryError("The server is busy. Please try again later.")
+        # The time limit covers the query and the reading of its rows
+        timer = threading.Timer(self._timeout_seconds, cursor.interrupt)
+        timer.start()
+        self._count("queries")
+        try:
+            cursor.execute(statement)
+        except duckdb.Error as e:
+            timer.cancel()
+            self.release(cursor, 0)
+            raise self.query_error(e)
+        return QueryResult(self, cursor, timer, cache_key, versions)
+
+    def _get_cache_key(self, sql: str, arrow: bool) -> Tuple[Optional[str], Optional[Dict[str, str]]]:
+        if self.cache is None:
+            return None, None
+        canonical = canonicalize_sql(sql)
+        with self._lock:
+            datasets = [self._datasets.get(name) for name in canonical[1]] if canonical is not None else [None]
+        if None in datasets:
+            # Reads a file, a table that isn't a dataset, or isn't deterministic
+            self.cache.count_uncacheable()
+            return None, None
+        versions = {dataset.name: dataset.version for dataset in datasets}
+        for name, version in versions.items():
+            with self._lock:
+                changed = self._versions.get(name) != version
+                self._versions[name] = version
+            if changed:
+                # A new dataset, or the file changed: the results of the version before are dropped
+                self.cache.invalidate(name, version)
+        return get_result_key(canonical[0], versions, "arrow" if arrow else "rows"), versions
+
+    def release(self, cursor: "duckdb.DuckDBPyConnection", rows: int):
+        # A result that wasn't read to the end is dropped by the next query on the cursor
+        self._count("rows", rows)
+        self._pool.put(cursor)
+
+    def query_error(self, e: "duckdb.Error") -> QueryError:
+        import duckdb
+        if isinstance(e, duckdb.InterruptException):
+            self._count("timeouts")
+            return QueryError(f"The query took more than {self._timeout_seconds} seconds")
+        self._count("errors")
+        return QueryError(str(e))
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._stats[name] += value
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {**self._stats, "datasets": len(self._datasets), "idle_connections": self._pool.qsize()}
+        if self.cache is not None:
+            stats["result_cache"] = self.cache.stats()
+        return stats
+
+
+def has_arrow() -> bool:
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def _parse_statement(sql: str) -> "duckdb.Statement":
+    import duckdb
+    try:
+        statements = duckdb.extract_statements(sql)
+    except duckdb.Error as e:
+        raise QueryError(str(e))
+    # Read-only: a single SELECT (WITH, UNION, DESCRIBE and SUMMARIZE are selects too)
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        raise QueryError("Only a single SELECT statement can run on server datasets")
+    return statements[0]
+
+
+def _drain(sink: io.BytesIO) -> bytes:
+    data = sink.getvalue()
+    sink.seek(0)
+    sink.truncate()
+    return data
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _escape(value: str) -> str:
+    return value.replace("'", "''")
+
+
+def create_dataset_server() -> Optional[DatasetServer]:
+    # Server datasets are opt-in: without a folder all the queries run in the browser
+    directory = os.environ.get("SERVER_DATASETS_DIR")
+    if not directory:
+        return None
+    cache_bytes = int(os.environ.get("QUERY_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+    cache = QueryResultCache(max_entries=int(os.environ.get("QUERY_CACHE_MAX_ENTRIES", 1000)), max_bytes=cache_bytes,
+                             max_entry_bytes=int(os.environ.get("QUERY_CACHE_MAX_ENTRY_BYTES", 16 * 1024 * 1024))
+                             ) if cache_bytes > 0 else None
+    return DatasetServer(directory,
+                         pool_size=int(os.environ.get("SERVER_QUERY_POOL_SIZE", os.cpu_count() or 1)),
+                         memory_limit=os.environ.get("SERVER_QUERY_MEMORY_LIMIT"),
+                         timeout_seconds=float(os.environ.get("SERVER_QUERY_TIMEOUT", 30)),
+                         wait_seconds=float(os.environ.get("SERVER_QUERY_WAIT", 10)),
+                         max_rows=int(os.environ.get("SERVER_QUERY_MAX_ROWS", 100000)),
+                         profile_max_bytes=int(os.environ.get("SERVER_PROFILE_MAX_BYTES", 64 * 1024 * 1024)),
+                         cache=cache)
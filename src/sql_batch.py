@@ -0,0 +1,74 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
+from typing import Optional, Dict, Tuple, List, Iterator, Mapping, Any, Union
+
+from llm_cache import LLMResponseCache
+from sql_generator import SqlResult, generate_sql
+from sql_request import SqlRequest
+from utils import _get_default_model_id, get_provider
+
+_executors: Dict[int, ThreadPoolExecutor] = {}
+_provider_limits: Dict[Tuple[str, int], threading.BoundedSemaphore] = {}
+_lock = threading.Lock()
+
+
+def parse_questions(params: Mapping[str, Any]) -> List[str]:
+    max_questions = int(os.environ.get("BATCH_MAX_QUESTIONS", 50))
+    questions = params.get("questions")
+    if not isinstance(questions, list) or len(questions) == 0:
+        raise ValueError("questions must be a non empty list")
+    if len(questions) > max_questions:
+        raise ValueError(f"A batch can have up to {max_questions} questions")
+    if not all(isinstance(q, str) and q.strip() != "" for q in questions):
+        raise ValueError("Every question must be a non empty string")
+    return questions
+
+
+def generate_sql_batch(sql_requests: List[SqlRequest], llm_cache: Optional[LLMResponseCache] = None
+                       ) -> Iterator[Tuple[int, Union[SqlResult, Exception]]]:
+    # Yields (index, result or error) in completion order, so the slow questions don't hold back the fast ones
+    executor = get_batch_executor()
+    futures: Dict[Future, int] = {executor.submit(_generate_sql, r, llm_cache): i for i, r in enumerate(sql_requests)}
+    try:
+        for future in as_completed(futures):
+            error = future.exception()
+            yield futures[future], error if error is not None else future.result()
+    finally:
+        # The client went away, don't spend LLM calls on answers no one will read
+        for future in futures:
+            future.cancel()
+
+
+def get_batch_executor() -> ThreadPoolExecutor:
+    max_workers = int(os.environ.get("BATCH_MAX_WORKERS", 32))
+    executor = _executors.get(max_workers)
+    if executor is None:
+        with _lock:
+            executor = _executors.get(max_workers)
+            if executor is None:
+                logging.info(f"Creating batch executor. Max workers: {max_workers}")
+                executor = _executors[max_workers] = ThreadPoolExecutor(max_workers=max_workers,
+                                                                        thread_name_prefix="sql-batch")
+    return executor
+
+
+def _generate_sql(sql_request: SqlRequest, llm_cache: Optional[LLMResponseCache]) -> SqlResult:
+    with _get_provider_limit(sql_request.model_id):
+        return generate_sql(sql_request, llm_cache)
+
+
+def _get_provider_limit(model_id: Optional[str]) -> threading.BoundedSemaphore:
+    # Every batch shares the provider quota, a single batch must not take all of it
+    try:
+        provider = get_provider(model_id or _get_default_model_id()).name
+    except ValueError:
+        # generate_sql reports it
+        provider = ""
+    key = (provider, int(os.environ.get("BATCH_PROVIDER_CONCURRENCY", 8)))
+    limit = _provider_limits.get(key)
+    if limit is None:
+        with _lock:
+            limit = _provider_limits.setdefault(key, threading.BoundedSemaphore(key[1]))
+    return limit
@@ -1,28 +1,46 @@
 import logging
+import os
 import re
-from typing import Optional, Set, Dict
+from functools import lru_cache
+from typing import Optional, Set, Dict, FrozenSet
 
 import sqlglot.expressions as expr
 
 import sqlglot
 
+from tracing import span
+
 _DIALECT = "duckdb"
+_PLAIN_IDENTIFIER = re.compile(r"[a-z_][a-z0-9_]*")
 
 
 def fix_sql(sql: str, column_names: Set[str] = None) -> str:
+    fuzzy = os.environ.get("SQL_FIX_FUZZY_COLUMNS", "false").lower() == "true"
+    # The index is shared by every answer on the dataset, so the cached answers don't hold a copy of the columns each
+    return _fix_sql(sql, get_column_index(frozenset(column_names) if column_names else frozenset(), fuzzy))
+
+
+@lru_cache(maxsize=1024)
+def _fix_sql(sql: str, column_index: "ColumnIndex") -> str:
     if sql.startswith("```sql\n") and sql.endswith("```"):
         sql = sql[7:-3]
-    sql = _convert_to_duckdb(sql)
-    sql = _verify_columns_and_add_aliases(sql, column_names if column_names else set())
+    # The statement is parsed once, all the fixes are applied on the tree and the SQL is generated once
+    with span("sqlglot_parse"):
+        parse_tree = _convert_to_duckdb(sql)
+    if parse_tree is None or parse_tree.find(expr.Select) is None:
+        # Not a query sqlglot can fix, the validation reports the error and the model gets another attempt
+        return _remove_semicolon(sql)
+    parse_tree = _verify_columns_and_add_aliases(parse_tree, column_index)
+    with span("sqlglot_generate"):
+        sql = parse_tree.sql(dialect=_DIALECT)
     sql = _remove_semicolon(sql)
     return sql
 
 
-def _convert_to_duckdb(sql: str) -> Optional[str]:
+def _convert_to_duckdb(sql: str) -> Optional[expr.Expression]:
     try:
-        converted_sql = sqlglot.transpile(sql, write=_DIALECT)
-        return converted_sql[0]
-    except sqlglot.errors.ParseError as e:
+        return sqlglot.parse(sql)[0]
+    except sqlglot.errors.SqlglotError as e:
         logging.error(f"Error converting SQL: {e}")
         return None
 
@@ -49,32 +67,32 @@ def _create_alias_for_exp(exp: str) -> str:
     return _update_col_name(result)
 
 
-def _verify_columns_and_add_aliases(sql: str, column_names: Set[str]) -> Optional[str]:
-    try:
-        parse_tree = sqlglot.parse_one(sql)
-    except sqlglot.errors.ParseError as e:
-        logging.error(f"SQL: {sql}\nError parsing SQL: {e}")
-        return sql
+def _verify_columns_and_add_aliases(parse_tree: expr.Expression, column_names: "ColumnIndex") -> expr.Expression:
     updated_aliases: Dict[str, str] = {}
-    s = parse_tree.find(expr.Select)
-    for e in s.expressions:
-        new_name = None
-        if isinstance(e, expr.Condition) and e.alias == "":
-            new_name = _get_key(e)
-        if new_name and new_name != e.name:
-            e.replace(expr.Alias(this=e.copy(), alias=new_name))
-        if isinstance(e, expr.Alias):
-            new_name = _update_col_name(e.alias)
-            if new_name != e.alias:
-                e.replace(expr.Alias(this=e.this, alias=_update_col_name(e.alias)))
-                updated_aliases[e.alias] = new_name
-    _fix_column_names(parse_tree, column_names, updated_aliases)
+    with span("fix_aliases"):
+        s = parse_tree.find(expr.Select)
+        for e in s.expressions:
+            new_name = None
+            if isinstance(e, expr.Condition) and e.alias == "":
+                new_name = _get_key(e)
+            if new_name and new_name != e.name:
+                e.replace(expr.Alias(this=e.copy(), alias=new_name))
+            if isinstance(e, expr.Alias):
+                new_name = _update_col_name(e.alias)
+                if new_name != e.alias:
+                    e.replace(expr.Alias(this=e.this, alias=_update_col_name(e.alias)))
+                    updated_aliases[e.alias] = new_name
+    with span("fix_columns"):
+        _fix_column_names(parse_tree, column_names, updated_aliases)
     for o in parse_tree.find_all(expr.Order):
-        identifier = o.find(expr.Column).find(expr.Identifier)
+        column = o.find(expr.Column)
+        if column is None:
+            # ORDER BY 1 - nothing to rename
+            continue
+        identifier = column.find(expr.Identifier)
         if identifier.name in updated_aliases:
-            identifier.replace(expr.Identifier(this=updated_aliases[identifier.name],
-                                                         quoted=identifier.quoted))
-    return s.sql(dialect=_DIALECT)
+            identifier.replace(_identifier(updated_aliases[identifier.name], identifier.quoted))
+    return s
 
 def _get_key(e: expr.Expression) -> str:
     if isinstance(e, expr.Column):
@@ -89,20 +107,87 @@ def _get_key(e: expr.Expression) -> str:
     return f"{e.key}_{sub_key}"
 
 
+def _identifier(name: str, quoted: bool) -> expr.Identifier:
+    # The matched column may have spaces, dashes or capitals the answer didn't have, then it must be quoted
+    return expr.Identifier(this=name, quoted=quoted or not _PLAIN_IDENTIFIER.fullmatch(name))
+
+
 def _remove_special_chars(name: str) -> str:
     return re.sub(r'[^a-zA-Z0-9]', '', name)
 
 
-def _fix_column_names(parse_tree: expr.Expression, cols: Set[str], renamed_cols: Dict[str, str]):
+class ColumnIndex:
+    def __init__(self, column_names: FrozenSet[str], fuzzy: bool = False):
+        self._columns = column_names
+        self._normalized: Dict[str, str] = {}
+        self._case_insensitive: Dict[str, Optional[str]] = {}
+        self._deletions: Optional[Dict[str, Set[str]]] = {} if fuzzy else None
+        # Sorted, so when a few columns have the same normalized name the same one is always picked
+        for c in sorted(column_names):
+            normalized = _remove_special_chars(c)
+            self._normalized.setdefault(normalized, c)
+            lower = normalized.lower()
+            if self._case_insensitive.get(lower, c) != c:
+                self._case_insensitive[lower] = None
+            else:
+                self._case_insensitive[lower] = c
+            if self._deletions is not None:
+                for key in _deletions(lower):
+                    self._deletions.setdefault(key, set()).add(c)
+
+    def __len__(self) -> int:
+        return len(self._columns)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._columns
+
+    def find(self, name: str) -> Optional[str]:
+        if name in self._columns:
+            return name
+        normalized = _remove_special_chars(name)
+        match = self._normalized.get(normalized) or self._case_insensitive.get(normalized.lower())
+        if match is None and self._deletions is not None:
+            match = self._find_similar(normalized.lower())
+        return match
+
+    def _find_similar(self, name: str) -> Optional[str]:
+        # Two names are at most one edit apart only if they share a key after deleting at most one char each
+        candidates = set()
+        for key in _deletions(name):
+            candidates.update(self._deletions.get(key, ()))
+        matches = {c for c in candidates if _within_one_edit(name, _remove_special_chars(c).lower())}
+        return matches.pop() if len(matches) == 1 else None
+
+
+@lru_cache(maxsize=64)
+def get_column_index(column_names: FrozenSet[str], fuzzy: bool = False) -> ColumnIndex:
+    return ColumnIndex(column_names, fuzzy)
+
+
+def _deletions(name: str) -> Set[str]:
+    return {name} | {name[:i] + name[i + 1:] for i in range(len(name))}
+
+
+def _within_one_edit(a: str, b: str) -> bool:
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        return a[i + 1:] == b[i + 1:]
+    return a[i:] == b[i + 1:]
+
+
+def _fix_column_names(parse_tree: expr.Expression, cols: ColumnIndex, renamed_cols: Dict[str, str]):
     if len(cols) == 0:
         return
     for col_ref in parse_tree.find_all(expr.Column):
         identifier = col_ref.find(expr.Identifier)
         if not identifier.name in cols:
-            for c in cols:
-                if _remove_special_chars(c) == _remove_special_chars(identifier.name):
-                    renamed_cols[identifier.name] = c
-                    identifier.replace(expr.Identifier(this=c, quoted=identifier.quoted))
-                    break
-
-
+            c = cols.find(identifier.name)
+            if c is not None:
+                renamed_cols[identifier.name] = c
+                identifier.replace(_identifier(c, identifier.quoted))
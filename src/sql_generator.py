@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import os
+import time
+from typing import NamedTuple, Optional, Iterator, Tuple, Any, Generator, Set
+
+from hedging import is_hedging_enabled, invoke_hedged, ainvoke_hedged
+from llm_cache import LLMResponseCache, get_cache_key
+from llm_router import invoke_llm, invoke_llm_stream, ainvoke_llm
+from metrics import stage, model_label, STAGE_SECONDS, PROMPT_CHARS, PROMPT_TOKENS, RESPONSE_CHARS, RESPONSE_TOKENS, \
+    RETRY_REQUESTS
+from prompt_encoding import estimate_tokens
+from question_to_sql import get_prompt
+from sql_request import SqlRequest
+from sql_validator import validate_sql
+
+_WARM_UP_SQL = """```sql
+WITH sales AS (SELECT Region, "Total Sales", strftime("Order Date", '%Y-%m') AS month FROM my_table)
+SELECT Region, month, SUM("Total Sales") AS total, RANK() OVER (PARTITION BY month ORDER BY total DESC) AS rank
+FROM sales GROUP BY ALL HAVING total > 0 ORDER BY month, rank LIMIT 10
+```"""
+
+
+def fix_sql(sql: str, column_names: Set[str]) -> str:
+    # sqlglot is imported with the first answer, or by the startup warm up, not with the app
+    from sql_fixer import fix_sql as _fix_sql
+    return _fix_sql(sql, column_names)
+
+
+def warm_up_sql_fixer():
+    # Imports sqlglot and builds its duckdb dialect, tokenizer and parser tables before the first answer needs them
+    start = time.perf_counter()
+    try:
+        fix_sql(_WARM_UP_SQL, {"Region", "Total Sales", "Order Date"})
+        logging.info(f"SQL fixer warm up done. Seconds: {time.perf_counter() - start:.3f}")
+    except Exception as e:
+        logging.warning(f"SQL fixer warm up failed: {e}")
+
+
+class SqlResult(NamedTuple):
+    sql: str
+    attempts: int
+    error: Optional[str] = None
+
+    def to_response(self) -> dict:
+        response = {"sql": self.sql, "attempts": self.attempts}
+        if self.error is not None:
+            response["validation_error"] = self.error
+        return response
+
+
+def log_result(sql_request: SqlRequest, result: SqlResult):
+    logging.info("Invoke details: %s", {
+        "question": sql_request.question,
+        "metadata-columns": [c["column_name"] for c in sql_request.columns],
+        "previous-error": sql_request.previous_error,
+        "sql": result.sql,
+        "attempts": result.attempts,
+        "validation-error": result.error,
+    })
+
+
+def generate_sql(sql_request: SqlRequest, llm_cache: Optional[LLMResponseCache] = None) -> SqlResult:
+    for event, value in _generate_sql_events(sql_request, llm_cache, stream=False):
+        if event == "result":
+            return value
+
+
+def generate_sql_stream(sql_request: SqlRequest,
+                        llm_cache: Optional[LLMResponseCache] = None) -> Iterator[Tuple[str, Any]]:
+    return _generate_sql_events(sql_request, llm_cache, stream=True)
+
+
+async def agenerate_sql(sql_request: SqlRequest, llm_cache: Optional[LLMResponseCache] = None) -> SqlResult:
+    attempts = _Attempts(sql_request, llm_cache)
+    while True:
+        # Building the prompt, fix_sql and the validation are CPU bound, they run in threads off the event loop
+        prompt = await asyncio.to_thread(attempts.next_prompt)
+        if attempts.use_cache:
+            answer = await llm_cache.aget_or_invoke(attempts.cache_key,
+                                                    lambda: _ainvoke(prompt, sql_request.model_id, attempts))
+        else:
+            answer = await _ainvoke(prompt, sql_request.model_id, attempts)
+        result = await asyncio.to_thread(attempts.check, answer)
+        if result is not None:
+            return result
+
+
+def _generate_sql_events(sql_request: SqlRequest, llm_cache: Optional[LLMResponseCache],
+                         stream: bool) -> Iterator[Tuple[str, Any]]:
+    attempts = _Attempts(sql_request, llm_cache)
+    while True:
+        prompt = attempts.next_prompt()
+        if attempts.use_cache:
+            if stream:
+                answer = llm_cache.get(attempts.cache_key)
+                if answer is not None:
+                    yield "token", answer
+                else:
+                    answer = yield from _invoke_stream(prompt, sql_request.model_id)
+                    llm_cache.put(attempts.cache_key, answer)
+            else:
+                answer = llm_cache.get_or_invoke(attempts.cache_key,
+                                                 lambda: _invoke(prompt, sql_request.model_id, attempts))
+        elif stream:
+            answer = yield from _invoke_stream(prompt, sql_request.model_id)
+        else:
+            answer = _invoke(prompt, sql_request.model_id, attempts)
+        result = attempts.check(answer)
+        if result is not None:
+            yield "result", result
+            return
+        yield "retry", attempts.previous_error
+
+
+class _Attempts:
+    def __init__(self, sql_request: SqlRequest, llm_cache: Optional[LLMResponseCache]):
+        self._sql_request = sql_request
+        self._llm_cache = llm_cache
+        self._max_attempts = int(os.environ.get("SQL_VALIDATION_MAX_ATTEMPTS", 2))
+        self._deadline = time.monotonic() + float(os.environ.get("SQL_VALIDATION_TIME_BUDGET", 30))
+        self.cache_key = None
+        # The answer to a retry or a follow-up depends on more than the question and the dataset
+        if llm_cache is not None and not sql_request.previous_sql and not sql_request.turns:
+            self.cache_key = get_cache_key(sql_request.table_name, sql_request.question, sql_request.metadata,
+                                           sql_request.sample_data, sql_request.distinct_values,
+                                           sql_request.hint, sql_request.model_id)
+        self.previous_sql = sql_request.previous_sql
+        self.previous_error = sql_request.previous_error
+        self.count = 0
+        self.model_label = model_label(sql_request.model_id)
+        if sql_request.previous_error:
+            RETRY_REQUESTS.inc()
+
+    @property
+    def use_cache(self) -> bool:
+        # A retry must reach the model, the cached answer is the one that failed
+        return self.cache_key is not None and self.count == 1
+
+    def next_prompt(self) -> str:
+        self.count += 1
+        sql_request = self._sql_request
+        with stage("prompt", sql_request.model_id):
+            prompt = get_prompt(sql_request.table_name, sql_request.question, sql_request.metadata,
+                                sql_request.sample_data, sql_request.distinct_values, sql_request.hint,
+                                self.previous_sql, self.previous_error, turns=sql_request.turns)
+        PROMPT_CHARS.observe(len(prompt), (self.model_label,))
+        PROMPT_TOKENS.observe(estimate_tokens(prompt), (self.model_label,))
+        return prompt
+
+    def accepts(self, answer: str) -> bool:
+        return self._max_attempts <= 0 or _validate(fix_sql(answer, self._sql_request.column_names),
+                                                    self._sql_request) is None
+
+    def check(self, answer: str) -> Optional[SqlResult]:
+        RESPONSE_CHARS.observe(len(answer), (self.model_label,))
+        RESPONSE_TOKENS.observe(estimate_tokens(answer), (self.model_label,))
+        with stage("fix_sql", self._sql_request.model_id):
+            sql = fix_sql(answer, self._sql_request.column_names)
+        with stage("validate", self._sql_request.model_id):
+            error = _validate(sql, self._sql_request) if self._max_attempts > 0 else None
+        if error is None:
+            if self.cache_key is not None and self.count > 1:
+                self._llm_cache.put(self.cache_key, answer)
+            return SqlResult(sql, self.count)
+        if self.count >= self._max_attempts or time.monotonic() >= self._deadline:
+            logging.info(f"SQL still fails validation after {self.count} attempts: {error}")
+            return SqlResult(sql, self.count, error)
+        logging.info(f"Generated SQL failed validation: {error}. Going to retry")
+        self.previous_sql, self.previous_error = sql, error
+        return None
+
+
+def _invoke(prompt: str, model_id: Optional[str], attempts: _Attempts) -> str:
+    with stage("llm", model_id):
+        if is_hedging_enabled():
+            return invoke_hedged(invoke_llm, prompt, model_id, attempts.accepts)
+        return invoke_llm(prompt, model_id)
+
+
+async def _ainvoke(prompt: str, model_id: Optional[str], attempts: _Attempts) -> str:
+    with stage("llm", model_id):
+        if is_hedging_enabled():
+            return await ainvoke_hedged(ainvoke_llm, prompt, model_id, attempts.accepts)
+        return await ainvoke_llm(prompt, model_id)
+
+
+def _invoke_stream(prompt: str, model_id: Optional[str]) -> Generator[Tuple[str, str], None, str]:
+    answer = ""
+    start = time.perf_counter()
+    first_token = None
+    for chunk in invoke_llm_stream(prompt, model_id):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+            STAGE_SECONDS.observe(first_token, ("llm_first_token", model_label(model_id)))
+        answer += chunk
+        yield "token", chunk
+    STAGE_SECONDS.observe(time.perf_counter() - start, ("llm", model_label(model_id)))
+    return answer
+
+
+def _validate(sql: str, sql_request: SqlRequest) -> Optional[str]:
+    if sql_request.table_name is None:
+        return None
+    return validate_sql(sql, sql_request.table_name, sql_request.columns)
@@ -0,0 +1,129 @@
+import json
+import re
+import zlib
+from typing import NamedTuple, Optional, List, Set, Mapping, Any, Tuple
+
+from dataset_context import DatasetContext, DatasetContextStore, Turn
+
+_MAX_BODY_SIZE = 20 * 1024 * 1024
+_SESSION_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+class SqlRequest(NamedTuple):
+    table_name: str
+    question: str
+    metadata: str
+    columns: List[dict]
+    sample_data: Optional[str] = None
+    distinct_values: Optional[str] = None
+    hint: Optional[str] = None
+    previous_sql: Optional[str] = None
+    previous_error: Optional[str] = None
+    model_id: Optional[str] = None
+    visitor_id: Optional[str] = None
+    token: Optional[str] = None
+    context_id: Optional[str] = None
+    session_id: Optional[str] = None
+    turns: Tuple[Turn, ...] = ()
+
+    @property
+    def column_names(self) -> Set[str]:
+        return {c["column_name"] for c in self.columns}
+
+
+def parse_sql_request(params: Mapping[str, Any], contexts: Optional[DatasetContextStore] = None) -> SqlRequest:
+    context_id = _get_str(params, "context_id")
+    session_id = _get_str(params, "session_id")
+    if session_id is not None and not _SESSION_ID.fullmatch(session_id):
+        raise ValueError("session_id must be up to 64 letters, digits, '-' or '_'")
+    previous_sql = _get_str(params, "previous_sql")
+    turns: Tuple[Turn, ...] = ()
+    if context_id is not None:
+        context = contexts.get(context_id) if contexts is not None else None
+        if context is None:
+            raise ValueError(f"context_id not found: {context_id}. Register the dataset again")
+        turns = contexts.get_turns(context_id, session_id)
+        if previous_sql is not None and turns and turns[-1].sql == previous_sql:
+            # The failed answer is sent as previous_sql, and is replaced by the retry in the conversation
+            turns = turns[:-1]
+    else:
+        context = parse_dataset_context(params)
+    return SqlRequest(
+        table_name=context.table_name,
+        question=_get_str(params, "question"),
+        metadata=context.metadata,
+        columns=context.columns,
+        sample_data=context.sample_data,
+        distinct_values=context.distinct_values,
+        hint=_get_str(params, "hint"),
+        previous_sql=previous_sql,
+        previous_error=_get_str(params, "previous_error"),
+        model_id=_get_str(params, "model_id"),
+        visitor_id=_get_str(params, "visitor_id"),
+        token=_get_str(params, "token"),
+        context_id=context_id,
+        session_id=session_id,
+        turns=turns,
+    )
+
+
+def parse_dataset_context(params: Mapping[str, Any]) -> DatasetContext:
+    metadata = _get_str(params, "metadata")
+    if metadata is None:
+        raise ValueError("metadata is required")
+    try:
+        columns = json.loads(metadata)
+    except ValueError as e:
+        raise ValueError(f"metadata is not a valid json: {e}")
+    if not isinstance(columns, list) or not all(isinstance(c, dict) and "column_name" in c for c in columns):
+        raise ValueError("metadata must be a list of columns with a column_name")
+    return DatasetContext(
+        table_name=_get_str(params, "table_name"),
+        metadata=metadata,
+        columns=columns,
+        sample_data=_get_str(params, "sample_data"),
+        distinct_values=_get_str(params, "distinct_values"),
+    )
+
+
+def read_json_body(data: bytes, content_encoding: Optional[str] = None) -> dict:
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "gzip":
+        data = _decompress(data, zlib.MAX_WBITS | 16)
+    elif encoding == "deflate":
+        data = _decompress(data, zlib.MAX_WBITS, raw_fallback=True)
+    elif encoding != "identity":
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+    try:
+        body = json.loads(data)
+    except ValueError as e:
+        raise ValueError(f"Request body is not a valid json: {e}")
+    if not isinstance(body, dict):
+        raise ValueError("Request body must be a json object")
+    return body
+
+
+def _decompress(data: bytes, wbits: int, raw_fallback: bool = False) -> bytes:
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        result = decompressor.decompress(data, _MAX_BODY_SIZE)
+    except zlib.error as e:
+        if raw_fallback:
+            # Some clients send a raw deflate stream without the zlib header
+            return _decompress(data, -zlib.MAX_WBITS)
+        raise ValueError(f"Request body is not valid gzip/deflate: {e}")
+    if decompressor.unconsumed_tail:
+        raise ValueError(f"Request body is larger than {_MAX_BODY_SIZE} bytes")
+    if not decompressor.eof:
+        raise ValueError("Request body is not valid gzip/deflate: the stream is truncated")
+    return result
+
+
+def _get_str(params: Mapping[str, Any], name: str) -> Optional[str]:
+    value = params.get(name)
+    if value is None or value == "":
+        return None
+    if not isinstance(value, str):
+        # A json body may hold the structures themselves rather than their string form
+        return json.dumps(value)
+    return value
@@ -0,0 +1,79 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import duckdb
+
+_MAX_SCHEMAS = 64
+_ONLY_SELECT = "Only a single SELECT statement is allowed"
+
+_schemas: OrderedDict[Tuple, "duckdb.DuckDBPyConnection"] = OrderedDict()
+_schemas_lock = threading.Lock()
+
+
+def validate_sql(sql: str, table_name: str, columns: List[dict]) -> Optional[str]:
+    import duckdb
+    try:
+        statements = duckdb.extract_statements(sql)
+    except duckdb.Error as e:
+        return str(e)
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        return _ONLY_SELECT
+    con = _get_schema_connection(table_name, columns)
+    # Cursors are separate connections to the same database, so concurrent requests don't share state
+    with con.cursor() as cursor:
+        try:
+            cursor.execute(f"EXPLAIN {sql}")
+            return None
+        except duckdb.Error as e:
+            return str(e)
+
+
+def _get_schema_connection(table_name: str, columns: List[dict]) -> "duckdb.DuckDBPyConnection":
+    key = (table_name, tuple((c["column_name"], c.get("column_type", "VARCHAR")) for c in columns))
+    with _schemas_lock:
+        con = _schemas.get(key)
+        if con is not None:
+            _schemas.move_to_end(key)
+            return con
+        con = _create_schema_connection(table_name, columns)
+        _schemas[key] = con
+        if len(_schemas) > _MAX_SCHEMAS:
+            # Not closed explicitly - a concurrent request may still hold a cursor on it
+            _schemas.popitem(last=False)
+        return con
+
+
+def _create_schema_connection(table_name: str, columns: List[dict]) -> "duckdb.DuckDBPyConnection":
+    import duckdb
+    con = duckdb.connect()
+    try:
+        con.execute(_create_table_sql(table_name, columns, use_types=True))
+    except duckdb.Error as e:
+        logging.info(f"Could not create the table with the metadata types: {e}. Using VARCHAR columns")
+        con.execute(_create_table_sql(table_name, columns, use_types=False))
+    # The sql comes from the LLM, so it can't read files or change the settings back
+    con.execute("SET enable_external_access = false")
+    con.execute("SET lock_configuration = true")
+    return con
+
+
+def _create_table_sql(table_name: str, columns: List[dict], use_types: bool) -> str:
+    cols = ", ".join(f'{_quote(c["column_name"])} '
+                     f'{_get_type(c.get("column_type", "VARCHAR")) if use_types else "VARCHAR"}' for c in columns)
+    return f"CREATE TABLE {_quote(table_name)} ({cols})"
+
+
+def _get_type(column_type: str) -> str:
+    # The type comes from the client: only what DuckDB parses as a type, in its own spelling, goes into the sql
+    import duckdb
+    try:
+        return str(duckdb.sqltype(column_type))
+    except (duckdb.Error, TypeError):
+        return "VARCHAR"
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
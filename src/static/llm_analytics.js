@@ -3,6 +3,8 @@ let table_loaded = false;
 let sqls = [null, null, null];
 let _visitor_id = null;
 let charts = [null, null, null];
+let contexts = [null, null, null];
+const session_id = crypto.randomUUID ? crypto.randomUUID() : Math.random().toString(36).substring(2);
 
 async function create_db(file_url, file_name) {
     const cnn = await window.duck_db.connect();
@@ -176,18 +178,18 @@ async function run_query(index) {
         init_device_fingerprint()
     }
     const my_url = new URL(window.location.origin + "/sql");
-    let token = await get_captcha_token()
-    my_url.searchParams.append("token", token);
+    let params = {};
+    params["token"] = await get_captcha_token();
     let question = document.getElementById(`question_input-${index}`).value;
     let table_name = get_table_name(index);
-    my_url.searchParams.append("visitor_id", _visitor_id);
-    my_url.searchParams.append("question", question);
-    my_url.searchParams.append("table_name", table_name);
-    my_url.searchParams.append("hint", document.getElementById("hint").value);
+    params["visitor_id"] = _visitor_id;
+    params["question"] = question;
+    params["hint"] = document.getElementById("hint").value;
+    let dataset = {};
+    dataset["table_name"] = table_name;
     let num_samples = document.getElementById("num_samples").value;
     if (num_samples > 0)
-        my_url.searchParams.append("sample_data", await db.query(
-            `SELECT * FROM ${table_name} LIMIT ${num_samples}`));
+        dataset["sample_data"] = await db.query(`SELECT * FROM ${table_name} LIMIT ${num_samples}`);
 
     let metadata;
     try {
@@ -203,7 +205,7 @@ async function run_query(index) {
         console.log("Error in SUMMARIZE: " + e.toString())
         metadata = JSON.parse(await db.query(`DESCRIBE ${table_name}`));
     }
-    my_url.searchParams.append("metadata", JSON.stringify(metadata));
+    dataset["metadata"] = JSON.stringify(metadata);
     let cols_with_distinct_values = [];
     metadata.forEach((column) => {
         if (column["approx_unique"] <= 20) {
@@ -216,11 +218,33 @@ async function run_query(index) {
             distinct_values_sql += `ARRAY_AGG(DISTINCT "${col}") AS "${col}",`
         });
         distinct_values_sql = distinct_values_sql.slice(0, -1) + ` FROM ${table_name}`;
-        my_url.searchParams.append("distinct_values", await db.query(distinct_values_sql));
+        dataset["distinct_values"] = await db.query(distinct_values_sql);
+    }
+    params["model_id"] = document.getElementById("model_id").value;
+    let COMMENT_REGEXP = "\\s*\\/\\*((?:.|\\n)*)\\*\\/"
+    let on_text = (text) => {
+        // Show the explanation comment as soon as the model has written it
+        let match = text.match(COMMENT_REGEXP);
+        if (match) {
+            set_status(index, match[1]);
+        }
+    };
+    // The dataset is sent once, follow-up questions only send its context id
+    let context_id = await get_context_id(index, dataset);
+    if (context_id != null) {
+        params["context_id"] = context_id;
+        params["session_id"] = session_id;
+    } else {
+        Object.assign(params, dataset);
+    }
+    let json_response = await post_json_stream(window.location.origin + "/sql/stream", params, on_text);
+    if (context_id != null && json_response["error"] != null && json_response["error"].includes("context_id")) {
+        // The server forgot the dataset, e.g. after a restart
+        contexts[index] = null;
+        delete params["context_id"];
+        Object.assign(params, dataset);
+        json_response = await post_json_stream(window.location.origin + "/sql/stream", params, on_text);
     }
-    my_url.searchParams.append("model_id", document.getElementById("model_id").value);
-    let response = await fetch(my_url.href);
-    let json_response = await response.json();
     if (json_response["error"] != null) {
         set_status(index, json_response["error"]);
         return null
@@ -228,7 +252,6 @@ async function run_query(index) {
 
     let sql = json_response["sql"];
 
-    let COMMENT_REGEXP = "\\s*\\/\\*((?:.|\\n)*)\\*\\/"
     let match = sql.match(COMMENT_REGEXP);
     if (match) {
         set_status(index, match[1]);
@@ -245,10 +268,15 @@ async function run_query(index) {
         console.log("Going to retry")
     }
     if (previous_error != null) {
-        my_url.searchParams.append("previous_error", previous_error);
-        my_url.searchParams.append("previous_sql", previous_sql);
-        let retry_response = await fetch(my_url.href);
-        let retry_sql = await retry_response.text();
+        // The server replaces the failed answer with the retry in the conversation of the session
+        params["previous_error"] = previous_error;
+        params["previous_sql"] = previous_sql;
+        let retry_response = await post_json(my_url.href, params);
+        if (retry_response["error"] != null) {
+            set_status(index, retry_response["error"]);
+            return null
+        }
+        let retry_sql = retry_response["sql"];
         try {
             let text_data = await db.query(retry_sql);
             show_data(index, text_data, question)
@@ -260,6 +288,61 @@ async function run_query(index) {
     return null
 }
 
+async function get_context_id(index, dataset) {
+    let key = JSON.stringify(dataset);
+    if (contexts[index] == null || contexts[index]["key"] !== key) {
+        let response = await post_json(window.location.origin + "/sql/context", dataset);
+        if (response["error"] != null) {
+            console.log("Error registering the dataset: " + response["error"]);
+            return null;
+        }
+        contexts[index] = {"key": key, "context_id": response["context_id"]};
+    }
+    return contexts[index]["context_id"];
+}
+
+async function post_json(url, params) {
+    let body = JSON.stringify(params);
+    let headers = {"Content-Type": "application/json"};
+    if (window.CompressionStream) {
+        const stream = new Blob([body]).stream().pipeThrough(new CompressionStream("gzip"));
+        body = await new Response(stream).blob();
+        headers["Content-Encoding"] = "gzip";
+    }
+    let response = await fetch(url, {method: "POST", headers: headers, body: body});
+    return await response.json();
+}
+
+async function post_json_stream(url, params, on_text) {
+    let response = await fetch(url, {method: "POST", headers: {"Content-Type": "application/json"},
+                                     body: JSON.stringify(params)});
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+    let buffer = "";
+    let text = "";
+    while (true) {
+        const {value, done} = await reader.read();
+        if (done)
+            break;
+        buffer += value;
+        let events = buffer.split("\n\n");
+        buffer = events.pop();
+        for (const event of events) {
+            let lines = event.split("\n");
+            let event_type = lines[0].substring("event: ".length);
+            let data = JSON.parse(lines[1].substring("data: ".length));
+            if (event_type === "token") {
+                text += data["text"];
+                on_text(text);
+            } else if (event_type === "retry") {
+                text = "";
+            } else {
+                return data;
+            }
+        }
+    }
+    return {"error": "The response ended unexpectedly"};
+}
+
 function show_data(index, text_data, question) {
     function _get_chart_type(question) {
         if (question.toLowerCase().includes("pie")) {
@@ -0,0 +1,167 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+from typing import Optional, List, Dict, Any
+
+_handler: Optional[RotatingFileHandler] = None
+_handler_lock = threading.Lock()
+# Only one profiler can be active in the process, the sampled requests that find it busy aren't profiled
+_profile_lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("name", "attrs", "parent", "start", "end", "children")
+
+    def __init__(self, name: str, attrs: Optional[Dict[str, Any]], parent: Optional["Span"]):
+        self.name = name
+        self.attrs = attrs
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.children: List[Span] = []
+
+    @property
+    def elapsed_ms(self) -> Optional[float]:
+        return None if self.end is None else (self.end - self.start) * 1000
+
+    def to_dict(self, origin: float) -> dict:
+        span = {"name": self.name, "start_ms": _round((self.start - origin) * 1000), "ms": _round(self.elapsed_ms)}
+        if self.attrs:
+            span.update(self.attrs)
+        if self.children:
+            # A span still running when the request ended (e.g. the losing hedge) keeps "ms": null
+            span["children"] = [c.to_dict(origin) for c in list(self.children)]
+        return span
+
+
+_current: ContextVar[Optional[Span]] = ContextVar("trace_span", default=None)
+
+
+def enter_span(name: str, attrs: Optional[Dict[str, Any]] = None) -> Optional[Span]:
+    # Outside a traced request this is a single context variable lookup
+    parent = _current.get()
+    if parent is None:
+        return None
+    span = Span(name, attrs, parent)
+    parent.children.append(span)
+    _current.set(span)
+    return span
+
+
+def exit_span(span: Optional[Span]):
+    if span is not None:
+        span.end = time.perf_counter()
+        _current.set(span.parent)
+
+
+class _SpanScope:
+    __slots__ = ("name", "attrs", "span")
+
+    def __init__(self, name: str, attrs: Dict[str, Any]):
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> Optional[Span]:
+        self.span = enter_span(self.name, self.attrs)
+        return self.span
+
+    def __exit__(self, *args):
+        exit_span(self.span)
+
+
+def span(name: str, **attrs) -> _SpanScope:
+    return _SpanScope(name, attrs)
+
+
+class Trace:
+    def __init__(self, endpoint: str, threshold_ms: float, profile: bool):
+        self.endpoint = endpoint
+        self.threshold_ms = threshold_ms
+        self.root = Span(endpoint, None, None)
+        self._previous = _current.get()
+        _current.set(self.root)
+        self._profiler: Optional[cProfile.Profile] = None
+        if profile:
+            self._start_profiler()
+
+    def finish(self, outcome: str) -> Optional[dict]:
+        self.root.end = time.perf_counter()
+        _current.set(self._previous)
+        profile = self._stop_profiler()
+        elapsed_ms = self.root.elapsed_ms
+        slow = 0 < self.threshold_ms <= elapsed_ms
+        if not slow and profile is None:
+            return None
+        record = {"time": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "endpoint": self.endpoint, "outcome": outcome,
+                  "ms": _round(elapsed_ms), "slow": slow, "spans": self.root.to_dict(self.root.start)}
+        if profile is not None:
+            record["profile"] = profile
+        if slow:
+            logging.warning(f"Slow request. Endpoint: {self.endpoint}, time: {elapsed_ms:.0f} ms")
+        try:
+            _get_handler().handle(logging.makeLogRecord({"msg": json.dumps(record), "levelno": logging.INFO,
+                                                          "levelname": "INFO"}))
+        except OSError as e:
+            logging.error(f"Could not write the slow requests log: {e}")
+        return record
+
+    def _start_profiler(self):
+        if not _profile_lock.acquire(blocking=False):
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler (a debugger, a coverage run) is already active
+            logging.info(f"Could not start the request profiler: {e}")
+            _profile_lock.release()
+            return
+        self._profiler = profiler
+
+    def _stop_profiler(self) -> Optional[str]:
+        profiler, self._profiler = self._profiler, None
+        if profiler is None:
+            return None
+        try:
+            profiler.disable()
+        finally:
+            _profile_lock.release()
+        output = io.StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats("cumulative").print_stats(int(os.environ.get("TRACE_PROFILE_TOP", 30)))
+        return output.getvalue()
+
+
+def start_trace(endpoint: str) -> Optional[Trace]:
+    threshold_ms = float(os.environ.get("TRACE_SLOW_REQUEST_MS", 0))
+    profile_rate = float(os.environ.get("TRACE_PROFILE_RATE", 0))
+    if threshold_ms <= 0 and profile_rate <= 0:
+        return None
+    return Trace(endpoint, threshold_ms, profile_rate > 0 and random.random() < profile_rate)
+
+
+def _get_handler() -> RotatingFileHandler:
+    # A handler of its own rather than a logger: the span trees are too large for the application log, and
+    # logging.config would disable a logger created before it runs
+    global _handler
+    if _handler is None:
+        with _handler_lock:
+            if _handler is None:
+                path = os.environ.get("TRACE_LOG_FILE", "slow_requests.log")
+                max_bytes = int(os.environ.get("TRACE_LOG_MAX_BYTES", 10 * 1024 * 1024))
+                backups = int(os.environ.get("TRACE_LOG_BACKUPS", 5))
+                logging.info(f"Logging slow requests to {path}")
+                _handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+    return _handler
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 3)
@@ -1,16 +1,20 @@
-import http.client
-import json
+import importlib
 import logging
 import os
+import re
+import sys
+import time
 from logging.config import fileConfig
 from pathlib import Path
-from typing import Optional
-
-from boto3.session import Session
-from botocore.config import Config
+from types import ModuleType
+from typing import Optional, Dict, Tuple, Iterator, NamedTuple, Callable, Awaitable
 
 _PROJECT_FOLDER = Path(os.path.dirname(os.path.abspath(__file__))).parent.absolute()
 
+_providers: Dict[str, "LLMProvider"] = {}
+# The modules of the built-in providers, imported on their first call so a deployment only loads the SDKs it uses
+_BACKENDS = {"gemini": "gemini_backend", "bedrock": "bedrock_backend"}
+
 
 def get_project_folder() -> str:
     return str(_PROJECT_FOLDER)
@@ -42,90 +46,87 @@ def _get_default_model_id() -> str:
     else:
         raise ValueError("No default model_id found")
 
+class ProviderError(ValueError):
+    # A failed call to the provider's API, with the HTTP status when there is one
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class LLMProvider(NamedTuple):
+    name: str
+    model_patterns: Tuple[str, ...]
+    invoke: Callable[[str, str], str]
+    invoke_stream: Callable[[str, str], Iterator[str]]
+    # Providers without an async client run invoke in a thread
+    ainvoke: Optional[Callable[[str, str], Awaitable[str]]] = None
+
+    def matches(self, model_id: str) -> bool:
+        return any(re.search(pattern, model_id) for pattern in self.model_patterns)
+
+
+def register_provider(provider: LLMProvider):
+    # A provider registered again replaces the previous one in its place
+    _providers[provider.name] = provider
+
+
+def get_provider(model_id: str) -> LLMProvider:
+    for provider in _providers.values():
+        if provider.matches(model_id):
+            return provider
+    raise ValueError(f"Unknown model_id: {model_id}")
+
+
 def invoke_llm(prompt: str, model_id: str = None) -> str:
     if model_id is None or model_id == "":
         model_id = _get_default_model_id()
-    if "gemini" in model_id:
-        return _invoke_gemini_model(prompt, model_id)
-    elif "jamba" in model_id or "claude" in model_id:
-        return _invoke_bedrock_model(prompt, model_id)
-    else:
-        raise ValueError(f"Unknown model_id: {model_id}")
-
-def _invoke_gemini_model(prompt: str, model_id: str) -> str:
-    api_key = os.environ["GEMINI_API_KEY"]
-    headers = {"Content-Type": "application/json"}
-    data = {
-        "contents": [{"parts": [{"text": prompt}]}]
-    }
-    conn = http.client.HTTPSConnection("generativelanguage.googleapis.com")
-    endpoint = f"/v1beta/models/{model_id}:generateContent?key=" + api_key
-    conn.request("POST", endpoint, body=json.dumps(data), headers=headers)
-    response = conn.getresponse()
-    result = response.read().decode()
-    if response.status == 404:
-        raise ValueError(
-            f"Model '{model_id}' not found or not supported for generateContent. "
-            "Check your model_id or use a supported Gemini model (e.g., 'gemini-2.0-pro', 'gemini-2.0-flash'). "
-            f"Response: {result}"
-        )
-    json_data = json.loads(result)
-    return json_data["candidates"][0]["content"]["parts"][0]["text"]
-
-
-def _invoke_bedrock_model(prompt: str, model_id: str) -> str:
-    logging.info(f"Going to invoke Bedrock LLM model. Model id: {model_id}")
-
-    session = Session()
-    region = os.getenv("AWS_DEFAULT_REGION", "us-east-1")
-    bedrock_client = session.client(
-        service_name="bedrock-runtime",
-        region_name=region,
-        config=Config(read_timeout=300),
-    )
-    body_dict = _format_model_body(prompt, None, model_id)
-    body_bytes = json.dumps(body_dict).encode("utf-8")
-    response = bedrock_client.invoke_model(
-        body=body_bytes,
-        modelId=model_id,
-    )
-    return _get_response_content(json.loads(response.get("body").read()), model_id)
-
-def _format_model_body(
-    prompt: str, system_prompt: Optional[str], model_id: str
-) -> dict:
-    if system_prompt is None:
-        system_prompt = "You are a SQL generator helper"
-    if "claude" in model_id:
-        body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "system": system_prompt,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt,
-                }
-            ],
-            "max_tokens": 2000,
-            "temperature": 0.0,
-        }
-    elif "jamba" in model_id:
-        body = {
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
-            ],
-            "n": 1,
-        }
-    else:
-        raise ValueError(f"Unknown model_id: {model_id}")
-    return body
+    return get_provider(model_id).invoke(prompt, model_id)
 
-
-def _get_response_content(response_json: dict, model_id: str) -> str:
-    if "claude" in model_id:
-        return response_json["content"][0]["text"]
-    elif "jamba" in model_id:
-        return response_json["choices"][0]["message"]["content"]
-    else:
-        raise ValueError(f"Unknown model_id: {model_id}")
\ No newline at end of file
+def invoke_llm_stream(prompt: str, model_id: str = None) -> Iterator[str]:
+    if model_id is None or model_id == "":
+        model_id = _get_default_model_id()
+    return get_provider(model_id).invoke_stream(prompt, model_id)
+
+def load_backend(name: str) -> ModuleType:
+    module_name = _BACKENDS[name]
+    module = sys.modules.get(module_name)
+    if module is None:
+        start = time.perf_counter()
+        module = importlib.import_module(module_name)
+        logging.info(f"Loaded LLM backend. Name: {name}, seconds: {time.perf_counter() - start:.3f}")
+    return module
+
+
+def _backend_provider(name: str, model_patterns: Tuple[str, ...]) -> LLMProvider:
+    def _invoke(prompt: str, model_id: str) -> str:
+        return load_backend(name).invoke(prompt, model_id)
+
+    def _invoke_stream(prompt: str, model_id: str) -> Iterator[str]:
+        return load_backend(name).invoke_stream(prompt, model_id)
+
+    async def _ainvoke(prompt: str, model_id: str) -> str:
+        return await load_backend(name).ainvoke(prompt, model_id)
+
+    return LLMProvider(name, model_patterns, _invoke, _invoke_stream, _ainvoke)
+
+
+def warm_up_llm_clients():
+    # Loads the backends of the default and fallback models and creates their clients
+    try:
+        model_ids = [_get_default_model_id()]
+    except ValueError:
+        logging.info("No default model configured. Skipping LLM clients warm up")
+        return
+    model_ids += [m.strip() for m in os.environ.get("LLM_FALLBACK_MODEL_IDS", "").split(",") if m.strip()]
+    for model_id in model_ids:
+        try:
+            name = get_provider(model_id).name
+            if name in _BACKENDS:
+                load_backend(name).warm_up()
+        except Exception as e:
+            logging.warning(f"LLM clients warm up failed. Model: {model_id}, error: {e}")
+    logging.info(f"LLM clients warm up done. Models: {model_ids}")
+
+
+register_provider(_backend_provider("gemini", (r"gemini",)))
+register_provider(_backend_provider("bedrock", (r"claude", r"jamba")))
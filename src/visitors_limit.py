@@ -1,45 +1,122 @@
 import logging
-from datetime import datetime
-from typing import Dict
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple, NamedTuple
+
+# A bucket is (tokens, last update time). Both the global limit and every visitor get one, so a check
+# costs O(1) instead of summing all the visits
+Bucket = Tuple[float, float]
+
+_GLOBAL_KEY = "\0global"
+
+
+class _Limits(NamedTuple):
+    max_visits: int
+    max_visitor_limit: int
+    time_period_in_seconds: float
+
+    def take(self, global_bucket: Optional[Bucket], visitor_bucket: Optional[Bucket],
+             now: float) -> Tuple[bool, Bucket, Bucket]:
+        global_tokens = self._refill(global_bucket, self.max_visits, now)
+        visitor_tokens = self._refill(visitor_bucket, self.max_visitor_limit, now)
+        allowed = global_tokens >= 1 and visitor_tokens >= 1
+        if allowed:
+            global_tokens -= 1
+            visitor_tokens -= 1
+        return allowed, (global_tokens, now), (visitor_tokens, now)
+
+    def _refill(self, bucket: Optional[Bucket], capacity: int, now: float) -> float:
+        if bucket is None:
+            return capacity
+        tokens, updated = bucket
+        return min(capacity, tokens + (now - updated) * capacity / self.time_period_in_seconds)
 
 
 class VisitorsLimit:
-    def __init__(self, max_visits: int, max_visitor_limit: int, time_period_in_seconds: int):
+    def __init__(self, max_visits: int, max_visitor_limit: int, time_period_in_seconds: int,
+                 max_visitors: int = 100000, db_file: Optional[str] = None):
         super().__init__()
-        self._visitors: Dict[str, int] = {}
-        self._visitors_limit_reached_time: Dict[str, datetime] = {}
-        self._MAX_VISITS = max_visits
-        self._MAX_VISITOR_LIMIT = max_visitor_limit
-        self._limit_reached_time = None
-        self._TIME_PERIOD_IN_SECONDS = time_period_in_seconds
+        limits = _Limits(max_visits, max_visitor_limit, time_period_in_seconds)
+        if db_file:
+            logging.info(f"Visitors limit shared through: {db_file}")
+            self._buckets = _SqliteBuckets(limits, db_file)
+        else:
+            self._buckets = _MemoryBuckets(limits, max_visitors)
 
     def visit(self, visitor_id: str) -> bool:
-        if (self._limit_reached_time is not None and
-                (datetime.now() - self._limit_reached_time).seconds > self._TIME_PERIOD_IN_SECONDS):
-            logging.info("Visitors limit reset. Time passed: %s",
-                         (datetime.now() - self._limit_reached_time).seconds)
-            self._visitors.clear()
-            self._visitors_limit_reached_time.clear()
-            _limit_reached_time = None
-        total_visits = sum(self._visitors.values())
-        if total_visits < self._MAX_VISITS:
-            if visitor_id not in self._visitors:
-                self._visitors[visitor_id] = 1
-            elif self._visitors[visitor_id] == self._MAX_VISITOR_LIMIT:
-                if visitor_id not in self._visitors_limit_reached_time:
-                    self._visitors_limit_reached_time[visitor_id] = datetime.now()
-                    return False
-                elif (datetime.now() - self._visitors_limit_reached_time[visitor_id]).seconds > self._TIME_PERIOD_IN_SECONDS:
-                    logging.info(f"Visitors limit reset for visitor {visitor_id}")
-                    self._visitors[visitor_id] = 1
-                    del self._visitors_limit_reached_time[visitor_id]
-                    return True
-                return False
-            else:
-                self._visitors[visitor_id] += 1
-            if total_visits == self._MAX_VISITS - 1:
-                logging.info("Visitors limit reached")
-                self._limit_reached_time = datetime.now()
-            return True
-        else:
-            return False
+        allowed = self._buckets.take(str(visitor_id), time.time())
+        if not allowed:
+            logging.info(f"Visitors limit reached. Visitor: {visitor_id}")
+        return allowed
+
+
+class _MemoryBuckets:
+    def __init__(self, limits: _Limits, max_visitors: int):
+        self._limits = limits
+        self._max_visitors = max_visitors
+        self._global: Optional[Bucket] = None
+        self._visitors: OrderedDict[str, Bucket] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, visitor_id: str, now: float) -> bool:
+        with self._lock:
+            allowed, self._global, visitor = self._limits.take(self._global, self._visitors.pop(visitor_id, None),
+                                                               now)
+            self._visitors[visitor_id] = visitor
+            self._evict(now)
+            return allowed
+
+    def _evict(self, now: float):
+        # Visitors are kept in last visit order. A visitor idle for a whole period has a full bucket again,
+        # so forgetting it changes nothing
+        while self._visitors:
+            visitor_id, (_, updated) = next(iter(self._visitors.items()))
+            if len(self._visitors) <= self._max_visitors and \
+                    now - updated < self._limits.time_period_in_seconds:
+                break
+            self._visitors.popitem(last=False)
+
+
+class _SqliteBuckets:
+    _EVICT_EVERY = 1000
+
+    def __init__(self, limits: _Limits, db_file: str):
+        self._limits = limits
+        self._db_file = db_file
+        self._local = threading.local()
+        self._calls = 0
+        self._connection().execute("CREATE TABLE IF NOT EXISTS visitor_buckets "
+                                   "(visitor_id TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def take(self, visitor_id: str, now: float) -> bool:
+        con = self._connection()
+        # The write lock is taken up front, so concurrent workers can't both spend the same token
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            rows = {row[0]: (row[1], row[2]) for row in con.execute(
+                "SELECT visitor_id, tokens, updated FROM visitor_buckets WHERE visitor_id IN (?, ?)",
+                (_GLOBAL_KEY, visitor_id))}
+            allowed, global_bucket, visitor_bucket = self._limits.take(rows.get(_GLOBAL_KEY), rows.get(visitor_id),
+                                                                       now)
+            con.executemany("INSERT OR REPLACE INTO visitor_buckets (visitor_id, tokens, updated) VALUES (?, ?, ?)",
+                            [(_GLOBAL_KEY, *global_bucket), (visitor_id, *visitor_bucket)])
+            self._calls += 1
+            if self._calls % self._EVICT_EVERY == 0:
+                con.execute("DELETE FROM visitor_buckets WHERE updated < ? AND visitor_id != ?",
+                            (now - self._limits.time_period_in_seconds, _GLOBAL_KEY))
+            con.execute("COMMIT")
+            return allowed
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+
+    def _connection(self) -> sqlite3.Connection:
+        con = getattr(self._local, "connection", None)
+        if con is None:
+            con = sqlite3.connect(self._db_file, timeout=10, isolation_level=None)
+            con.execute("PRAGMA journal_mode=WAL")
+            con.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = con
+        return con
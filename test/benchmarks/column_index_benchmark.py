@@ -0,0 +1,53 @@
+import argparse
+import json
+import time
+
+import sqlglot
+
+from sql_fixer import ColumnIndex, _fix_column_names, _remove_special_chars
+
+
+def _quadratic_fix_column_names(parse_tree, cols):
+    # The matching used before the column index, kept here as the baseline
+    for col_ref in parse_tree.find_all(sqlglot.expressions.Column):
+        identifier = col_ref.find(sqlglot.expressions.Identifier)
+        if identifier.name not in cols:
+            for c in cols:
+                if _remove_special_chars(c) == _remove_special_chars(identifier.name):
+                    identifier.replace(sqlglot.expressions.Identifier(this=c, quoted=identifier.quoted))
+                    break
+
+
+def _timed(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def _run(columns: int, references: int, repeat: int) -> dict:
+    column_names = frozenset(f"Column-{i} Name" for i in range(columns))
+    # Every reference is slightly off, so each one has to be looked up
+    sql = "SELECT " + ", ".join(f"column_{i * (columns // references)}_name" for i in range(references)) + \
+          " FROM my_table"
+    parse_tree = sqlglot.parse_one(sql)
+    index = ColumnIndex(column_names)
+    fuzzy_index = ColumnIndex(column_names, fuzzy=True)
+    return {
+        "columns": columns,
+        "references": references,
+        "index_build_ms": round(_timed(lambda: ColumnIndex(column_names), repeat), 3),
+        "fuzzy_index_build_ms": round(_timed(lambda: ColumnIndex(column_names, fuzzy=True), repeat), 3),
+        "quadratic_ms": round(_timed(lambda: _quadratic_fix_column_names(parse_tree.copy(), column_names), 1), 3),
+        "indexed_ms": round(_timed(lambda: _fix_column_names(parse_tree.copy(), index, {}), repeat), 3),
+        "fuzzy_indexed_ms": round(_timed(lambda: _fix_column_names(parse_tree.copy(), fuzzy_index, {}), repeat), 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare indexed and quadratic column name matching")
+    parser.add_argument("--columns", type=int, default=5000)
+    parser.add_argument("--references", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(_run(args.columns, args.references, args.repeat)))
@@ -0,0 +1,129 @@
+import argparse
+import csv
+import json
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from typing import List, Optional
+
+import duckdb
+
+from dataset_profiler import profile_dataset
+from validation_tests_utils import get_full_file_name, _fetch_dict
+
+_SOURCE = "resources/validation/sales/sales_data.csv"
+
+
+def _write_scaled_csv(source: str, path: str, scale: int) -> int:
+    # The source rows repeated scale times, with new order ids so the id column stays unique like in a real file
+    with open(source, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        rows = list(reader)
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for copy in range(scale):
+            offset = copy * len(rows)
+            writer.writerows([str(int(row[0]) + offset)] + row[1:] for row in rows)
+    return len(rows) * scale
+
+
+def _duckdb_profile(path: str) -> dict:
+    # What the validation harness and the UI do: load the file, SUMMARIZE, ARRAY_AGG(DISTINCT) and LIMIT 5
+    start = time.perf_counter()
+    with duckdb.connect(config={"enable_progress_bar": False}) as con:
+        con.execute(f"CREATE TABLE my_table AS SELECT * FROM read_csv_auto('{path}')")
+        metadata = list(_fetch_dict(con, "SUMMARIZE my_table"))
+        distinct_columns = [c["column_name"] for c in metadata if c["approx_unique"] <= 20]
+        distinct_values = {}
+        if distinct_columns:
+            distinct_values = next(_fetch_dict(con, "SELECT " + ",".join(
+                f'ARRAY_AGG(DISTINCT "{col}") AS "{col}"' for col in distinct_columns) + " FROM my_table"))
+        list(_fetch_dict(con, "SELECT * FROM my_table LIMIT 5"))
+        seconds = time.perf_counter() - start
+        # Exact counts for the accuracy, outside of the timing
+        exact = next(_fetch_dict(con, "SELECT " + ",".join(
+            f'COUNT(DISTINCT "{c["column_name"]}") AS "{c["column_name"]}"' for c in metadata) + " FROM my_table"))
+    return {"seconds": seconds, "max_rss_mb": _max_rss_mb(), "metadata": metadata,
+            "distinct_values": {k: sorted(v, key=str) for k, v in distinct_values.items()}, "exact_unique": exact}
+
+
+def _streaming_profile(path: str, sample_rate: float) -> dict:
+    start = time.perf_counter()
+    profile = profile_dataset(path, sample_rate=sample_rate, seed=1)
+    return {"seconds": time.perf_counter() - start, "max_rss_mb": _max_rss_mb(), "metadata": profile.metadata,
+            "distinct_values": {k: sorted(v, key=str) for k, v in profile.distinct_values.items()},
+            "rows": profile.rows}
+
+
+def _max_rss_mb() -> float:
+    # Every measurement runs in a new process, so this is its own peak
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _in_new_process(func, *args) -> dict:
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(func, *args).result()
+
+
+def _accuracy(result: dict, reference: dict) -> dict:
+    exact = reference["exact_unique"]
+    types = {c["column_name"]: c["column_type"] for c in reference["metadata"]}
+    errors = [abs(c["approx_unique"] - exact[c["column_name"]]) / max(exact[c["column_name"]], 1)
+              for c in result["metadata"]]
+    return {
+        "matching_types": sum(types.get(c["column_name"]) == c["column_type"] for c in result["metadata"]),
+        "columns": len(types),
+        "max_unique_error": round(max(errors), 4),
+        "mean_unique_error": round(sum(errors) / len(errors), 4),
+        "same_distinct_values": result["distinct_values"] == {
+            k: [v for v in values if v is not None] for k, values in reference["distinct_values"].items()},
+    }
+
+
+def _summary(result: dict, reference: Optional[dict] = None) -> dict:
+    summary = {"seconds": round(result["seconds"], 3), "max_rss_mb": result["max_rss_mb"]}
+    if reference is not None:
+        summary["speedup"] = round(reference["seconds"] / result["seconds"], 2)
+        summary.update(_accuracy(result, reference))
+    return summary
+
+
+def _run(path: str, rows: int, sample_rates: List[float]) -> dict:
+    reference = _in_new_process(_duckdb_profile, path)
+    exact = reference["exact_unique"]
+    duckdb_errors = [abs(c["approx_unique"] - exact[c["column_name"]]) / max(exact[c["column_name"]], 1)
+                     for c in reference["metadata"]]
+    result = {"rows": rows, "file_mb": round(os.path.getsize(path) / 1024 / 1024, 1),
+              "duckdb": {**_summary(reference), "max_unique_error": round(max(duckdb_errors), 4)}}
+    for sample_rate in sample_rates:
+        profiled = _in_new_process(_streaming_profile, path, sample_rate)
+        result[f"profiler_{sample_rate}"] = {**_summary(profiled, reference), "estimated_rows": profiled["rows"]}
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Compare the streaming dataset profiler with DuckDB SUMMARIZE on a scaled sales file")
+    parser.add_argument("--scale", type=int, default=1000, help="Copies of sales_data.csv (10k rows each)")
+    parser.add_argument("--sample-rates", default="1,0.1,0.01",
+                        help="Comma separated sample rates of the profiler, 1 reads the whole file")
+    parser.add_argument("--file", help="Profile this file instead of a scaled sales file")
+    parser.add_argument("--output", help="Also write the results to this file")
+    args = parser.parse_args()
+    rates = [float(r) for r in args.sample_rates.split(",")]
+    if args.file:
+        output = _run(args.file, 0, rates)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            scaled = os.path.join(tmp, "sales_data.csv")
+            count = _write_scaled_csv(get_full_file_name(_SOURCE), scaled, args.scale)
+            output = _run(scaled, count, rates)
+    print(json.dumps(output))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
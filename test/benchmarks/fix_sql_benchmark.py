@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, List, NamedTuple, FrozenSet, Dict, Any
+
+from sql_fixer import _fix_sql, _convert_to_duckdb, _verify_columns_and_add_aliases, _fix_column_names, \
+    get_column_index
+
+_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "resources", "fix_sql", "corpus.json")
+
+
+class Case(NamedTuple):
+    name: str
+    sql: str
+    column_names: FrozenSet[str]
+
+
+def load_corpus(file: str = _CORPUS) -> List[Case]:
+    with open(file) as f:
+        corpus = json.load(f)
+    cases = []
+    for case in corpus["cases"]:
+        if case["schema"] == "wide":
+            cases.append(_wide_case(case["name"], case["wide_columns"], case["references"]))
+        else:
+            cases.append(Case(case["name"], case["sql"], frozenset(corpus["schemas"][case["schema"]])))
+    return cases
+
+
+def _wide_case(name: str, columns: int, references: int) -> Case:
+    # A wide table the model refers to with the usual mistakes: lower case and underscores instead of spaces
+    column_names = frozenset(f"Metric {i} Value" for i in range(columns))
+    step = max(1, columns // references)
+    select = [f"SUM(metric_{i}_value)" if i % 2 else f"metric_{i}_value" for i in range(0, columns, step)]
+    group_by = [f"metric_{i}_value" for i in range(0, columns, step) if i % 2 == 0]
+    sql = f"SELECT {', '.join(select)} FROM my_table WHERE metric_0_value > 0 " \
+          f"GROUP BY {', '.join(group_by)} ORDER BY metric_0_value"
+    return Case(name, sql, column_names)
+
+
+def _unfenced(sql: str) -> str:
+    # The same unwrapping _fix_sql does before parsing
+    return sql[7:-3] if sql.startswith("```sql\n") and sql.endswith("```") else sql
+
+
+def _measure(func: Callable[[Any], Any], make_input: Callable[[], Any], count: int, rounds: int) -> dict:
+    # The inputs are made before the timing, the fixes change the parse tree they get in place.
+    # The best round is kept, the others are mostly noise from the machine
+    best = float("inf")
+    for _ in range(rounds):
+        inputs = [make_input() for _ in range(count)]
+        start = time.perf_counter()
+        for value in inputs:
+            func(value)
+        best = min(best, (time.perf_counter() - start) / count)
+    value = make_input()
+    tracemalloc.start()
+    func(value)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"ops_per_sec": round(1 / best, 1), "us_per_op": round(best * 1e6, 1),
+            "alloc_peak_kb": round(peak / 1024, 1)}
+
+
+def _run_case(case: Case, count: int, rounds: int) -> Dict[str, dict]:
+    sql = _unfenced(case.sql)
+    index = get_column_index(case.column_names)
+    parse_tree = _convert_to_duckdb(sql)
+    return {
+        # fix_sql is cached by SQL and columns, the uncached function is what every new answer costs
+        "fix_sql": _measure(lambda s: _fix_sql.__wrapped__(s, index), lambda: case.sql, count, rounds),
+        "convert_to_duckdb": _measure(_convert_to_duckdb, lambda: sql, count, rounds),
+        # Includes fix_column_names
+        "verify_columns_and_add_aliases": _measure(lambda tree: _verify_columns_and_add_aliases(tree, index),
+                                                   parse_tree.copy, count, rounds),
+        "fix_column_names": _measure(lambda tree: _fix_column_names(tree, index, {}), parse_tree.copy, count, rounds),
+    }
+
+
+def _compare(result: dict, baseline: dict, max_regression: float) -> List[str]:
+    # Adds the change in ops/sec against the baseline, and returns the measurements that regressed too much
+    regressions = []
+    for name, stages in result["cases"].items():
+        for stage, measurement in stages.items():
+            before = baseline["cases"].get(name, {}).get(stage)
+            if before is None:
+                continue
+            measurement["ops_change"] = round(measurement["ops_per_sec"] / before["ops_per_sec"] - 1, 3)
+            if max_regression > 0 and measurement["ops_change"] < -max_regression:
+                regressions.append(f"{name}.{stage}: {measurement['ops_change']:+.1%}")
+    return regressions
+
+
+def _run(cases: List[Case], count: int, rounds: int) -> dict:
+    return {"count": count, "rounds": rounds, "cases": {case.name: _run_case(case, count, rounds) for case in cases}}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure fix_sql and its steps on a corpus of LLM generated SQL")
+    parser.add_argument("--corpus", default=_CORPUS)
+    parser.add_argument("--cases", help="Comma separated case names, all the corpus by default")
+    parser.add_argument("--count", type=int, default=50, help="Operations per round")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--output", help="Also write the results to this file")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.25,
+                        help="Fail when ops/sec drops by more than this fraction of the baseline (0 to only report)")
+    args = parser.parse_args()
+    corpus = load_corpus(args.corpus)
+    if args.cases:
+        names = set(args.cases.split(","))
+        corpus = [case for case in corpus if case.name in names]
+    result = _run(corpus, args.count, args.rounds)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = _compare(result, json.load(f), args.max_regression)
+    print(json.dumps(result))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if regressions:
+        print("Regressions: " + "; ".join(regressions), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+from typing import List, Optional, Dict
+
+import httpx
+
+from fake_llm_server import FakeLLMServer, parse_latency
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+_MODEL_IDS = {"gemini": "gemini-2.0-flash", "bedrock": "us.anthropic.claude-haiku-4-5-20251001-v1:0"}
+_ANSWER = "SELECT customer, SUM(revenue) AS total_revenue FROM my_table GROUP BY customer ORDER BY total_revenue DESC"
+_CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _metadata(columns: int) -> str:
+    metadata = [{"column_name": "customer", "column_type": "VARCHAR", "approx_unique": 100},
+                {"column_name": "revenue", "column_type": "DOUBLE", "approx_unique": 1000}]
+    metadata += [{"column_name": f"col_{i}", "column_type": "INTEGER", "approx_unique": i, "min": "0", "max": str(i)}
+                 for i in range(max(0, columns - 2))]
+    return json.dumps(metadata)
+
+
+def _start_server(server: str, port: int, fake_url: str, provider: str, workers: int,
+                  max_concurrency: int) -> subprocess.Popen:
+    env = {**os.environ,
+           # The server talks to the fake for both providers, and no env file is loaded on start
+           "ENV": "load-benchmark", "MODEL_ID": _MODEL_IDS[provider],
+           "GEMINI_API_URL": fake_url, "GEMINI_API_KEY": "key", "GEMINI_MAX_CONNECTIONS": str(max_concurrency),
+           "BEDROCK_ENDPOINT_URL": fake_url, "AWS_ACCESS_KEY_ID": "key-id", "AWS_SECRET_ACCESS_KEY": "secret",
+           "AWS_DEFAULT_REGION": "us-east-1", "BEDROCK_MAX_POOL_CONNECTIONS": str(max_concurrency),
+           "VISITORS_LIMIT_TOTAL": str(10 ** 9), "VISITORS_LIMIT_PER_VISITOR": str(10 ** 9),
+           "APP_PORT": str(port)}
+    if server == "asgi":
+        command = [sys.executable, "-m", "uvicorn", "asgi:app", "--port", str(port), "--log-level", "warning",
+                   "--workers", str(workers)]
+    else:
+        command = [sys.executable, "app.py"]
+    process = subprocess.Popen(command, cwd=os.path.join(_ROOT, "src"), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The server exited with code {process.returncode}")
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/ping", timeout=1).status_code == 200:
+                return process
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("The server didn't start within 30 seconds")
+
+
+def _process_ids(pid: int) -> List[int]:
+    # The server and its workers
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                pids += _process_ids(int(child))
+    except OSError:
+        pass
+    return pids
+
+
+def _cpu_seconds(pid: int) -> Optional[float]:
+    total = 0
+    try:
+        for p in _process_ids(pid):
+            with open(f"/proc/{p}/stat") as f:
+                # The command may contain spaces, the fields after it are fixed: utime and stime are 14 and 15
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += int(fields[11]) + int(fields[12])
+    except OSError:
+        return None
+    return total / _CLOCK_TICKS
+
+
+def _rss_mb(pid: int) -> Optional[float]:
+    total = 0
+    try:
+        for p in _process_ids(pid):
+            with open(f"/proc/{p}/status") as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    except (OSError, StopIteration):
+        return None
+    return round(total / 1024, 1)
+
+
+async def _drive(url: str, concurrency: int, requests: int, metadata: str, level: int,
+                 same_question: bool) -> Dict:
+    latencies: List[float] = []
+    errors = 0
+    next_request = 0
+
+    async def _worker(client: httpx.AsyncClient):
+        nonlocal next_request, errors
+        while next_request < requests:
+            index = next_request
+            next_request += 1
+            question = "top customers by revenue" if same_question else f"top customers by revenue #{level}-{index}"
+            start = time.perf_counter()
+            try:
+                response = await client.post(url, json={"visitor_id": f"load-{index % 100}", "table_name": "my_table",
+                                                        "question": question, "metadata": metadata})
+                ok = response.status_code == 200 and "error" not in response.json()
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += 0 if ok else 1
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[_worker(client) for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {"requests": requests, "errors": errors, "seconds": round(elapsed, 3),
+            "rps": round(requests / elapsed, 1),
+            "p50_ms": _percentile(latencies, 50), "p95_ms": _percentile(latencies, 95),
+            "p99_ms": _percentile(latencies, 99)}
+
+
+def _percentile(sorted_values: List[float], percentile: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, int(len(sorted_values) * percentile / 100 + 0.5) - 1))
+    return round(sorted_values[index] * 1000, 1)
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _compare(result: dict, baseline: dict, max_regression: float) -> List[str]:
+    # Adds the change against the baseline to every level, and returns the levels that regressed too much
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in result["levels"]:
+        before = baseline_levels.get(level["concurrency"])
+        if before is None:
+            continue
+        level["rps_change"] = round(level["rps"] / before["rps"] - 1, 3)
+        level["p95_change"] = round(level["p95_ms"] / before["p95_ms"] - 1, 3)
+        if max_regression > 0 and (level["rps_change"] < -max_regression or level["p95_change"] > max_regression):
+            regressions.append(f"concurrency {level['concurrency']}: rps {level['rps_change']:+.1%}, "
+                               f"p95 {level['p95_change']:+.1%}")
+    return regressions
+
+
+def _run(args) -> dict:
+    levels = [int(c) for c in args.concurrency.split(",")]
+    metadata = _metadata(args.columns)
+    with FakeLLMServer(args.answer, latency=parse_latency(args.latency), keep_requests=False) as fake:
+        port = _free_port()
+        process = _start_server(args.server, port, fake.url, args.provider, args.workers, max(levels))
+        try:
+            url = f"http://127.0.0.1:{port}/sql"
+            # Warm up the connections and the caches that every request uses
+            asyncio.run(_drive(url, min(levels), args.warmup, metadata, -1, args.same_question))
+            rss_start = _rss_mb(process.pid)
+            results = []
+            for i, concurrency in enumerate(levels):
+                cpu_start = _cpu_seconds(process.pid)
+                level = asyncio.run(_drive(url, concurrency, args.requests, metadata, i, args.same_question))
+                cpu_end = _cpu_seconds(process.pid)
+                rss = _rss_mb(process.pid)
+                level = {"concurrency": concurrency, **level,
+                         "cpu_ms_per_request": None if cpu_start is None else
+                         round((cpu_end - cpu_start) * 1000 / args.requests, 3),
+                         "rss_mb": rss,
+                         "rss_growth_mb": None if rss is None else round(rss - rss_start, 1)}
+                results.append(level)
+        finally:
+            process.terminate()
+            process.wait(10)
+        llm_requests = fake.request_count
+    return {"server": args.server, "provider": args.provider, "latency": args.latency, "columns": args.columns,
+            "workers": args.workers, "commit": _commit(), "python": platform.python_version(),
+            "llm_requests": llm_requests, "levels": results}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the /sql throughput against a fake LLM provider")
+    parser.add_argument("--server", choices=["asgi", "flask"], default="asgi")
+    parser.add_argument("--provider", choices=list(_MODEL_IDS), default="gemini")
+    parser.add_argument("--latency", default="lognormal:0.5,0.4",
+                        help='LLM latency in seconds: "0.5", "uniform:0.2,1" or "lognormal:<median>,<sigma>"')
+    parser.add_argument("--concurrency", default="1,4,16,64", help="Comma separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per concurrency level")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--columns", type=int, default=20, help="Columns in the metadata of every request")
+    parser.add_argument("--answer", default=_ANSWER)
+    parser.add_argument("--same-question", action="store_true", help="Repeat one question, so the LLM cache answers")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--output", help="Also write the results to this file")
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0,
+                        help="Fail when rps drops or p95 grows by more than this fraction of the baseline")
+    args = parser.parse_args()
+    result = _run(args)
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = _compare(result, json.load(f), args.max_regression)
+    print(json.dumps(result))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if regressions:
+        print("Regressions: " + "; ".join(regressions), file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,47 @@
+import argparse
+import json
+
+import duckdb
+
+from prompt_encoding import estimate_tokens
+from question_to_sql import get_prompt
+from validation_tests_utils import get_full_file_name, _fetch_dict, _data_to_str
+
+_FILES = [
+    "resources/validation/sales/sales_data.csv",
+    "resources/validation/countries/countries.csv",
+    "resources/validation/students/StudentPerformanceFactors.csv",
+]
+
+
+def _prompt_data(file: str):
+    # The same data the validation harness sends
+    with duckdb.connect() as con:
+        con.execute(f"CREATE TABLE my_table AS SELECT * FROM read_csv_auto('{get_full_file_name(file)}')")
+        metadata = list(_fetch_dict(con, "SUMMARIZE my_table"))
+        distinct_values_cols = [c["column_name"] for c in metadata if c["approx_unique"] <= 20]
+        distinct_values = None
+        if distinct_values_cols:
+            distinct_values = _data_to_str(_fetch_dict(con, "SELECT " + ",".join(
+                f'ARRAY_AGG(DISTINCT "{col}") AS "{col}"' for col in distinct_values_cols) + " FROM my_table"))
+        sample_data = list(_fetch_dict(con, "SELECT * FROM my_table LIMIT 5"))
+        return _data_to_str(metadata), _data_to_str(sample_data), distinct_values
+
+
+def _run(file: str) -> dict:
+    metadata, sample_data, distinct_values = _prompt_data(file)
+    raw = get_prompt("my_table", "What is the total?", metadata, sample_data, distinct_values, compact=False)
+    compact = get_prompt("my_table", "What is the total?", metadata, sample_data, distinct_values, compact=True)
+    return {
+        "file": file,
+        "raw_tokens": estimate_tokens(raw),
+        "compact_tokens": estimate_tokens(compact),
+        "reduction": round(1 - estimate_tokens(compact) / estimate_tokens(raw), 3),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare raw and compact prompt sizes on the validation data")
+    parser.add_argument("--file", action="append", help="CSV file, relative to the test folder")
+    args = parser.parse_args()
+    print(json.dumps([_run(f) for f in args.file or _FILES]))
@@ -0,0 +1,73 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import duckdb
+
+from benchmarks.dataset_profiler_benchmark import _write_scaled_csv
+from query_cache import QueryResultCache
+from server_datasets import DatasetServer
+from validation_tests_utils import get_full_file_name
+
+_QUERIES = [
+    'SELECT "Region", SUM("Total Sales") AS total FROM sales GROUP BY 1 ORDER BY 2 DESC',
+    'SELECT "Product Name", AVG("Quantity") AS quantity FROM sales WHERE "Payment Method" = \'PayPal\' GROUP BY 1',
+    'SELECT DATE_TRUNC(\'month\', "Order Date") AS month, COUNT(DISTINCT "Customer ID") FROM sales GROUP BY 1',
+    'SELECT * FROM sales WHERE "Total Sales" > 900 ORDER BY "Order ID" LIMIT 1000',
+]
+
+
+def _run_query(server: DatasetServer, sql: str) -> float:
+    start = time.perf_counter()
+    with server.query(sql) as result:
+        for _ in result.pages(1000):
+            pass
+    return time.perf_counter() - start
+
+
+def _run(server: DatasetServer, concurrency: int, count: int) -> dict:
+    queries = [_QUERIES[i % len(_QUERIES)] for i in range(count)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(lambda sql: _run_query(server, sql), queries))
+    seconds = time.perf_counter() - start
+    return {"concurrency": concurrency, "queries_per_sec": round(count / seconds, 2),
+            "p50_ms": round(latencies[len(latencies) // 2] * 1000, 1),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 1)}
+
+
+def _benchmark(directory: str, pool_sizes: List[int], count: int) -> List[dict]:
+    results = []
+    for pool_size in pool_sizes:
+        server = DatasetServer(directory, pool_size=pool_size, timeout_seconds=600, max_rows=1000000)
+        # The first query reads the Parquet footer and fills DuckDB's cache
+        _run_query(server, _QUERIES[0])
+        results.append({"pool_size": pool_size, **_run(server, pool_size, count)})
+    return results
+
+
+def _benchmark_cache(directory: str, count: int) -> dict:
+    # The same queries with the result cache: the first run of each query fills it, the others are hits
+    server = DatasetServer(directory, pool_size=1, timeout_seconds=600, max_rows=1000000, cache=QueryResultCache())
+    return {**_run(server, 1, count), "result_cache": server.cache.stats()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Concurrent queries on a server dataset by connection pool size")
+    parser.add_argument("--scale", type=int, default=100, help="Copies of sales_data.csv (10k rows each)")
+    parser.add_argument("--pool-sizes", default=f"1,2,4,{os.cpu_count()}")
+    parser.add_argument("--queries", type=int, default=40)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        scaled = os.path.join(tmp, "sales.csv")
+        rows = _write_scaled_csv(get_full_file_name("resources/validation/sales/sales_data.csv"), scaled, args.scale)
+        with duckdb.connect() as con:
+            con.execute(f"COPY (SELECT * FROM read_csv_auto('{scaled}')) TO '{tmp}/sales.parquet' (FORMAT parquet)")
+        os.remove(scaled)
+        pool_sizes = sorted({int(p) for p in args.pool_sizes.split(",")})
+        print(json.dumps({"rows": rows, "cpus": os.cpu_count(), "results": _benchmark(tmp, pool_sizes, args.queries),
+                          "cached": _benchmark_cache(tmp, args.queries)}))
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from typing import List
+
+from fake_llm_server import FakeLLMServer
+
+_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+_MODEL_IDS = {"gemini": "gemini-2.0-flash", "bedrock": "us.anthropic.claude-haiku-4-5-20251001-v1:0"}
+_ANSWER = "SELECT customer, SUM(revenue) AS total_revenue FROM my_table GROUP BY customer ORDER BY total_revenue DESC"
+_METADATA = json.dumps([{"column_name": "customer", "column_type": "VARCHAR", "approx_unique": 100},
+                        {"column_name": "revenue", "column_type": "DOUBLE", "approx_unique": 1000}])
+# provider, startup warm up, the SDKs and sqlglot imported with the app like before the backends were lazy
+_CONFIGURATIONS = {
+    "gemini": ("gemini", False, False),
+    "gemini_warm_up": ("gemini", True, False),
+    "bedrock": ("bedrock", False, False),
+    "bedrock_warm_up": ("bedrock", True, False),
+    "eager": ("gemini", False, True),
+}
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024, 1)
+    except OSError:
+        return _max_rss_mb()
+
+
+def _max_rss_mb() -> float:
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def _sql_seconds(client, question: str) -> float:
+    start = time.perf_counter()
+    response = client.post("/sql", json={"visitor_id": "startup", "table_name": "my_table", "question": question,
+                                         "metadata": _METADATA})
+    if response.status_code != 200 or "sql" not in response.json:
+        raise RuntimeError(f"The /sql request failed: {response.text}")
+    return time.perf_counter() - start
+
+
+def _measure(configuration: str) -> dict:
+    # Runs in a new process, the same work as a container that starts and gets its first requests
+    provider, warm_up, eager = _CONFIGURATIONS[configuration]
+    start = time.perf_counter()
+    if eager:
+        import boto3, sqlglot, sql_fixer  # noqa: F401
+    import app
+    result = {"import_seconds": time.perf_counter() - start, "import_rss_mb": _rss_mb()}
+    if warm_up:
+        # The server runs it in a thread next to the first requests, here it's timed on its own
+        start = time.perf_counter()
+        app._warm_up()
+        result["warm_up_seconds"] = time.perf_counter() - start
+    client = app.app.test_client()
+    result["first_sql_seconds"] = _sql_seconds(client, "top customers by revenue")
+    result["second_sql_seconds"] = _sql_seconds(client, "customers with the lowest revenue")
+    result["loaded"] = sorted(m for m in ("boto3", "sqlglot", "duckdb", "httpx", "gemini_backend", "bedrock_backend")
+                              if m in sys.modules)
+    return {**result, "rss_mb": _rss_mb(), "max_rss_mb": _max_rss_mb()}
+
+
+def _run(configuration: str, fake_url: str) -> dict:
+    provider = _CONFIGURATIONS[configuration][0]
+    env = {**os.environ, "ENV": "startup-benchmark", "MODEL_ID": _MODEL_IDS[provider],
+           "GEMINI_API_URL": fake_url, "GEMINI_API_KEY": "key",
+           "BEDROCK_ENDPOINT_URL": fake_url, "AWS_ACCESS_KEY_ID": "key-id", "AWS_SECRET_ACCESS_KEY": "secret",
+           "AWS_DEFAULT_REGION": "us-east-1", "VISITORS_LIMIT_TOTAL": str(10 ** 9),
+           "VISITORS_LIMIT_PER_VISITOR": str(10 ** 9), "SERVER_DATASETS_DIR": "",
+           "PYTHONPATH": os.pathsep.join([os.path.join(_ROOT, "src"), os.path.join(_ROOT, "test")])}
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--measure", configuration],
+                            cwd=os.path.join(_ROOT, "src"), env=env, capture_output=True, text=True, check=True)
+    process_seconds = time.perf_counter() - start
+    result = json.loads(output.stdout.splitlines()[-1])
+    return {**{k: round(v, 4) if isinstance(v, float) else v for k, v in result.items()},
+            "process_seconds": round(process_seconds, 3)}
+
+
+def _median(results: List[dict]) -> dict:
+    median = dict(results[0])
+    for key, value in results[0].items():
+        if isinstance(value, (int, float)):
+            median[key] = sorted(r[key] for r in results)[len(results) // 2]
+    return median
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import time, first /sql latency and RSS of the app by configuration")
+    parser.add_argument("--configurations", default=",".join(_CONFIGURATIONS))
+    parser.add_argument("--runs", type=int, default=5, help="New processes per configuration, the median is reported")
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        print(json.dumps(_measure(args.measure)))
+    else:
+        with FakeLLMServer(_ANSWER) as server:
+            print(json.dumps({name: _median([_run(name, server.url) for _ in range(args.runs)])
+                              for name in args.configurations.split(",")}))
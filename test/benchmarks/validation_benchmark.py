@@ -0,0 +1,43 @@
+import argparse
+import json
+import os
+import time
+
+from utils import init_env_from_file
+from validation_tests_utils import get_validation_cases, run_tests, _stats, _tests_log, VALIDATION_SUITES
+
+_MODEL_IDS = ["gemini-2.0-flash", "us.anthropic.claude-haiku-4-5-20251001-v1:0"]
+
+
+def _run(model_ids, groups, processes: int) -> dict:
+    cases = get_validation_cases(model_ids, groups)
+    start = time.perf_counter()
+    run_tests(cases, processes)
+    return {
+        "mode": os.environ.get("VALIDATION_LLM", "replay"),
+        "processes": processes,
+        "tests": len(cases),
+        "seconds": round(time.perf_counter() - start, 3),
+        "stats": dict(_stats),
+        "failures": [f"{log['group']}/{log['name']} ({log['model_id']})" for log in _tests_log
+                     if log.get("error") or log.get("verification_error") or log.get("retry_sql_error")],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the validation suite, offline with --mode replay")
+    parser.add_argument("--mode", choices=["live", "record", "replay"], default="replay")
+    parser.add_argument("--models", default=",".join(_MODEL_IDS), help="Comma separated model ids")
+    parser.add_argument("--groups", default=",".join(g for g, _, _ in VALIDATION_SUITES))
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--output", help="Also write the results with the log of every failed test to this file")
+    args = parser.parse_args()
+    os.environ["VALIDATION_LLM"] = args.mode
+    if args.mode != "replay":
+        init_env_from_file("aws.env.list")
+        init_env_from_file("google.env.list")
+    result = _run(args.models.split(","), args.groups.split(","), args.processes)
+    print(json.dumps(result))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({**result, "tests_log": _tests_log}, f, indent=2)
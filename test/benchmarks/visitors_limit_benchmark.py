@@ -0,0 +1,39 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from visitors_limit import VisitorsLimit
+
+
+def _run(backend: str, visitors: int, checks: int) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = os.path.join(tmp_dir, "visitors.db") if backend == "sqlite" else None
+        vl = VisitorsLimit(10 ** 12, 20, 3600, max_visitors=visitors, db_file=db_file)
+        start = time.perf_counter()
+        for visitor_id in range(visitors):
+            vl.visit(str(visitor_id))
+        fill_seconds = time.perf_counter() - start
+        visitor_ids = [str(random.randrange(visitors)) for _ in range(checks)]
+        start = time.perf_counter()
+        for visitor_id in visitor_ids:
+            vl.visit(visitor_id)
+        check_seconds = time.perf_counter() - start
+    return {
+        "backend": backend,
+        "visitors": visitors,
+        "checks": checks,
+        "fill_seconds": round(fill_seconds, 3),
+        "checks_per_second": round(checks / check_seconds),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure VisitorsLimit checks per second")
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--visitors", type=int, default=1000000)
+    parser.add_argument("--checks", type=int, default=1000000)
+    args = parser.parse_args()
+    print(json.dumps(_run(args.backend, args.visitors, args.checks)))
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import math
+import random
+import socket
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Optional, Iterator, Callable
+
+from utils import LLMProvider
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    # "0.5" (fixed seconds), "uniform:0.2,1" (min, max) or "lognormal:0.5,0.4" (median, sigma)
+    kind, _, args = spec.partition(":") if ":" in spec else ("fixed", "", spec)
+    values = [float(v) for v in args.split(",")]
+    if kind == "fixed" and len(values) == 1:
+        return lambda: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal" and len(values) == 2:
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Invalid latency: {spec}")
+
+
+class FakeLLMServer:
+    def __init__(self, answer: str = "SELECT 1 AS col", chunk_size: int = 5,
+                 latency: Optional[Callable[[], float]] = None, port: int = 0, keep_requests: bool = True):
+        self.answer = answer
+        self.chunk_size = chunk_size
+        # Seconds before the answer (the first chunk when streaming), drawn for every request
+        self.latency = latency
+        # A load test sends too many requests to keep them all
+        self.keep_requests = keep_requests
+        self.request_count = 0
+        self.requests: List[dict] = []
+        self.connections = 0
+        self.close_after_response = False
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._create_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def __enter__(self) -> "FakeLLMServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _create_handler(self):
+        fake = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # The headers and the body are separate writes, with Nagle the body waits for a delayed ACK
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                fake.connections += 1
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                fake.request_count += 1
+                if fake.keep_requests:
+                    fake.requests.append({"path": self.path, "headers": dict(self.headers),
+                                          "body": json.loads(body) if body else None})
+                if fake.latency is not None:
+                    time.sleep(fake.latency())
+                if self.path.startswith("/model/") and self.path.endswith("/invoke"):
+                    self._send_json({"content": [{"type": "text", "text": fake.answer}]})
+                elif ":streamGenerateContent" in self.path:
+                    self._send_gemini_stream()
+                elif ":generateContent" in self.path:
+                    self._send_json({"candidates": [{"content": {"parts": [{"text": fake.answer}]}}]})
+                else:
+                    self._send_json({"error": "not found"}, status=404)
+                if fake.close_after_response:
+                    # Drop the connection without telling the client, like an idle timeout on the server side
+                    self.close_connection = True
+
+            def _send_gemini_stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                for i in range(0, len(fake.answer), fake.chunk_size):
+                    event = {"candidates": [{"content": {"parts": [{"text": fake.answer[i:i + fake.chunk_size]}]}}]}
+                    self._write_chunk(f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8"))
+                self._write_chunk(b"")
+
+            def _write_chunk(self, data: bytes):
+                self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            def _send_json(self, data: dict, status: int = 200):
+                payload = json.dumps(data).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+        return _Handler
+
+
+class FakeLLMProvider:
+    # A provider for the registry that answers in process, with an optional delay and error
+    def __init__(self, name: str, answer: str = "SELECT 1 AS col", delay: float = 0.0,
+                 error: Optional[Exception] = None):
+        self.name = name
+        self.answer = answer
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+
+    @property
+    def provider(self) -> LLMProvider:
+        return LLMProvider(self.name, (f"^{self.name}-",), self.invoke, self.invoke_stream, self.ainvoke)
+
+    def invoke(self, prompt: str, model_id: str) -> str:
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+    def invoke_stream(self, prompt: str, model_id: str) -> Iterator[str]:
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        for word in self.answer.split(" "):
+            yield word + " "
+
+    async def ainvoke(self, prompt: str, model_id: str) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None:
+            raise self.error
+        return self.answer
@@ -1,12 +1,54 @@
+import asyncio
+import gzip
+import json
+import logging
 import re
 import string
+import zlib
+import shutil
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from time import sleep
 
 import pytest
 
-from app import app
-from sql_fixer import fix_sql
-from utils import get_project_folder, init_logging, invoke_llm
+import duckdb
+
+import httpx
+
+from app import app, dataset_contexts
+from benchmarks.fix_sql_benchmark import load_corpus
+from asgi import app as asgi_app
+from async_llm import ainvoke_llm
+from bedrock_backend import get_bedrock_client
+from dataset_context import DatasetContext, DatasetContextStore
+import dataset_profiler
+from dataset_profiler import profile_dataset, HyperLogLog
+from fake_llm_server import FakeLLMServer, FakeLLMProvider
+from hedging import get_hedge_delay, hedging_stats, _record_latency
+from http_pool import HTTPConnectionPool
+from llm_cache import LLMResponseCache, get_cache_key
+from llm_router import LLMRouter
+from query_cache import QueryResultCache, CachedResult, canonicalize_sql, encode_rows
+from metrics import Histogram, Counter, RETRY_REQUESTS, STAGE_SECONDS
+from prompt_encoding import encode_prompt_data
+from question_to_sql import get_prompt
+from sql_fixer import fix_sql, _fix_sql, ColumnIndex, get_column_index
+from sql_batch import _get_provider_limit
+from sql_generator import generate_sql, agenerate_sql
+from sql_request import parse_sql_request, read_json_body
+from sql_validator import validate_sql
+from server_datasets import DatasetServer, QueryError
+import tracing
+from tracing import span, start_trace
+import utils
+import validation_tests_utils
+from utils import get_project_folder, init_logging, invoke_llm, invoke_llm_stream, get_provider, ProviderError
 from visitors_limit import VisitorsLimit
 
 
@@ -77,6 +119,15 @@ HAVING COUNT(DISTINCT "region-code") > 0""")
         assert (fix_sql('SELECT * FROM my_table ORDER BY "customer-name" LIMIT 5')
                 == 'SELECT * FROM my_table ORDER BY "customer-name" NULLS FIRST LIMIT 5')
 
+    def test_order_by_position(self):
+        assert (fix_sql('SELECT region, COUNT(*) FROM my_table GROUP BY region ORDER BY 2 DESC')
+                == 'SELECT region, COUNT(*) AS count_star_ FROM my_table GROUP BY region ORDER BY 2 DESC')
+
+    def test_benchmark_corpus(self):
+        # Every SQL the fix_sql benchmark measures must go through the fixes
+        for case in load_corpus():
+            assert fix_sql(case.sql, set(case.column_names)).startswith(("SELECT", "WITH")), case.name
+
     def test_remove_semicolon(self):
         expected = "SELECT * FROM my_table"
         assert fix_sql("SELECT *\nFROM my_table;") == expected
@@ -96,9 +147,58 @@ HAVING COUNT(DISTINCT "region-code") > 0""")
         assert fix_sql("SELECT the_col1, col2 FROM my_table ORDER BY the_col1", {"thecol1", "col2"}) == \
                'SELECT thecol1, col2 FROM my_table ORDER BY thecol1 NULLS FIRST'
 
+    def test_matched_names_with_spaces_or_dashes_are_quoted(self):
+        assert fix_sql("SELECT order_date, SUM(total_sales) FROM my_table GROUP BY 1",
+                       {"Order Date", "Total Sales"}) == \
+               'SELECT "Order Date", SUM("Total Sales") AS sum_total_sales FROM my_table GROUP BY 1'
+        assert fix_sql("SELECT customer_name FROM my_table ORDER BY customer_name", {"customer-name"}) == \
+               'SELECT "customer-name" FROM my_table ORDER BY "customer-name" NULLS FIRST'
+        assert fix_sql("SELECT region FROM my_table", {"Region", "region_id"}) == 'SELECT "Region" FROM my_table'
+        sql = fix_sql("SELECT order_date, total_sales FROM my_table", {"Order Date", "Total Sales"})
+        assert validate_sql(sql, "my_table", [{"column_name": "Order Date", "column_type": "DATE"},
+                                              {"column_name": "Total Sales", "column_type": "DOUBLE"}]) is None
+
     def test_remove_code_wrap(self):
         assert fix_sql("```sql\nSELECT 1 AS col```") == "SELECT 1 AS col"
 
+    def test_memoized(self):
+        sql = "SELECT the_col1, COUNT(*) FROM my_table GROUP BY 1 ORDER BY the_col1"
+        hits = _fix_sql.cache_info().hits
+        first = fix_sql(sql, {"thecol1", "col2"})
+        assert fix_sql(sql, {"col2", "thecol1"}) == first
+        assert fix_sql(sql, {"thecol1"}) == first
+        assert _fix_sql.cache_info().hits == hits + 1
+
+    def test_unparsable_answer(self):
+        assert fix_sql("I can't answer this question.", {"col"}) == "I can't answer this question."
+        assert fix_sql("```sql\nSELECT FROM WHERE (;```", {"col"}) == "SELECT FROM WHERE ("
+        assert fix_sql("SHOW TABLES", {"col"}) == "SHOW TABLES"
+
+
+class TestColumnIndex:
+    def test_find(self):
+        index = ColumnIndex(frozenset({"customer-name", "Total", "total", "Revenue"}))
+        assert index.find("customer-name") == "customer-name"
+        assert index.find("customer_name") == "customer-name"
+        assert index.find("revenue") == "Revenue"
+        assert index.find("TOTAL") is None
+        assert index.find("custmer_name") is None
+
+    def test_fuzzy(self):
+        index = ColumnIndex(frozenset({"customer_name", "order_date", "order_data"}), fuzzy=True)
+        assert index.find("custmer_name") == "customer_name"
+        assert index.find("customers_name") == "customer_name"
+        assert index.find("order_dat") is None
+        assert index.find("unrelated") is None
+
+    def test_fuzzy_fix_sql(self, monkeypatch):
+        monkeypatch.setenv("SQL_FIX_FUZZY_COLUMNS", "true")
+        assert fix_sql("SELECT custmer FROM my_table", {"customer"}) == "SELECT customer FROM my_table"
+
+    def test_index_reused(self):
+        columns = frozenset(f"col_{i}" for i in range(100))
+        assert get_column_index(columns) is get_column_index(frozenset(columns))
+
 
 class TestVisitorsLimit:
     def test_visitors_limit(self):
@@ -123,6 +223,868 @@ class TestVisitorsLimit:
         sleep(3)
         assert vl.visit("1")
 
+    def test_idle_visitors_evicted(self):
+        vl = VisitorsLimit(1000, 2, 1, max_visitors=3)
+        for visitor_id in range(10):
+            assert vl.visit(str(visitor_id))
+        assert len(vl._buckets._visitors) == 3
+        sleep(1.1)
+        vl.visit("new")
+        assert list(vl._buckets._visitors) == ["new"]
+
+    def test_shared_between_processes(self, tmp_path):
+        db_file = str(tmp_path / "visitors.db")
+        worker1 = VisitorsLimit(3, 2, 60, db_file=db_file)
+        worker2 = VisitorsLimit(3, 2, 60, db_file=db_file)
+        assert worker1.visit("1")
+        assert worker2.visit("1")
+        assert not worker1.visit("1")
+        assert worker2.visit("2")
+        assert not worker1.visit("3")
+
+
+class TestHTTPConnectionPool:
+    def test_connection_reused(self):
+        with FakeLLMServer() as server:
+            pool = HTTPConnectionPool(server.url, max_connections=2, timeout=5)
+            for _ in range(3):
+                status, body = pool.request("POST", "/v1beta/models/m:generateContent", body=b"{}")
+                assert status == 200
+            assert server.connections == 1
+            assert pool.connections_created == 1
+            pool.close()
+
+    def test_stale_connection_replaced(self):
+        with FakeLLMServer() as server:
+            server.close_after_response = True
+            pool = HTTPConnectionPool(server.url, max_connections=2, timeout=5)
+            for _ in range(3):
+                status, body = pool.request("POST", "/v1beta/models/m:generateContent", body=b"{}")
+                assert status == 200
+            assert server.connections == 3
+            pool.close()
+
+    def test_connection_closed_on_send_error(self, monkeypatch):
+        with FakeLLMServer() as server:
+            pool = HTTPConnectionPool(server.url, max_connections=1, timeout=5)
+            connections = []
+
+            def _send(conn, method, path, body, headers):
+                conn.connect()
+                connections.append(conn)
+                raise TimeoutError("timed out")
+
+            monkeypatch.setattr(pool, "_send", _send)
+            with pytest.raises(TimeoutError):
+                pool.request("POST", "/v1beta/models/m:generateContent", body=b"{}")
+            assert connections[0].sock is None and pool._idle == []
+            # The slot was released
+            monkeypatch.undo()
+            assert pool.request("POST", "/v1beta/models/m:generateContent", body=b"{}")[0] == 200
+
+    def test_pool_is_bounded(self):
+        with FakeLLMServer() as server:
+            pool = HTTPConnectionPool(server.url, max_connections=1, timeout=0.2)
+            assert pool._slots.acquire()
+            with pytest.raises(TimeoutError):
+                pool.request("POST", "/v1beta/models/m:generateContent", body=b"{}")
+
+
+class TestLLMResponseCache:
+    def test_cache_key(self):
+        key = get_cache_key("t", "Top 10  customers", '[{"a": 1, "b": 2}]', "rows", None, None, "m")
+        assert key == get_cache_key("t", "top 10 customers ", '[{"b":2,"a":1}]', "rows", None, None, "m")
+        assert key != get_cache_key("t", "top 10 customers", '[{"a": 1, "b": 2}]', "rows", None, "hint", "m")
+        assert key != get_cache_key("t", "top 10 customers", '[{"a": 1, "b": 2}]', "rows", None, None, "m2")
+
+    def test_lru_and_ttl(self):
+        cache = LLMResponseCache(max_entries=2, ttl_seconds=1)
+        cache.put("a", "1")
+        cache.put("b", "2")
+        assert cache.get("a") == "1"
+        cache.put("c", "3")
+        assert cache.get("b") is None
+        assert cache.get("a") == "1"
+        sleep(1.5)
+        assert cache.get("a") is None
+        stats = cache.stats()
+        assert stats["hits"] == 2 and stats["misses"] == 2 and stats["evictions"] == 1
+
+    def test_memory_cap(self):
+        cache = LLMResponseCache(max_entries=100, max_bytes=20)
+        cache.put("a", "x" * 9)
+        cache.put("b", "y" * 9)
+        cache.put("c", "z" * 9)
+        assert cache.get("a") is None
+        assert cache.stats()["bytes"] <= 20
+
+    def test_disk_tier(self, tmp_path):
+        db_file = str(tmp_path / "cache.db")
+        LLMResponseCache(db_file=db_file).put("a", "1")
+        cache = LLMResponseCache(db_file=db_file)
+        assert cache.get("a") == "1"
+        assert cache.stats()["disk_hits"] == 1
+
+    def test_disk_tier_pruned(self, tmp_path, monkeypatch):
+        monkeypatch.setattr("llm_cache._PRUNE_EVERY", 5)
+        db_file = str(tmp_path / "cache.db")
+        cache = LLMResponseCache(max_entries=1, db_file=db_file, max_disk_entries=3)
+        for i in range(5):
+            cache.put(str(i), "SELECT 1")
+            sleep(0.01)
+        assert [cache.get(str(i)) for i in range(5)] == [None, None, "SELECT 1", "SELECT 1", "SELECT 1"]
+
+    def test_disk_write_error_not_fatal(self, tmp_path):
+        db_file = str(tmp_path / "cache.db")
+        cache = LLMResponseCache(db_file=db_file)
+        sqlite3.connect(db_file).execute("DROP TABLE llm_cache")
+        assert cache.get_or_invoke("q", lambda: "SELECT 1") == "SELECT 1"
+        assert cache.get("q") == "SELECT 1"
+
+    def test_coalesce_in_flight(self):
+        cache = LLMResponseCache()
+        calls = []
+        release = threading.Event()
+
+        def invoke():
+            calls.append(1)
+            release.wait(5)
+            return "SELECT 1"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_invoke("q", invoke)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        while cache.stats()["coalesced"] < 4:
+            sleep(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+        assert results == ["SELECT 1"] * 5
+        assert len(calls) == 1
+
+    def test_errors_not_cached(self):
+        cache = LLMResponseCache()
+        with pytest.raises(ValueError):
+            cache.get_or_invoke("q", lambda: (_ for _ in ()).throw(ValueError("boom")))
+        assert cache.get_or_invoke("q", lambda: "SELECT 1") == "SELECT 1"
+
+    def test_async_leader_cancelled(self):
+        cache = LLMResponseCache()
+        calls = []
+
+        async def invoke():
+            calls.append(1)
+            await asyncio.sleep(0.2)
+            return "SELECT 1"
+
+        async def _run():
+            leader = asyncio.create_task(cache.aget_or_invoke("q", invoke))
+            await asyncio.sleep(0.05)
+            waiters = [asyncio.create_task(cache.aget_or_invoke("q", invoke)) for _ in range(3)]
+            await asyncio.sleep(0.05)
+            leader.cancel()
+            return await asyncio.gather(*waiters)
+
+        # The first waiter invokes the LLM again for the others, none of them is cancelled
+        assert asyncio.run(_run()) == ["SELECT 1"] * 3
+        assert len(calls) == 2
+
+
+_METADATA = json.dumps([{"column_name": "customer", "column_type": "VARCHAR"},
+                        {"column_name": "revenue", "column_type": "DOUBLE"}])
+
+
+class TestSqlRequest:
+    def test_parse(self):
+        sql_request = parse_sql_request({"table_name": "my_table", "question": "q", "metadata": _METADATA,
+                                         "hint": ""})
+        assert sql_request.column_names == {"customer", "revenue"}
+        assert sql_request.metadata == _METADATA
+        assert sql_request.hint is None and sql_request.sample_data is None
+
+    def test_parse_json_values(self):
+        sql_request = parse_sql_request({"table_name": "my_table", "question": "q",
+                                         "metadata": json.loads(_METADATA), "sample_data": [{"customer": "a"}]})
+        assert sql_request.column_names == {"customer", "revenue"}
+        assert json.loads(sql_request.sample_data) == [{"customer": "a"}]
+
+    def test_invalid_metadata(self):
+        with pytest.raises(ValueError, match="metadata"):
+            parse_sql_request({"question": "q"})
+        with pytest.raises(ValueError, match="metadata"):
+            parse_sql_request({"question": "q", "metadata": "not json"})
+
+    def test_read_compressed_body(self):
+        body = json.dumps({"question": "q"}).encode("utf-8")
+        assert read_json_body(body) == {"question": "q"}
+        assert read_json_body(gzip.compress(body), "gzip") == {"question": "q"}
+        assert read_json_body(zlib.compress(body), "deflate") == {"question": "q"}
+        with pytest.raises(ValueError, match="Unsupported"):
+            read_json_body(body, "br")
+
+    def test_read_corrupt_body(self):
+        body = json.dumps({"question": "q"}).encode("utf-8")
+        raw = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        assert read_json_body(raw.compress(body) + raw.flush(), "deflate") == {"question": "q"}
+        for encoding in ("gzip", "deflate"):
+            with pytest.raises(ValueError, match="not valid gzip/deflate"):
+                read_json_body(b"garbage", encoding)
+        with pytest.raises(ValueError, match="truncated"):
+            read_json_body(gzip.compress(body)[:-10], "gzip")
+        with pytest.raises(ValueError, match="truncated"):
+            read_json_body(zlib.compress(body)[:-6], "deflate")
+        response = app.test_client().post("/sql", data=b"garbage", content_type="application/json",
+                                          headers={"Content-Encoding": "gzip"})
+        assert response.status_code == 200 and "not valid gzip/deflate" in response.json["error"]
+
+
+class TestPromptEncoding:
+    def test_json(self):
+        encoded = encode_prompt_data(_METADATA, json.dumps([{"customer": "a", "revenue": 1.5}]),
+                                     json.dumps([{"customer": ["a", "b"]}]))
+        assert encoded.metadata == "column_name,column_type\ncustomer,VARCHAR\nrevenue,DOUBLE\n"
+        assert encoded.sample_data == "customer,revenue\na,1.5\n"
+        assert encoded.distinct_values == "customer: a, b\n"
+        assert encoded.tokens_after < encoded.tokens_before
+
+    def test_python_repr(self):
+        metadata = "{'column_name': 'price', 'column_type': 'DECIMAL(9,2)', 'min': Decimal('1.50'), 'q25': '2'}\n" \
+                   "{'column_name': 'day', 'column_type': 'DATE', 'min': datetime.date(2024, 1, 31), 'q25': None}"
+        encoded = encode_prompt_data(metadata, "not a table", None)
+        assert encoded.metadata == 'column_name,column_type,min\nprice,"DECIMAL(9,2)",1.50\nday,DATE,2024-01-31\n'
+        assert encoded.sample_data == "not a table" and encoded.distinct_values is None
+
+    def test_floats_keep_their_precision(self):
+        encoded = encode_prompt_data(_METADATA, json.dumps([{"revenue": 1234567.891}, {"revenue": 0.123456789},
+                                                            {"revenue": 2.0}, {"revenue": 1e-7}]), None)
+        assert encoded.sample_data == "revenue\n1234567.891\n0.123456789\n2\n1e-07\n"
+
+    def test_invalid_data_used_as_is(self):
+        for data in ["{[1]: 2}", "{'day': datetime.date('a', 'b', 'c')}", "[" * 100000 + "]" * 100000]:
+            assert encode_prompt_data(_METADATA, data, None).sample_data == data
+
+    def test_truncation(self):
+        encoded = encode_prompt_data(_METADATA, json.dumps([{"customer": "x" * 100}]), None)
+        assert encoded.sample_data == "customer\n" + "x" * 37 + "...\n"
+
+    def test_token_budget(self):
+        samples = json.dumps([{"customer": f"customer {i}"} for i in range(20)])
+        distinct = json.dumps([{"customer": [f"c{i}" for i in range(30)], "region": ["north", "south"]}])
+        full = encode_prompt_data(_METADATA, samples, distinct)
+        # Sample rows go first
+        encoded = encode_prompt_data(_METADATA, samples, distinct, full.tokens_after - 20)
+        assert 0 < encoded.sample_data.count("\n") < 21 and encoded.distinct_values == full.distinct_values
+        # Then the columns with the most distinct values
+        encoded = encode_prompt_data(_METADATA, samples, distinct, 30)
+        assert encoded.sample_data is None and encoded.distinct_values == "region: north, south\n"
+        encoded = encode_prompt_data(_METADATA, samples, distinct, 1)
+        assert encoded.sample_data is None and encoded.distinct_values is None
+        assert encoded.metadata == full.metadata
+
+    def test_compact_prompt(self, monkeypatch):
+        samples = json.dumps([{"customer": "a", "revenue": 1.5}])
+        raw = get_prompt("my_table", "q", _METADATA, samples)
+        assert samples in raw
+        monkeypatch.setenv("PROMPT_ENCODING", "compact")
+        compact = get_prompt("my_table", "q", _METADATA, samples)
+        assert "customer,revenue\na,1.5" in compact and len(compact) < len(raw)
+        assert get_prompt("my_table", "q", _METADATA, samples, compact=False) == raw
+        monkeypatch.setenv("PROMPT_TOKEN_BUDGET", "1")
+        assert "customer,revenue" not in get_prompt("my_table", "q", _METADATA, samples)
+
+
+class TestDatasetContext:
+    _CONTEXT = DatasetContext("my_table", _METADATA, json.loads(_METADATA), "[]")
+
+    def test_register(self):
+        store = DatasetContextStore()
+        context_id = store.register(self._CONTEXT)
+        # The id is a content fingerprint, key order and whitespace don't matter
+        same = self._CONTEXT._replace(metadata=json.dumps(json.loads(_METADATA), indent=2))
+        assert store.register(same) == context_id
+        assert store.get(context_id) == self._CONTEXT
+        assert store.register(self._CONTEXT._replace(table_name="other")) != context_id
+        assert store.get("unknown") is None
+
+    def test_lru_and_ttl(self):
+        store = DatasetContextStore(max_entries=2, ttl_seconds=0.2)
+        first = store.register(self._CONTEXT._replace(table_name="t1"))
+        second = store.register(self._CONTEXT._replace(table_name="t2"))
+        store.get(first)
+        store.register(self._CONTEXT._replace(table_name="t3"))
+        assert store.get(first) is not None and store.get(second) is None
+        sleep(0.3)
+        assert store.get(first) is None
+        assert store.stats()["evictions"] == 1
+
+    def test_max_bytes(self):
+        store = DatasetContextStore(max_bytes=self._CONTEXT.size * 2)
+        ids = [store.register(self._CONTEXT._replace(table_name=f"t{i}")) for i in range(3)]
+        assert store.get(ids[0]) is None and store.get(ids[2]) is not None
+        assert store.stats()["bytes"] == self._CONTEXT.size * 2
+
+    def test_turns(self):
+        store = DatasetContextStore(max_turns=2)
+        context_id = store.register(self._CONTEXT)
+        for i in range(3):
+            store.add_turn(context_id, "session", f"question {i}", f"SELECT {i}")
+        assert [t.question for t in store.get_turns(context_id, "session")] == ["question 1", "question 2"]
+        assert store.get_turns(context_id, "other") == () and store.get_turns(context_id, None) == ()
+        assert store.stats()["bytes"] == self._CONTEXT.size + 2 * len("question 1SELECT 1")
+        store.add_turn(context_id, "session", "question 2", "SELECT 3", replaces="SELECT 2")
+        assert [t.sql for t in store.get_turns(context_id, "session")] == ["SELECT 1", "SELECT 3"]
+        assert store.stats()["bytes"] == self._CONTEXT.size + 2 * len("question 1SELECT 1")
+
+    def test_parse_with_context(self):
+        store = DatasetContextStore()
+        context_id = store.register(self._CONTEXT)
+        store.add_turn(context_id, "session", "all customers", "SELECT customer FROM my_table")
+        sql_request = parse_sql_request({"context_id": context_id, "session_id": "session", "question": "q"}, store)
+        assert sql_request.metadata == _METADATA and sql_request.column_names == {"customer", "revenue"}
+        assert sql_request.turns[0].sql == "SELECT customer FROM my_table"
+        retry = parse_sql_request({"context_id": context_id, "session_id": "session", "question": "all customers",
+                                   "previous_sql": "SELECT customer FROM my_table", "previous_error": "e"}, store)
+        assert retry.turns == ()
+        with pytest.raises(ValueError, match="context_id not found"):
+            parse_sql_request({"context_id": "unknown", "question": "q"}, store)
+        for session_id in ("a" * 65, "../session", "session id"):
+            with pytest.raises(ValueError, match="session_id"):
+                parse_sql_request({"context_id": context_id, "session_id": session_id, "question": "q"}, store)
+
+
+class TestSqlGenerator:
+    _REQUEST = parse_sql_request({"table_name": "my_table", "question": "top customers", "metadata": _METADATA})
+
+    def test_validate_sql(self):
+        columns = json.loads(_METADATA)
+        assert validate_sql("SELECT customer, SUM(revenue) FROM my_table GROUP BY 1", "my_table", columns) is None
+        assert "customers" in validate_sql("SELECT customers FROM my_table", "my_table", columns)
+        assert validate_sql("SELECT a FROM my_table", "my_table", [{"column_name": "a", "column_type": "BAD"}]) is None
+
+    def test_validate_sql_is_sandboxed(self, tmp_path):
+        target = tmp_path / "out.csv"
+        column_type = f"INT); COPY (SELECT 42 AS x) TO '{target}'; CREATE TABLE z (q INT"
+        assert validate_sql("SELECT a FROM t1", "t1", [{"column_name": "a", "column_type": column_type}]) is None
+        assert not target.exists()
+        columns = [{"column_name": "a", "column_type": "DECIMAL(10, 2)"}]
+        assert "file system operations are disabled" in validate_sql(
+            "SELECT nope FROM read_csv('/etc/passwd', header=true)", "t2", columns)
+        for sql in [f"COPY (SELECT 1) TO '{target}'", "SELECT a FROM t2; DROP TABLE t2"]:
+            assert validate_sql(sql, "t2", columns) == "Only a single SELECT statement is allowed"
+        assert not target.exists()
+
+    def test_valid_first_attempt(self, monkeypatch):
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: "SELECT customer FROM my_table")
+        assert generate_sql(self._REQUEST) == ("SELECT customer FROM my_table", 1, None)
+
+    def test_repair(self, monkeypatch):
+        prompts = []
+        answers = iter(["SELECT price FROM my_table", "SELECT revenue FROM my_table"])
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: prompts.append(prompt) or
+                            next(answers))
+        cache = LLMResponseCache()
+        assert generate_sql(self._REQUEST, cache) == ("SELECT revenue FROM my_table", 2, None)
+        assert "SELECT price FROM my_table" in prompts[1] and "price" in prompts[1]
+        # The repaired answer replaces the failed one in the cache
+        assert generate_sql(self._REQUEST, cache) == ("SELECT revenue FROM my_table", 1, None)
+        assert len(prompts) == 2
+
+    def test_attempts_limit(self, monkeypatch):
+        monkeypatch.setenv("SQL_VALIDATION_MAX_ATTEMPTS", "3")
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: "SELECT price FROM my_table")
+        result = generate_sql(self._REQUEST)
+        assert result.attempts == 3 and "price" in result.error
+
+
+class TestHedging:
+    _REQUEST = parse_sql_request({"table_name": "my_table", "question": "hedged customers", "metadata": _METADATA,
+                                  "model_id": "slow-model"})
+
+    def test_hedge_slow_primary(self, monkeypatch):
+        monkeypatch.setenv("LLM_HEDGE_MODE", "hedge")
+        monkeypatch.setenv("LLM_HEDGE_DELAY", "0.1")
+        monkeypatch.setenv("LLM_HEDGE_MODEL_IDS", "fast-model")
+
+        def _invoke(prompt, model_id):
+            sleep(1 if model_id == "slow-model" else 0.05)
+            return f"SELECT customer AS {model_id.split('-')[0]} FROM my_table"
+
+        monkeypatch.setattr("sql_generator.invoke_llm", _invoke)
+        wins = hedging_stats()["wins"].get("hedge:fast-model", 0)
+        start = time.monotonic()
+        assert generate_sql(self._REQUEST).sql == "SELECT customer AS fast FROM my_table"
+        assert time.monotonic() - start < 0.5
+        assert hedging_stats()["wins"]["hedge:fast-model"] == wins + 1
+
+    def test_race_skips_invalid_answer(self, monkeypatch):
+        monkeypatch.setenv("LLM_HEDGE_MODE", "race")
+        monkeypatch.setenv("LLM_HEDGE_MODEL_IDS", "fast-model")
+        answers = {"slow-model": "SELECT price FROM my_table", "fast-model": "SELECT revenue FROM my_table"}
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: sleep(
+            0.2 if model_id == "fast-model" else 0) or answers[model_id])
+        assert generate_sql(self._REQUEST) == ("SELECT revenue FROM my_table", 1, None)
+
+    def test_async_hedge_cancels_primary(self, monkeypatch):
+        monkeypatch.setenv("LLM_HEDGE_MODE", "hedge")
+        monkeypatch.setenv("LLM_HEDGE_DELAY", "0.1")
+        monkeypatch.setenv("LLM_HEDGE_MODEL_IDS", "fast-model")
+        cancelled = []
+
+        async def _ainvoke(prompt, model_id):
+            try:
+                await asyncio.sleep(5 if model_id == "slow-model" else 0)
+            except asyncio.CancelledError:
+                cancelled.append(model_id)
+                raise
+            return "SELECT customer FROM my_table"
+
+        async def _generate():
+            result = await agenerate_sql(self._REQUEST)
+            await asyncio.sleep(0)
+            return result
+
+        monkeypatch.setattr("sql_generator.ainvoke_llm", _ainvoke)
+        assert asyncio.run(_generate()).sql == "SELECT customer FROM my_table"
+        assert cancelled == ["slow-model"]
+
+    def test_percentile_delay(self, monkeypatch):
+        monkeypatch.setenv("LLM_HEDGE_DELAY", "7")
+        monkeypatch.setenv("LLM_HEDGE_PERCENTILE", "90")
+        assert get_hedge_delay("percentile-model") == 7
+        for i in range(20):
+            _record_latency("percentile-model", (i + 1) / 10)
+        assert get_hedge_delay("percentile-model") == 1.8
+
+    def test_tracked_models_capped(self, monkeypatch):
+        monkeypatch.setattr("hedging._latencies", {})
+        for i in range(150):
+            _record_latency(f"client-model-{i}", 1)
+        assert len(hedging_stats()["hedge_delays"]) == 100
+
+
+class TestLLMRouter:
+    @staticmethod
+    def _register(monkeypatch, *fakes: FakeLLMProvider):
+        for fake in fakes:
+            monkeypatch.setitem(utils._providers, fake.name, fake.provider)
+
+    def test_registry(self, monkeypatch):
+        fake = FakeLLMProvider("fake", "SELECT 6 AS col")
+        self._register(monkeypatch, fake)
+        assert invoke_llm("question", "fake-model") == "SELECT 6 AS col"
+        assert asyncio.run(ainvoke_llm("question", "fake-model")) == "SELECT 6 AS col"
+        assert get_provider("us.anthropic.claude-haiku-4-5-20251001-v1:0").name == "bedrock"
+        with pytest.raises(ValueError, match="Unknown model_id"):
+            LLMRouter().invoke("question", "unknown")
+
+    def test_fallback_and_circuit(self, monkeypatch):
+        monkeypatch.setenv("LLM_FALLBACK_MODEL_IDS", "backup-model")
+        monkeypatch.setenv("LLM_CIRCUIT_FAILURES", "2")
+        monkeypatch.setenv("LLM_CIRCUIT_OPEN_SECONDS", "0.2")
+        primary = FakeLLMProvider("primary", error=ProviderError("Service unavailable", 503))
+        backup = FakeLLMProvider("backup", "SELECT 2 AS col")
+        self._register(monkeypatch, primary, backup)
+        router = LLMRouter()
+        for _ in range(3):
+            assert router.invoke("question", "primary-model") == "SELECT 2 AS col"
+        # The circuit opened after two failures, the third request went straight to the backup
+        assert primary.calls == 2 and router.stats()["primary-model"]["circuit"] == "open"
+        sleep(0.3)
+        primary.error = None
+        assert router.invoke("question", "primary-model") == "SELECT 1 AS col"
+        assert router.stats()["primary-model"]["circuit"] == "closed"
+        assert router.stats()["backup-model"]["error_rate"] == 0
+
+    def test_client_errors_keep_circuit_closed(self, monkeypatch):
+        monkeypatch.setenv("LLM_CIRCUIT_FAILURES", "2")
+        primary = FakeLLMProvider("primary", error=ProviderError("Bad request", 400))
+        self._register(monkeypatch, primary)
+        router = LLMRouter()
+        for _ in range(3):
+            with pytest.raises(ProviderError, match="Bad request"):
+                router.invoke("question", "primary-model")
+        assert primary.calls == 3 and "primary-model" not in router.stats()
+        primary.error = ValueError("Unknown model_id: primary-model")
+        with pytest.raises(ValueError):
+            router.invoke("question", "primary-model")
+        assert "primary-model" not in router.stats()
+
+    def test_client_errors_not_retried_on_fallbacks(self, monkeypatch):
+        monkeypatch.setenv("LLM_FALLBACK_MODEL_IDS", "backup-model")
+        primary = FakeLLMProvider("primary", error=ProviderError("Bad request", 400))
+        backup = FakeLLMProvider("backup", "SELECT 1")
+        self._register(monkeypatch, primary, backup)
+        router = LLMRouter()
+        with pytest.raises(ProviderError, match="Bad request"):
+            router.invoke("question", "primary-model")
+        with pytest.raises(ProviderError, match="Bad request"):
+            asyncio.run(router.ainvoke("question", "primary-model"))
+        with pytest.raises(ProviderError, match="Bad request"):
+            list(router.invoke_stream("question", "primary-model"))
+        assert primary.calls == 3 and backup.calls == 0
+
+    def test_all_circuits_open_fails_fast(self, monkeypatch):
+        monkeypatch.setenv("LLM_FALLBACK_MODEL_IDS", "backup-model")
+        monkeypatch.setenv("LLM_CIRCUIT_FAILURES", "1")
+        monkeypatch.setenv("LLM_CIRCUIT_OPEN_SECONDS", "0.2")
+        primary = FakeLLMProvider("primary", error=ProviderError("Throttled", 429))
+        backup = FakeLLMProvider("backup", error=ConnectionError("Connection refused"))
+        self._register(monkeypatch, primary, backup)
+        router = LLMRouter()
+        with pytest.raises(ConnectionError):
+            router.invoke("question", "primary-model")
+        with pytest.raises(ProviderError, match="All the circuits are open") as error:
+            asyncio.run(router.ainvoke("question", "primary-model"))
+        assert error.value.status == 503 and primary.calls == backup.calls == 1
+        sleep(0.3)
+        # Half open: a single probe per model
+        primary.error = None
+        assert router.invoke("question", "primary-model") == "SELECT 1 AS col"
+        assert primary.calls == 2 and backup.calls == 1
+
+    def test_batch_limit_by_registered_provider(self, monkeypatch):
+        self._register(monkeypatch, FakeLLMProvider("fake"))
+        assert _get_provider_limit("fake-model") is _get_provider_limit("fake-other")
+        assert _get_provider_limit("fake-model") is not _get_provider_limit("anthropic.claude-v2")
+        assert _get_provider_limit("gemini-2.0-flash") is not _get_provider_limit("anthropic.claude-v2")
+
+    def test_default_model_goes_to_fastest(self, monkeypatch):
+        monkeypatch.setenv("MODEL_ID", "slow-model")
+        monkeypatch.setenv("LLM_FALLBACK_MODEL_IDS", "fast-model")
+        self._register(monkeypatch, FakeLLMProvider("slow", delay=0.1), FakeLLMProvider("fast", delay=0.01))
+        router = LLMRouter()
+        assert router.route(None) == ["slow-model", "fast-model"]
+        router.invoke("question")
+        router.invoke("question", "fast-model")
+        assert router.route(None) == ["fast-model", "slow-model"]
+        assert router.stats()["slow-model"]["p50"] >= 0.1
+
+    def test_slow_answers_and_timeouts(self, monkeypatch):
+        monkeypatch.setenv("LLM_FALLBACK_MODEL_IDS", "backup-model")
+        monkeypatch.setenv("LLM_ROUTER_SLOW_SECONDS", "0.05")
+        monkeypatch.setenv("LLM_ROUTER_TIMEOUT", "0.2")
+        self._register(monkeypatch, FakeLLMProvider("primary", delay=1), FakeLLMProvider("backup", "SELECT 2 AS col"))
+        router = LLMRouter()
+        start = time.monotonic()
+        assert asyncio.run(router.ainvoke("question", "primary-model")) == "SELECT 2 AS col"
+        assert time.monotonic() - start < 0.5
+        assert router.stats()["primary-model"]["error_rate"] == 1
+
+    def test_stream_fallback(self, monkeypatch):
+        monkeypatch.setenv("LLM_FALLBACK_MODEL_IDS", "backup-model")
+        self._register(monkeypatch, FakeLLMProvider("primary", error=ProviderError("Throttled", 429)),
+                       FakeLLMProvider("backup", "SELECT 2"))
+        assert list(LLMRouter().invoke_stream("question", "primary-model")) == ["SELECT ", "2 "]
+
+
+class TestMetrics:
+    def test_histogram(self):
+        histogram = Histogram("test_seconds", "Test histogram", ("stage",), buckets=(0.1, 1))
+        for value in [0.05, 0.1, 0.5, 5]:
+            histogram.observe(value, ("a",))
+        assert histogram.render() == [
+            "# HELP test_seconds Test histogram", "# TYPE test_seconds histogram",
+            'test_seconds_bucket{stage="a",le="0.1"} 2', 'test_seconds_bucket{stage="a",le="1"} 3',
+            'test_seconds_bucket{stage="a",le="+Inf"} 4', 'test_seconds_sum{stage="a"} 5.65',
+            'test_seconds_count{stage="a"} 4']
+
+    def test_counter(self):
+        counter = Counter("test_total", "Test counter", ("name",))
+        counter.inc(("a\"b",), 2)
+        assert counter.render()[-1] == 'test_total{name="a\\"b"} 2'
+
+    def test_metrics_endpoint(self, monkeypatch):
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: "SELECT customer FROM my_table")
+        retries = RETRY_REQUESTS.get()
+        llm_calls = STAGE_SECONDS.count(("llm", "metrics-model"))
+        result = app.test_client().post("/sql", json={
+            "visitor_id": "test_metrics", "table_name": "my_table", "question": "metrics customers",
+            "metadata": _METADATA, "model_id": "metrics-model", "previous_sql": "SELECT 1",
+            "previous_error": "error"}).json
+        assert result["sql"] == "SELECT customer FROM my_table"
+        assert RETRY_REQUESTS.get() == retries + 1
+        assert STAGE_SECONDS.count(("llm", "metrics-model")) == llm_calls + 1
+        metrics = app.test_client().get("/metrics").text
+        for stage_name in ["rate_limit", "prompt", "llm", "fix_sql", "validate"]:
+            assert f'llm_analytics_stage_seconds_count{{stage="{stage_name}",model_id="metrics-model"}}' in metrics
+        assert 'llm_analytics_prompt_tokens_count{model_id="metrics-model"}' in metrics
+        assert 'llm_analytics_requests_in_flight{endpoint="sql"} 0' in metrics
+        assert 'llm_analytics_llm_cache{stat="hit_rate"}' in metrics
+
+
+class TestTracing:
+    def test_span_tree(self, monkeypatch):
+        monkeypatch.setenv("TRACE_SLOW_REQUEST_MS", "1")
+        monkeypatch.setattr(tracing, "_get_handler", lambda: logging.NullHandler())
+        with span("outside") as outside:
+            assert outside is None
+        trace = start_trace("test")
+        with span("parent", model_id="m"):
+            with span("child"):
+                sleep(0.002)
+        record = trace.finish("ok")
+        assert record["slow"] and "profile" not in record
+        parent = record["spans"]["children"][0]
+        assert parent["name"] == "parent" and parent["model_id"] == "m" and parent["ms"] >= 2
+        assert parent["children"][0]["name"] == "child"
+        assert start_trace("test").finish("ok") is None
+        with span("after") as after:
+            assert after is None
+
+    def test_slow_request_log(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("TRACE_SLOW_REQUEST_MS", "0.001")
+        monkeypatch.setenv("TRACE_LOG_FILE", str(tmp_path / "slow.log"))
+        monkeypatch.setattr(tracing, "_handler", None)
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: "SELECT customer AS traced FROM my_table")
+        result = app.test_client().post("/sql", json={
+            "visitor_id": "test_tracing", "table_name": "my_table", "question": "traced customers",
+            "metadata": _METADATA}).json
+        assert result["sql"] == "SELECT customer AS traced FROM my_table"
+        record = json.loads((tmp_path / "slow.log").read_text().splitlines()[-1])
+        assert record["endpoint"] == "sql" and record["outcome"] == "ok"
+        spans = {s["name"]: s for s in record["spans"]["children"]}
+        assert {"recaptcha", "rate_limit", "prompt", "llm", "fix_sql", "validate"} <= set(spans)
+        assert [s["name"] for s in spans["fix_sql"]["children"]] == ["sqlglot_parse", "fix_aliases", "fix_columns",
+                                                                      "sqlglot_generate"]
+
+    def test_sampled_profile(self, monkeypatch):
+        monkeypatch.setenv("TRACE_PROFILE_RATE", "1")
+        monkeypatch.setattr(tracing, "_get_handler", lambda: logging.NullHandler())
+        trace = start_trace("test")
+        fix_sql("SELECT count(*) FROM profiled_table")
+        record = trace.finish("ok")
+        assert not record["slow"]
+        assert "function calls" in record["profile"]
+
+
+class TestValidationHarness:
+    def test_record_and_replay(self, monkeypatch, tmp_path):
+        monkeypatch.setenv("VALIDATION_SNAPSHOT_DIR", str(tmp_path / "snapshots"))
+        monkeypatch.setenv("VALIDATION_RECORDINGS", str(tmp_path / "recordings.json"))
+        monkeypatch.setenv("VALIDATION_LLM", "record")
+        monkeypatch.setattr(validation_tests_utils, "_recorder", None)
+        # A cache of its own, the snapshots are gone after the test
+        monkeypatch.setattr(validation_tests_utils, "load_dataset",
+                            lru_cache(None)(validation_tests_utils.load_dataset.__wrapped__))
+        monkeypatch.setattr(validation_tests_utils, "_stats", dict.fromkeys(validation_tests_utils._stats, 0))
+        monkeypatch.setattr(validation_tests_utils, "_tests_log", [])
+        monkeypatch.setattr(validation_tests_utils, "invoke_llm", lambda prompt, model_id:
+                            "SELECT COUNT(DISTINCT \"Product ID\") FROM my_table")
+        cases = validation_tests_utils.get_validation_cases(["test-model"], ["sales"])[:3]
+        recorded = validation_tests_utils.run_tests(cases)
+        assert len(json.load(open(tmp_path / "recordings.json"))) == 3
+        assert len(list((tmp_path / "snapshots").glob("*.duckdb"))) == 1
+
+        # Replay is the default
+        monkeypatch.delenv("VALIDATION_LLM")
+        monkeypatch.setattr(validation_tests_utils, "_recorder", None)
+        monkeypatch.setattr(validation_tests_utils, "invoke_llm", None)
+        assert validation_tests_utils.run_tests(cases) == recorded
+        # A changed prompt fails, unless the answer recorded for the same test is explicitly allowed
+        monkeypatch.setattr(validation_tests_utils, "get_prompt", lambda *args, **kwargs: "changed prompt")
+        stale = validation_tests_utils.run_tests(cases)
+        assert [r.status for r in stale] == ["stale_recording"] * 3
+        with pytest.raises(AssertionError, match="changed since its answer was recorded"):
+            validation_tests_utils.check_replay(stale[0])
+        monkeypatch.setenv("VALIDATION_ALLOW_STALE", "true")
+        monkeypatch.setattr(validation_tests_utils, "_recorder", None)
+        assert [r.stale_replays for r in validation_tests_utils.run_tests(cases)] == [1, 1, 1]
+        other_model = validation_tests_utils.get_validation_cases(["other-model"], ["sales"])[:1]
+        assert validation_tests_utils.run_tests(other_model)[0].status == "missing_recording"
+        assert validation_tests_utils._stats["missing_recording"] == 1
+
+
+class TestDatasetProfiler:
+    _SALES = validation_tests_utils.get_full_file_name("resources/validation/sales/sales_data.csv")
+
+    def test_csv_matches_summarize(self):
+        profile = profile_dataset(self._SALES, seed=1)
+        with duckdb.connect() as con:
+            con.execute(f"CREATE TABLE my_table AS SELECT * FROM read_csv_auto('{self._SALES}')")
+            summary = list(validation_tests_utils._fetch_dict(con, "SUMMARIZE my_table"))
+            regions = con.execute('SELECT ARRAY_AGG(DISTINCT "Region" ORDER BY "Region") FROM my_table').fetchone()
+        assert profile.rows == 10000 and not profile.sampled
+        for column, expected in zip(profile.metadata, summary):
+            assert column["column_name"] == expected["column_name"]
+            assert column["column_type"] == expected["column_type"]
+            assert (column["min"], column["max"]) == (expected["min"], expected["max"])
+            assert column["count"] == 10000
+        unique = {c["column_name"]: c["approx_unique"] for c in profile.metadata}
+        assert unique["Region"] == 4 and unique["Payment Method"] == 3 and 9500 <= unique["Order ID"] <= 10500
+        assert profile.distinct_values["Region"] == regions[0]
+        assert "Order ID" not in profile.distinct_values
+        assert len(profile.sample_data) == 5 and isinstance(profile.sample_data[0]["Quantity"], int)
+        metadata, sample_data, distinct_values = profile.prompt_data()
+        assert metadata.count("\n") == 10 and "'Region': [" in distinct_values
+
+    def test_jsonl_and_parquet(self, tmp_path):
+        csv_profile = profile_dataset(self._SALES, seed=1)
+        with duckdb.connect() as con:
+            con.execute(f"CREATE TABLE my_table AS SELECT * FROM read_csv_auto('{self._SALES}')")
+            con.execute(f"COPY my_table TO '{tmp_path / 'sales.jsonl'}' (FORMAT json)")
+            con.execute(f"COPY my_table TO '{tmp_path / 'sales.parquet'}' (FORMAT parquet)")
+        for file in ("sales.jsonl", "sales.parquet"):
+            profile = profile_dataset(str(tmp_path / file), seed=1)
+            assert profile.rows == 10000
+            assert [c["column_type"] for c in profile.metadata] == [c["column_type"] for c in csv_profile.metadata]
+            assert profile.distinct_values == csv_profile.distinct_values
+
+    def test_csv_delimiters(self, tmp_path):
+        csv_profile = profile_dataset(self._SALES, seed=1)
+        with duckdb.connect() as con:
+            con.execute(f"CREATE TABLE my_table AS SELECT * FROM read_csv_auto('{self._SALES}')")
+            for name, delimiter in [("semicolon.csv", ";"), ("tab.tsv", "\t"), ("pipe.csv", "|")]:
+                file = str(tmp_path / name)
+                con.execute(f"COPY my_table TO '{file}' (HEADER, DELIMITER '{delimiter}')")
+                columns = [c[0] for c in con.execute(f"DESCRIBE SELECT * FROM read_csv_auto('{file}')").fetchall()]
+                profile = profile_dataset(file, seed=1)
+                assert [c["column_name"] for c in profile.metadata] == columns
+                assert profile.metadata == csv_profile.metadata and profile.rows == 10000
+
+    def test_type_inference(self, tmp_path):
+        file = tmp_path / "mixed.csv"
+        file.write_text("a,b,c,d\n1,2024-01-01,x,true\n2,2024-01-02 10:00:00,,false\n"
+                        "3.5,2024-01-03,3,\nfoo,2024-01-04,4,true\n")
+        profile = profile_dataset(str(file), batch_size=2)
+        assert [c["column_type"] for c in profile.metadata] == ["VARCHAR", "TIMESTAMP", "VARCHAR", "BOOLEAN"]
+        assert profile.metadata[1]["min"] == "2024-01-01 00:00:00"
+        assert [c["null_percentage"] for c in profile.metadata] == [0, 0, 25, 25]
+        numbers = tmp_path / "numbers.csv"
+        numbers.write_text("n\n" + "".join(f"{i}\n" for i in range(10)) + "2.5\n")
+        column = profile_dataset(str(numbers), batch_size=3).metadata[0]
+        assert column["column_type"] == "DOUBLE" and column["avg"] == str(47.5 / 11)
+
+    def test_sampled(self, monkeypatch):
+        monkeypatch.setattr(dataset_profiler, "_BLOCK_SIZE", 32 * 1024)
+        profile = profile_dataset(self._SALES, sample_rate=0.3, seed=1)
+        assert profile.sampled
+        assert 8000 <= profile.rows <= 12000
+        unique = {c["column_name"]: c["approx_unique"] for c in profile.metadata}
+        # Id columns are scaled up with the rows, categories are not
+        assert 8000 <= unique["Order ID"] <= 12000 and unique["Region"] == 4
+        assert profile.distinct_values["Payment Method"] == profile_dataset(self._SALES).distinct_values[
+            "Payment Method"]
+
+    def test_hyperloglog(self):
+        sketch = HyperLogLog()
+        sketch.add(range(100000))
+        sketch.add(f"value {i}" for i in range(100000))
+        assert abs(sketch.count() - 200000) < 200000 * 0.05
+
+
+class TestServerDatasets:
+    @pytest.fixture
+    def server(self, tmp_path):
+        shutil.copy(TestDatasetProfiler._SALES, tmp_path / "sales.csv")
+        with duckdb.connect() as con:
+            con.execute(f"COPY (SELECT * FROM read_csv_auto('{TestDatasetProfiler._SALES}')) "
+                        f"TO '{tmp_path / 'orders.parquet'}' (FORMAT parquet)")
+        return DatasetServer(str(tmp_path), pool_size=2, timeout_seconds=0.5, max_rows=250)
+
+    def test_query_pages(self, server):
+        assert [d.name for d in server.datasets()] == ["orders", "sales"]
+        with server.query('SELECT "Region", COUNT(*) FROM sales GROUP BY 1 ORDER BY 1') as result:
+            assert result.columns == ["Region", "count_star()"] and result.types == ["VARCHAR", "BIGINT"]
+            assert [len(p) for p in result.pages(3)] == [3, 1]
+        result = server.query("SELECT s.* FROM sales s JOIN orders o USING (\"Order ID\")")
+        assert sum(len(p) for p in result.pages(100)) == 250 and result.truncated
+        assert server.stats()["idle_connections"] == 2
+
+    def test_read_only(self, server, tmp_path):
+        for sql in [f"COPY sales TO '{tmp_path / 'copy.csv'}'", "CREATE TABLE t AS SELECT 1", "SELECT 1; SELECT 2",
+                    "SET enable_external_access = true"]:
+            with pytest.raises(QueryError, match="Only a single SELECT"):
+                server.query(sql)
+        with pytest.raises(QueryError, match="Permission"):
+            server.query(f"SELECT * FROM read_csv_auto('{TestDatasetProfiler._SALES}')")
+        assert server.stats()["idle_connections"] == 2
+
+    def test_timeout_and_concurrency(self, server):
+        with pytest.raises(QueryError, match="more than 0.5 seconds"):
+            list(server.query("SELECT COUNT(*) FROM range(100000000000) a, range(10) b").pages())
+
+        def _count(region):
+            sql = f"SELECT COUNT(*) FROM sales WHERE \"Region\" = '{region}'"
+            with server.query(sql) as result:
+                return next(result.pages())[0][0]
+
+        with ThreadPoolExecutor(8) as executor:
+            counts = list(executor.map(_count, ["Midwest", "North East", "South", "West Coast"] * 4))
+        assert sum(counts) == 40000
+        assert server.stats()["idle_connections"] == 2 and server.stats()["timeouts"] == 1
+
+    def test_context_and_endpoint(self, server, monkeypatch):
+        context = server.get_context("sales")
+        assert context.table_name == "sales" and len(context.columns) == 10
+        assert "Midwest" in context.distinct_values
+        assert server.get_context("sales") == context
+        prompts = []
+        monkeypatch.setattr("app.dataset_server", server)
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: prompts.append(prompt) or
+                            'SELECT region, SUM("Total Sales") AS total FROM sales GROUP BY 1 ORDER BY 1')
+        result = app.test_client().post("/datasets/query", json={
+            "visitor_id": "test_datasets", "dataset": "sales", "question": "sales by region", "page_size": 3})
+        assert result.mimetype == "application/x-ndjson"
+        lines = [json.loads(line) for line in result.text.splitlines()]
+        assert lines[0]["sql"] == 'SELECT "Region", SUM("Total Sales") AS total FROM sales GROUP BY 1 ORDER BY 1 NULLS FIRST'
+        assert lines[0]["columns"] == ["Region", "total"]
+        assert [len(line["rows"]) for line in lines[1:-1]] == [3, 1]
+        assert lines[-1] == {"done": True, "rows": 4, "truncated": False}
+        assert "Widget A" in prompts[0]
+        result = app.test_client().post("/datasets/query", json={"visitor_id": "test_datasets", "dataset": "none",
+                                                                 "question": "sales by region"}).json
+        assert result == {"error": "Dataset not found: none"}
+
+
+class TestQueryCache:
+    def test_canonicalize_sql(self):
+        canonical = canonicalize_sql('SELECT "Region", SUM("Total Sales") AS total FROM sales GROUP BY 1')
+        assert canonical == ('SELECT "Region", SUM("Total Sales") AS "total" FROM "sales" GROUP BY 1',
+                             frozenset({"sales"}))
+        assert canonicalize_sql('/* Results for sales by region */\nselect Region,\n  sum("Total Sales") as total '
+                                'from sales group by 1;') == canonical
+        assert canonicalize_sql("WITH a AS (SELECT * FROM sales) SELECT * FROM a JOIN orders USING (id)")[1] == \
+               frozenset({"sales", "orders"})
+        for sql in ["SELECT RANDOM() FROM sales", "SELECT NOW()", "SELECT * FROM read_csv('sales.csv')"]:
+            assert canonicalize_sql(sql) is None
+
+    def test_lru(self):
+        cache = QueryResultCache(max_entries=2, max_entry_bytes=100)
+        entry = CachedResult(["a"], ["BIGINT"], encode_rows([(1,), (2,)]), 2, False, {"sales": "v1"})
+        for key in ["k1", "k2", "k3"]:
+            cache.put(key, entry)
+        assert cache.get("k1") is None and cache.get("k3").decode_rows() == [(1,), (2,)]
+        cache.put("big", entry._replace(data=b"x" * 101))
+        assert cache.get("big") is None
+        cache.invalidate("sales", "v2")
+        assert cache.stats()["entries"] == 0
+        assert cache.stats()["evictions"] == 1 and cache.stats()["too_large"] == 1
+
+    def test_server_results(self, tmp_path):
+        shutil.copy(TestDatasetProfiler._SALES, tmp_path / "sales.csv")
+        server = DatasetServer(str(tmp_path), pool_size=1, cache=QueryResultCache())
+
+        def _run(sql):
+            with server.query(sql) as result:
+                return result.cached, [row for page in result.pages(3) for row in page]
+
+        cached, rows = _run('SELECT "Region", COUNT(*) AS orders FROM sales GROUP BY 1 ORDER BY 1')
+        assert not cached and len(rows) == 4
+        assert _run('/* Results for orders */ select Region, count(*) as orders\n'
+                    'from "sales" group by 1 order by 1') == (True, rows)
+        assert server.stats()["queries"] == 1
+        # Read in part, not cached
+        with server.query('SELECT * FROM sales') as result:
+            next(result.pages(10))
+        with server.query('SELECT * FROM sales') as result:
+            assert not result.cached
+        with open(tmp_path / "sales.csv", "a") as f:
+            f.write("10001,C001,P001,Widget A,1,10.0,10.0,2024-01-01,PayPal,Midwest\n")
+        cached, changed = _run('SELECT "Region", COUNT(*) AS orders FROM sales GROUP BY 1 ORDER BY 1')
+        assert not cached and changed[0][1] == rows[0][1] + 1
+        assert server.stats()["result_cache"]["invalidations"] == 1
 
 
 class TestFlaskApp:
@@ -137,8 +1099,260 @@ class TestFlaskApp:
         html = result.text
         assert html.startswith("<!DOCTYPE html>") and html.endswith("/html>")
 
+    def test_sql_get(self, monkeypatch):
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: "SELECT customer FROM my_table;")
+        result = app.test_client().get("/sql", query_string={
+            "visitor_id": "test_sql_get", "table_name": "my_table", "question": "all customers - get",
+            "metadata": _METADATA, "sample_data": "[]"}).json
+        assert result == {"sql": "SELECT customer FROM my_table", "attempts": 1}
+
+    def test_sql_post_gzip(self, monkeypatch):
+        prompts = []
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: prompts.append(prompt) or
+                            "SELECT cust_omer FROM my_table")
+        body = gzip.compress(json.dumps({"visitor_id": "test_sql_post", "table_name": "my_table",
+                                         "question": "all customers - post", "metadata": _METADATA}).encode())
+        result = app.test_client().post("/sql", data=body, headers={"Content-Encoding": "gzip",
+                                                                    "Content-Type": "application/json"}).json
+        assert result == {"sql": "SELECT customer FROM my_table", "attempts": 1}
+        assert "all customers - post" in prompts[0]
+
+    def test_sql_invalid_request(self):
+        result = app.test_client().post("/sql", data=b"not json").json
+        assert result["error"].startswith("Invalid request")
+
+    def test_sql_stream(self, monkeypatch):
+        monkeypatch.setattr("sql_generator.invoke_llm_stream",
+                            lambda prompt, model_id: iter(["/* Results for all customers */ ", "SELECT customer ",
+                                                           "FROM my_table"]))
+        result = app.test_client().post("/sql/stream", json={
+            "visitor_id": "test_sql_stream", "table_name": "my_table", "question": "all customers - stream",
+            "metadata": _METADATA})
+        assert result.mimetype == "text/event-stream"
+        events = [(e.split("\n")[0][len("event: "):], json.loads(e.split("\n")[1][len("data: "):]))
+                  for e in result.text.strip().split("\n\n")]
+        assert events[0] == ("token", {"text": "/* Results for all customers */ "})
+        assert [e for e, _ in events] == ["token", "token", "token", "result"]
+        assert events[-1][1] == {"sql": "/* Results for all customers */ SELECT customer FROM my_table",
+                                 "attempts": 1}
+
+
+    def test_sql_with_context(self, monkeypatch):
+        prompts = []
+        monkeypatch.setattr("sql_generator.invoke_llm", lambda prompt, model_id: prompts.append(prompt) or
+                            "SELECT customer FROM my_table")
+        client = app.test_client()
+        context_id = client.post("/sql/context", json={"table_name": "my_table", "metadata": _METADATA,
+                                                       "sample_data": "[]"}).json["context_id"]
+        params = {"visitor_id": "test_sql_with_context", "context_id": context_id, "session_id": "s1"}
+        assert client.post("/sql", json={**params, "question": "all customers - context"}).json["sql"] == \
+               "SELECT customer FROM my_table"
+        assert client.post("/sql", json={**params, "question": "only the first one"}).json["attempts"] == 1
+        assert _METADATA in prompts[0] and "<conversation>" not in prompts[0]
+        assert "Question: all customers - context\nSQL: SELECT customer FROM my_table" in prompts[1]
+        # The retry of an answer that failed on the client replaces it in the conversation
+        client.post("/sql", json={**params, "question": "only the first one", "previous_error": "e",
+                                  "previous_sql": "SELECT customer FROM my_table"})
+        assert [t.question for t in dataset_contexts.get_turns(context_id, "s1")] == \
+               ["all customers - context", "only the first one"]
+        assert "Invalid" in client.post("/sql", json={**params, "session_id": "x" * 100, "question": "q"}).json["error"]
+        assert "context_id not found" in client.post("/sql", json={**params, "context_id": "x",
+                                                                   "question": "q"}).json["error"]
+        assert "metadata" in client.post("/sql/context", json={"table_name": "t"}).json["error"]
+
+
+    def test_sql_batch(self, monkeypatch):
+        monkeypatch.setenv("BATCH_PROVIDER_CONCURRENCY", "3")
+        running, max_running = [0], [0]
+        lock = threading.Lock()
+
+        def _invoke(prompt, model_id):
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            sleep(0.2)
+            with lock:
+                running[0] -= 1
+            if "bad question" in prompt:
+                raise ValueError("LLM failed")
+            return "SELECT customer FROM my_table"
+
+        monkeypatch.setattr("sql_generator.invoke_llm", _invoke)
+        questions = [f"batch question {i}" for i in range(5)] + ["bad question"]
+        result = app.test_client().post("/sql/batch", json={
+            "visitor_id": "test_sql_batch", "table_name": "my_table", "metadata": _METADATA,
+            "model_id": "gemini-2.0-flash", "questions": questions})
+        events = [(e.split("\n")[0][len("event: "):], json.loads(e.split("\n")[1][len("data: "):]))
+                  for e in result.text.strip().split("\n\n")]
+        assert events[-1] == ("done", {"questions": 6, "errors": 1})
+        results = {data["index"]: (event, data) for event, data in events[:-1]}
+        assert sorted(results) == list(range(6))
+        assert results[0] == ("result", {"index": 0, "sql": "SELECT customer FROM my_table", "attempts": 1})
+        assert results[5] == ("error", {"index": 5, "error": "LLM failed"})
+        assert max_running[0] == 3
+
+    def test_sql_batch_invalid(self):
+        result = app.test_client().post("/sql/batch", json={"metadata": _METADATA, "questions": []})
+        assert "questions" in result.text and result.text.startswith("event: error")
+
+
+class TestAsgiApp:
+    @staticmethod
+    async def _request(method: str, url: str, **kwargs) -> httpx.Response:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=asgi_app), base_url="http://test") as client:
+            return await client.request(method, url, **kwargs)
+
+    def test_ping_served_by_flask(self):
+        assert asyncio.run(self._request("GET", "/ping")).json()["status"] == "ok"
+
+    def test_flask_routes_run_in_thread_pool(self, monkeypatch):
+        def _invoke_llm_stream(prompt, model_id):
+            sleep(1)
+            yield "SELECT customer FROM my_table"
+
+        async def _run():
+            body = {"visitor_id": "test_asgi_pool", "table_name": "my_table", "question": "all customers - pool",
+                    "metadata": _METADATA}
+            stream = asyncio.ensure_future(self._request("POST", "/sql/stream", json=body))
+            await asyncio.sleep(0.2)
+            start = time.perf_counter()
+            assert (await self._request("GET", "/ping")).status_code == 200
+            seconds = time.perf_counter() - start
+            assert "SELECT customer FROM my_table" in (await stream).text
+            return seconds
+
+        monkeypatch.setattr("sql_generator.invoke_llm_stream", _invoke_llm_stream)
+        assert asyncio.run(_run()) < 0.5
+
+    def test_sql(self, monkeypatch):
+        async def _ainvoke_llm(prompt, model_id):
+            await asyncio.sleep(0.01)
+            return "SELECT customer FROM my_table"
+
+        monkeypatch.setattr("sql_generator.ainvoke_llm", _ainvoke_llm)
+        body = gzip.compress(json.dumps({"visitor_id": "test_asgi_sql", "table_name": "my_table",
+                                         "question": "all customers - asgi", "metadata": _METADATA}).encode())
+        result = asyncio.run(self._request("POST", "/sql", content=body, headers={"Content-Encoding": "gzip"}))
+        assert result.json() == {"sql": "SELECT customer FROM my_table", "attempts": 1}
+        result = asyncio.run(self._request("GET", "/sql", params={"visitor_id": "test_asgi_sql",
+                                                                  "table_name": "my_table", "metadata": "x"}))
+        assert result.json()["error"].startswith("Invalid request")
+
+    def test_concurrent_requests_coalesced(self, monkeypatch):
+        calls = []
+
+        async def _ainvoke_llm(prompt, model_id):
+            calls.append(prompt)
+            await asyncio.sleep(0.2)
+            return "SELECT customer FROM my_table"
+
+        async def _run():
+            body = {"visitor_id": "test_asgi_concurrent", "table_name": "my_table",
+                    "question": "all customers - concurrent", "metadata": _METADATA}
+            return await asyncio.gather(*[self._request("POST", "/sql", json=body) for _ in range(10)])
+
+        monkeypatch.setattr("sql_generator.ainvoke_llm", _ainvoke_llm)
+        results = asyncio.run(_run())
+        assert all(r.json()["sql"] == "SELECT customer FROM my_table" for r in results)
+        assert len(calls) == 1
+
 
 class TestUtils:
     def test_invoke_model_value_error(self):
         with pytest.raises(ValueError, match="Unknown model_id: unknown"):
             invoke_llm("", "unknown")
+
+    def test_bedrock_client_reused(self, monkeypatch):
+        monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+        client = get_bedrock_client()
+        assert get_bedrock_client() is client
+        assert get_bedrock_client("us-west-2") is not client
+        monkeypatch.setenv("BEDROCK_READ_TIMEOUT", "10")
+        assert get_bedrock_client() is not client
+        assert get_bedrock_client().meta.config.read_timeout == 10
+
+    def test_backends_loaded_on_first_use(self):
+        script = """
+import sys
+import app, asgi, sql_generator, utils
+loaded = lambda: sorted(m for m in ("boto3", "sqlglot", "gemini_backend", "bedrock_backend", "duckdb", "httpx")
+                        if m in sys.modules)
+print(loaded())
+utils.load_backend("gemini").warm_up()
+print(loaded())
+sql_generator.warm_up_sql_fixer()
+print(loaded())
+"""
+        output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                cwd=get_project_folder() + "/src").stdout.splitlines()
+        assert output == ["[]", "['gemini_backend']", "['gemini_backend', 'sqlglot']"]
+
+    def test_invoke_gemini_with_pool(self, monkeypatch):
+        with FakeLLMServer("SELECT 2 AS col") as server:
+            monkeypatch.setenv("GEMINI_API_URL", server.url)
+            monkeypatch.setenv("GEMINI_API_KEY", "key")
+            assert invoke_llm("question", "gemini-2.0-flash") == "SELECT 2 AS col"
+            assert invoke_llm("question", "gemini-2.0-flash") == "SELECT 2 AS col"
+            assert server.connections == 1
+            assert server.requests[0]["body"]["contents"][0]["parts"][0]["text"] == "question"
+
+    def test_invoke_gemini_stream(self, monkeypatch):
+        with FakeLLMServer("SELECT customer FROM my_table", chunk_size=4) as server:
+            monkeypatch.setenv("GEMINI_API_URL", server.url)
+            monkeypatch.setenv("GEMINI_API_KEY", "key")
+            chunks = list(invoke_llm_stream("question", "gemini-2.0-flash"))
+            assert chunks[0] == "SELE" and "".join(chunks) == "SELECT customer FROM my_table"
+            assert "".join(invoke_llm_stream("question", "gemini-2.0-flash")) == "SELECT customer FROM my_table"
+            assert server.connections == 1
+
+    def test_invoke_bedrock_stream(self, monkeypatch):
+        class _FakeClient:
+            def invoke_model_with_response_stream(self, body, modelId):
+                chunks = [{"type": "message_start"},
+                          {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "SELECT "}},
+                          {"type": "content_block_delta", "delta": {"type": "text_delta", "text": "1"}},
+                          {"type": "message_stop"}]
+                return {"body": [{"chunk": {"bytes": json.dumps(c).encode()}} for c in chunks]}
+
+        monkeypatch.setattr("bedrock_backend.get_bedrock_client", lambda: _FakeClient())
+        assert list(invoke_llm_stream("question", "anthropic.claude-v2")) == ["SELECT ", "1"]
+
+    def test_ainvoke_gemini(self, monkeypatch):
+        with FakeLLMServer("SELECT 3 AS col") as server:
+            monkeypatch.setenv("GEMINI_API_URL", server.url)
+            monkeypatch.setenv("GEMINI_API_KEY", "key")
+            assert asyncio.run(ainvoke_llm("question", "gemini-2.0-flash")) == "SELECT 3 AS col"
+            assert server.requests[0]["path"] == "/v1beta/models/gemini-2.0-flash:generateContent?key=key"
+
+    def test_invoke_bedrock_sync_and_async(self, monkeypatch):
+        with FakeLLMServer("SELECT 4 AS col") as server:
+            monkeypatch.setenv("BEDROCK_ENDPOINT_URL", server.url)
+            monkeypatch.setenv("AWS_ACCESS_KEY_ID", "key-id")
+            monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+            model_id = "us.anthropic.claude-haiku-4-5-20251001-v1:0"
+            assert invoke_llm("question", model_id) == "SELECT 4 AS col"
+            assert asyncio.run(ainvoke_llm("question", model_id)) == "SELECT 4 AS col"
+            sync_request, async_request = server.requests
+            assert async_request["path"] == sync_request["path"]
+            assert async_request["body"] == sync_request["body"]
+            assert async_request["headers"]["Authorization"].startswith("AWS4-HMAC-SHA256 Credential=key-id/")
+
+    def test_prompt_caching(self, monkeypatch):
+        with FakeLLMServer("SELECT 5 AS col") as server:
+            monkeypatch.setenv("BEDROCK_ENDPOINT_URL", server.url)
+            monkeypatch.setenv("AWS_ACCESS_KEY_ID", "key-id")
+            monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+            model_id = "us.anthropic.claude-haiku-4-5-20251001-v1:0"
+            prompt = get_prompt("sales", "top customers", _METADATA, "[]")
+            assert invoke_llm(prompt, model_id) == "SELECT 5 AS col"
+            assert asyncio.run(ainvoke_llm(prompt, model_id)) == "SELECT 5 AS col"
+            for request in server.requests:
+                static, dataset, question = request["body"]["messages"][0]["content"]
+                assert static["cache_control"] == dataset["cache_control"] == {"type": "ephemeral"}
+                assert "<instructions>" in static["text"] and "sales" not in static["text"]
+                assert _METADATA in dataset["text"] and "top customers" not in dataset["text"]
+                assert "cache_control" not in question and "top customers" in question["text"]
+            assert get_prompt("other_table", "q", "{}", "[]").parts[0] == prompt.parts[0]
+            monkeypatch.setenv("PROMPT_CACHING", "false")
+            invoke_llm(prompt, model_id)
+            assert server.requests[-1]["body"]["messages"][0]["content"] == prompt
@@ -1,7 +1,15 @@
+import os
+
 import pytest
 
 from utils import init_logging, init_env_from_file
-from validation_tests_utils import get_test_names, ValidationTest, validate_test, validation_test_print_stats
+from validation_tests_utils import get_test_names, ValidationTest, validation_test_print_stats, run_tests, \
+    check_replay
+
+_MODEL_IDS = [
+    "gemini-2.0-flash",
+    "us.anthropic.claude-haiku-4-5-20251001-v1:0",
+]
 
 
 @pytest.fixture(autouse=True, scope="module")
@@ -13,23 +21,27 @@ def set_evn():
     validation_test_print_stats()
 
 
+@pytest.fixture(scope="module")
+def results(request, set_evn) -> dict:
+    # The selected tests of the module run at once over a process pool, every test then checks its own result
+    cases = [(item.callspec.params["test"], item.callspec.params["file"], item.callspec.params["model_id"])
+             for item in request.session.items if item.module is request.module]
+    processes = int(os.environ.get("VALIDATION_PROCESSES", os.cpu_count()))
+    return {(test.group, test.name, model_id): result
+            for (test, _, model_id), result in zip(cases, run_tests(cases, processes))}
+
+
 @pytest.mark.parametrize("test", get_test_names("resources/validation/sales/basic-tests.csv",
                                                 "sales", test_name=None))
 @pytest.mark.parametrize("file", ["resources/validation/sales/sales_data.csv"])
-@pytest.mark.parametrize("model_id", [
-    "gemini-2.0-flash",
-    "us.anthropic.claude-haiku-4-5-20251001-v1:0",
-])
-def test_sales_validation(test: ValidationTest, file: str, model_id: str):
-    validate_test(test, file, model_id)
+@pytest.mark.parametrize("model_id", _MODEL_IDS)
+def test_sales_validation(test: ValidationTest, file: str, model_id: str, results: dict):
+    check_replay(results[(test.group, test.name, model_id)])
 
 
 @pytest.mark.parametrize("test", get_test_names("resources/validation/countries/countries-tests.csv",
                                                 "countries", test_name=None))
 @pytest.mark.parametrize("file", ["resources/validation/countries/countries.csv"])
-@pytest.mark.parametrize("model_id", [
-    "gemini-2.0-flash",
-    "us.anthropic.claude-haiku-4-5-20251001-v1:0",
-])
-def test_countries_validation(test: ValidationTest, file: str, model_id: str):
-    validate_test(test, file, model_id)
+@pytest.mark.parametrize("model_id", _MODEL_IDS)
+def test_countries_validation(test: ValidationTest, file: str, model_id: str, results: dict):
+    check_replay(results[(test.group, test.name, model_id)])
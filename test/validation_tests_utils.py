@@ -1,14 +1,25 @@
 import csv
+import hashlib
 import json
 import logging
 import os.path
-from typing import Generator, NamedTuple, List, Optional, Iterable
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Generator, NamedTuple, List, Optional, Iterable, Dict, Tuple
 
 import duckdb
 
 from question_to_sql import get_prompt
 from sql_fixer import fix_sql
-from utils import invoke_llm
+from utils import invoke_llm, init_env_from_file
+
+VALIDATION_SUITES = [
+    ("sales", "resources/validation/sales/basic-tests.csv", "resources/validation/sales/sales_data.csv"),
+    ("countries", "resources/validation/countries/countries-tests.csv", "resources/validation/countries/countries.csv"),
+]
+_DEFAULT_MODEL_ID = "anthropic.claude-instant-v1"
 
 _stats = {
     "passed": 0,
@@ -16,11 +27,17 @@ _stats = {
     "failed": 0,
     "retry_failed": 0,
     "sql_error": 0,
+    "missing_recording": 0,
+    "stale_recording": 0,
+    "stale_replays": 0,
 }
+# In replay, a test without an answer recorded for its prompt fails, so a prompt change can't go unnoticed
+REPLAY_ERRORS = ("missing_recording", "stale_recording")
 _tests_log = []
 
 
 def validation_test_print_stats():
+    get_recorder().save()
     logging.info(f"stats:\n{_stats}")
     logging.info(f"tests_log:\n{json.dumps(_tests_log, indent=4)}")
 
@@ -31,6 +48,19 @@ class ValidationTest(NamedTuple):
     question: str
     answer: list
 
+
+class ValidationResult(NamedTuple):
+    status: str
+    log: Optional[dict] = None
+    stale_replays: int = 0
+
+
+class PromptData(NamedTuple):
+    db_file: str
+    metadata: str
+    sample_data: str
+    distinct_values: Optional[str]
+
 def get_full_file_name(file: str) -> str:
     return os.path.join(os.path.dirname(os.path.abspath(__file__)), file)
 
@@ -61,9 +91,27 @@ def _data_to_str(data: Iterable) -> str:
     return result
 
 
-def validate_test(test: ValidationTest, file: str, model_id: str = None):
-    with duckdb.connect() as con:
-        con.execute(f"CREATE TABLE my_table AS SELECT * FROM read_csv_auto('{get_full_file_name(file)}')")
+@lru_cache(maxsize=None)
+def load_dataset(file: str) -> PromptData:
+    # The table and the prompt data are built once per dataset and kept on disk, every test and process reuses them
+    csv_file = get_full_file_name(file)
+    stat = os.stat(csv_file)
+    key = hashlib.sha256(f"{csv_file}:{stat.st_mtime_ns}:{stat.st_size}".encode("utf-8")).hexdigest()[:16]
+    snapshot_dir = os.environ.get("VALIDATION_SNAPSHOT_DIR", get_full_file_name(".validation_snapshots"))
+    base = os.path.join(snapshot_dir, f"{os.path.splitext(os.path.basename(file))[0]}-{key}")
+    if not os.path.exists(base + ".json"):
+        _build_snapshot(csv_file, base)
+    with open(base + ".json") as f:
+        return PromptData(base + ".duckdb", **json.load(f))
+
+
+def _build_snapshot(csv_file: str, base: str):
+    logging.info(f"Building validation snapshot: {base}")
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    # Built under temporary names and renamed, the json last: it marks a complete snapshot
+    tmp_db = f"{base}.{os.getpid()}.tmp.duckdb"
+    with duckdb.connect(tmp_db) as con:
+        con.execute(f"CREATE TABLE my_table AS SELECT * FROM read_csv_auto('{csv_file}')")
 
         try:
             metadata = list(_fetch_dict(con, "SUMMARIZE my_table"))
@@ -82,9 +130,121 @@ def validate_test(test: ValidationTest, file: str, model_id: str = None):
         else:
             distinct_values = None
         sample_data = list(_fetch_dict(con, "SELECT * FROM my_table LIMIT 5"))
-        prompt = get_prompt("my_table", test.question, _data_to_str(metadata), _data_to_str(sample_data),
-                            distinct_values, hint=None)
-        sql = invoke_llm(prompt, model_id if model_id else "anthropic.claude-instant-v1")
+    os.replace(tmp_db, base + ".duckdb")
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(base), suffix=".tmp", delete=False) as f:
+        json.dump({"metadata": _data_to_str(metadata), "sample_data": _data_to_str(sample_data),
+                   "distinct_values": distinct_values}, f)
+    os.replace(f.name, base + ".json")
+
+
+class MissingRecording(KeyError):
+    pass
+
+
+class StaleRecording(MissingRecording):
+    pass
+
+
+class LLMRecorder:
+    # VALIDATION_LLM=replay (the default) only uses the kept answers, so the suite runs offline. live calls the
+    # model, and record also keeps its answers. Answers are keyed by the hash of the model and the prompt. When the
+    # prompt changed since it was recorded the test fails, unless allow_stale replays the answer recorded for the
+    # same test and attempt
+    def __init__(self, file: str, mode: str, allow_stale: bool = False):
+        if mode not in ("live", "record", "replay"):
+            raise ValueError(f"Invalid VALIDATION_LLM: {mode}")
+        self.file = file
+        self.mode = mode
+        self.allow_stale = allow_stale
+        self._answers: Dict[str, dict] = {}
+        self._new: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if mode != "live" and os.path.exists(file):
+            with open(file) as f:
+                self._answers = json.load(f)
+        self._by_test = {_test_key(a["model_id"], a["test"], a["attempt"]): a for a in self._answers.values()}
+
+    def invoke(self, prompt: str, model_id: str, test: ValidationTest, attempt: int) -> Tuple[str, bool]:
+        # Returns the answer and whether it was recorded for a different prompt
+        key = hashlib.sha256(f"{model_id}\0{prompt}".encode("utf-8")).hexdigest()
+        if self.mode == "replay":
+            recording = self._answers.get(key)
+            if recording is not None:
+                return recording["answer"], False
+            recording = self._by_test.get(_test_key(model_id, f"{test.group}/{test.name}", attempt))
+            if recording is None:
+                raise MissingRecording(f"No recorded answer for {test.group}/{test.name}, model id: {model_id}")
+            if not self.allow_stale:
+                raise StaleRecording(f"The prompt of {test.group}/{test.name} changed since its answer was recorded, "
+                                     f"model id: {model_id}. Record it again with VALIDATION_LLM=record")
+            return recording["answer"], True
+        answer = invoke_llm(prompt, model_id)
+        if self.mode == "record":
+            self.add({key: {"model_id": model_id, "test": f"{test.group}/{test.name}", "attempt": attempt,
+                            "answer": answer}})
+        return answer, False
+
+    def add(self, recordings: Dict[str, dict]):
+        with self._lock:
+            self._answers.update(recordings)
+            self._new.update(recordings)
+
+    def take_new(self) -> Dict[str, dict]:
+        with self._lock:
+            new, self._new = self._new, {}
+        return new
+
+    def save(self):
+        with self._lock:
+            if self.mode != "record" or not self._new:
+                return
+            self._new = {}
+            with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(self.file), suffix=".tmp", delete=False) as f:
+                json.dump(self._answers, f, indent=1, sort_keys=True)
+            os.replace(f.name, self.file)
+
+
+def _test_key(model_id: str, test: str, attempt: int) -> str:
+    return f"{model_id}\0{test}\0{attempt}"
+
+
+_recorder: Optional[LLMRecorder] = None
+
+
+def get_recorder() -> LLMRecorder:
+    global _recorder
+    if _recorder is None:
+        _recorder = LLMRecorder(os.environ.get("VALIDATION_RECORDINGS",
+                                               get_full_file_name("resources/validation/llm_recordings.json")),
+                                os.environ.get("VALIDATION_LLM", "replay"),
+                                os.environ.get("VALIDATION_ALLOW_STALE", "false").lower() == "true")
+    return _recorder
+
+
+def validate_test(test: ValidationTest, file: str, model_id: str = None):
+    result = run_test(test, file, model_id)
+    record_result(result)
+    check_replay(result)
+
+
+def check_replay(result: ValidationResult):
+    assert result.status not in REPLAY_ERRORS, result.log["error"]
+
+
+def run_test(test: ValidationTest, file: str, model_id: str = None) -> ValidationResult:
+    data = load_dataset(file)
+    model_id = model_id if model_id else _DEFAULT_MODEL_ID
+    recorder = get_recorder()
+    stale_replays = 0
+    # The snapshot is only read, so any number of processes can open it at once
+    with duckdb.connect(data.db_file, read_only=True) as con:
+        prompt = get_prompt("my_table", test.question, data.metadata, data.sample_data, data.distinct_values,
+                            hint=None)
+        try:
+            sql, stale = recorder.invoke(prompt, model_id, test, 1)
+        except MissingRecording as e:
+            return _replay_error(test, model_id, e)
+        stale_replays += stale
         sql = fix_sql(sql)
         try:
             sql_error = None
@@ -93,42 +253,100 @@ def validate_test(test: ValidationTest, file: str, model_id: str = None):
             sql_error = str(e)
             logging.info(f"Got SQL error: {sql_error}. Going to retry")
         if sql_error is not None:
-            prompt = get_prompt("my_table", test.question, str(metadata), str(sample_data), hint=None,
-                                previous_sql=sql, previous_error=sql_error)
-            retry_sql = invoke_llm(prompt, model_id if model_id else "anthropic.claude-instant-v1")
+            prompt = get_prompt("my_table", test.question, data.metadata, data.sample_data, data.distinct_values,
+                                hint=None, previous_sql=sql, previous_error=sql_error)
+            try:
+                retry_sql, stale = recorder.invoke(prompt, model_id, test, 2)
+            except MissingRecording as e:
+                return _replay_error(test, model_id, e, stale_replays)
+            stale_replays += stale
             try:
                 result = con.execute(retry_sql).fetchall()
             except Exception as e:
-                _log_test(test, None, sql, sql_error, retry_sql, str(e))
                 # assert False, f"Failed to execute SQL: {retry_sql}. Error: {e}"
-                return
+                return _test_result(test, model_id, None, sql, sql_error, retry_sql, str(e), stale_replays)
         else:
             retry_sql = None
 
         verification_error = _verify_result(test.answer, result)
-        _log_test(test, verification_error, sql, sql_error, retry_sql, None)
         # if verification_error is not None:
         #     assert False, f"{verification_error}\nExpected: {test.answer}\nActual:   {result}\nSQL used: {sql}"
+        return _test_result(test, model_id, verification_error, sql, sql_error, retry_sql, None, stale_replays)
+
+
+def _replay_error(test: ValidationTest, model_id: str, e: MissingRecording, stale_replays: int = 0
+                  ) -> ValidationResult:
+    logging.info(e.args[0])
+    status = "stale_recording" if isinstance(e, StaleRecording) else "missing_recording"
+    return ValidationResult(status, {"group": test.group, "name": test.name, "model_id": model_id,
+                                     "error": e.args[0]}, stale_replays)
+
+
+def get_validation_cases(model_ids: List[str], groups: Optional[List[str]] = None
+                         ) -> List[Tuple[ValidationTest, str, str]]:
+    return [(test, data_file, model_id)
+            for group, tests_file, data_file in VALIDATION_SUITES if groups is None or group in groups
+            for test in get_test_names(tests_file, group)
+            for model_id in model_ids]
+
+
+def run_tests(cases: List[Tuple[ValidationTest, str, str]], processes: int = 1) -> List[ValidationResult]:
+    # The datasets are built here first, so the workers only read them
+    for file in {file for _, file, _ in cases}:
+        load_dataset(file)
+    if processes <= 1:
+        results = [run_test(*case) for case in cases]
+    else:
+        with ProcessPoolExecutor(processes, initializer=_init_worker) as pool:
+            results = []
+            for result, recordings in pool.map(_run_in_worker, cases):
+                get_recorder().add(recordings)
+                results.append(result)
+    for result in results:
+        record_result(result)
+    get_recorder().save()
+    return results
+
+
+def _init_worker():
+    init_env_from_file("aws.env.list")
+    init_env_from_file("google.env.list")
+
+
+def _run_in_worker(case: Tuple[ValidationTest, str, str]) -> Tuple[ValidationResult, Dict[str, dict]]:
+    # The answers a worker records go back to the parent, which keeps the recordings file
+    result = run_test(*case)
+    return result, get_recorder().take_new()
+
+
+def record_result(result: ValidationResult):
+    _stats[result.status] += 1
+    _stats["stale_replays"] += result.stale_replays
+    if result.log is not None:
+        _tests_log.append(result.log)
 
 
-def _log_test(test: ValidationTest, verification_error: Optional[str], sql: str,
-              sql_error: str, retry_sql: str, retry_sql_error: Optional[str]):
+def _test_result(test: ValidationTest, model_id: str, verification_error: Optional[str], sql: str, sql_error: str,
+                 retry_sql: str, retry_sql_error: Optional[str], stale_replays: int) -> ValidationResult:
     if retry_sql_error:
-        _stats["sql_error"] += 1
+        status = "sql_error"
     elif verification_error:
-        _stats["failed" if sql_error is None else "retry_failed"] += 1
+        status = "failed" if sql_error is None else "retry_failed"
     else:
-        _stats["passed" if sql_error is None else "retry_passed"] += 1
+        status = "passed" if sql_error is None else "retry_passed"
+    log = None
     if verification_error or sql_error:
-        _tests_log.append({
+        log = {
             "group": test.group,
             "name": test.name,
+            "model_id": model_id,
             "verification_error": verification_error,
             "sql": sql,
             "sql_error": sql_error,
             "retry_sql": retry_sql,
             "retry_sql_error": retry_sql_error
-        })
+        }
+    return ValidationResult(status, log, stale_replays)
 
 
 def _verify_result(expected: List, actual: List) -> Optional[str]: